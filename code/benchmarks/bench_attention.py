@@ -0,0 +1,107 @@
+"""
+Compares qa_model.Attention with the former formulation that tiled h and u to
+[N, JX, JQ, d_en] before the tri-linear logits. Both share the same variables
+and random inputs; reported are the largest difference of the outputs and of
+the gradients, seconds per forward + backward step and the peak resident
+memory of the process running it.
+
+    PYTHONPATH=code python code/benchmarks/bench_attention.py --batch_size 8 --JX 766 --JQ 60 --d_en 200
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+from six.moves import queue
+from tensorflow.python.ops.rnn_cell import _linear
+
+from qa_model import Attention, softmax_mask_prepro
+
+
+class TiledAttention(Attention):
+    """Attention.calculate before broadcasting, with its get_logits made runnable"""
+    def calculate(self, h, u, h_mask, u_mask, JX, JQ, dropout=1.0):
+        d_en = h.get_shape().as_list()[-1]
+        h_aug = tf.tile(tf.reshape(h, shape=[-1, JX, 1, d_en]), [1, 1, JQ, 1])
+        u_aug = tf.tile(tf.reshape(u, shape=[-1, 1, JQ, d_en]), [1, JX, 1, 1])
+        h_mask_aug = tf.tile(tf.expand_dims(h_mask, -1), [1, 1, JQ])
+        u_mask_aug = tf.tile(tf.expand_dims(u_mask, -2), [1, JX, 1])
+        args = [h_aug, u_aug, h_aug * u_aug]
+        with tf.variable_scope("Linear_Logits"):
+            flat = _linear([tf.reshape(arg, [-1, d_en]) for arg in args], 1, True, scope="first")
+        s = tf.reshape(flat, [-1, JX, JQ])
+        s = softmax_mask_prepro(s, h_mask_aug & u_mask_aug)
+
+        a_x = tf.reshape(tf.nn.softmax(s, dim=-1), shape=[-1, JX, JQ, 1])
+        u_a = tf.reduce_sum(tf.multiply(a_x, u_aug), axis=-2)
+        a_q = tf.reshape(tf.nn.softmax(tf.reduce_max(s, axis=-1), dim=-1), shape=[-1, JX, 1])
+        h_a = tf.reduce_sum(tf.multiply(a_q, h), axis=-2)
+        h_a = tf.tile(tf.expand_dims(h_a, -2), [1, JX, 1])
+        return tf.concat(2, [h, u_a, h * u_a, h * h_a])
+
+
+def build(attention, args):
+    h = tf.placeholder(tf.float32, [None, None, args.d_en])
+    u = tf.placeholder(tf.float32, [None, None, args.d_en])
+    h_len = tf.placeholder(tf.int32, [None])
+    u_len = tf.placeholder(tf.int32, [None])
+    JX, JQ = tf.shape(h)[1], tf.shape(u)[1]
+    with tf.variable_scope("attention", initializer=tf.uniform_unit_scaling_initializer(1.0)):
+        g = attention.calculate(h, u, tf.sequence_mask(h_len, JX), tf.sequence_mask(u_len, JQ), JX=JX, JQ=JQ)
+    loss = tf.reduce_sum(tf.square(g))
+    grads = tf.gradients(loss, [h, u] + tf.trainable_variables())
+    return (h, u, h_len, u_len), g, grads
+
+
+def run(name, args, results):
+    rng = np.random.RandomState(0)
+    inputs, g, grads = build(TiledAttention() if name == 'tiled' else Attention(), args)
+    feed = dict(zip(inputs, [rng.randn(args.batch_size, args.JX, args.d_en).astype(np.float32),
+                             rng.randn(args.batch_size, args.JQ, args.d_en).astype(np.float32),
+                             rng.randint(args.JX // 2, args.JX + 1, size=args.batch_size),
+                             rng.randint(args.JQ // 2, args.JQ + 1, size=args.batch_size)]))
+    with tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=args.threads,
+                                          inter_op_parallelism_threads=args.threads)) as sess:
+        # same weights in both graphs, whatever the op seeds
+        for v in sorted(tf.trainable_variables(), key=lambda v: v.name):
+            sess.run(v.assign(rng.randn(*v.get_shape().as_list()).astype(np.float32) * 0.1))
+        outputs = sess.run([g] + grads, feed)
+        tic = time.time()
+        for _ in range(args.steps):
+            sess.run([g] + grads, feed)
+        elapsed = (time.time() - tic) / args.steps
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    results.put((name, elapsed, peak, outputs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--JX", default=400, type=int)
+    parser.add_argument("--JQ", default=30, type=int)
+    parser.add_argument("--d_en", default=200, type=int)
+    parser.add_argument("--steps", default=5, type=int)
+    parser.add_argument("--threads", default=0, type=int, help="TensorFlow threads (0: all cores)")
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    outputs = {}
+    print("{:>10} {:>10} {:>12}".format("attention", "step s", "peak RSS MB"))
+    for name in ['tiled', 'broadcast']:
+        process = multiprocessing.Process(target=run, args=(name, args, results))
+        process.start()
+        while True:
+            try:
+                name, elapsed, peak, outputs[name] = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError("The {} run failed".format(name))
+        process.join()
+        print("{:>10} {:>10.3f} {:>12.0f}".format(name, elapsed, peak))
+    for label, a, b in zip(["output", "grad h", "grad u", "grad w", "grad b"], outputs['tiled'], outputs['broadcast']):
+        print("max |difference| {:<7} {:.2e} (max |value| {:.2e})".format(label, np.abs(a - b).max(), np.abs(a).max()))
@@ -0,0 +1,81 @@
+"""
+Compares a split held as lists of [question, q_len, context, c_len, span]
+examples with the same split in a QADataset: memory taken by the container
+and seconds to produce one epoch of padded minibatches. Each layout is built in its
+own process so that the resident set sizes do not mix. Without --data_dir a
+synthetic split shaped like SQuAD train is generated.
+
+    PYTHONPATH=code python code/benchmarks/bench_dataset.py --data_dir data/squad
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import utils.data_reader as data_reader
+from utils.util import QADataset, minibatches, pad_sequences
+
+
+def synthetic(num_examples, questions_per_context=5, seed=0):
+    rng = np.random.RandomState(seed)
+    num_contexts = (num_examples + questions_per_context - 1) // questions_per_context
+    question_offsets = np.concatenate([[0], np.cumsum(rng.randint(5, 30, size=num_examples))])
+    context_offsets = np.concatenate([[0], np.cumsum(rng.randint(50, 300, size=num_contexts))])
+    context_index = np.arange(num_examples) // questions_per_context
+    starts = rng.randint(50, size=num_examples)
+    return QADataset(rng.randint(1, 100000, size=question_offsets[-1]), question_offsets,
+                     rng.randint(1, 100000, size=context_offsets[-1]), context_offsets,
+                     context_index, np.stack([starts, starts], axis=1))
+
+
+def resident_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / float(1 << 20)
+
+
+def load(args, layout):
+    dataset = data_reader.read_data(args.data_dir)['training'] if args.data_dir else synthetic(args.num_examples)
+    if layout == 'lists':
+        # one list per paragraph, shared by its questions, as read_data used to return
+        contexts = [list(map(int, dataset.context_tokens[dataset.context_offsets[i]:dataset.context_offsets[i + 1]]))
+                    for i in range(len(dataset.context_offsets) - 1)]
+        return [[list(map(int, dataset.question(i))), int(dataset.question_lengths[i]),
+                 contexts[dataset.context_index[i]], int(dataset.context_lengths[i]), list(map(int, dataset.spans[i]))]
+                for i in range(len(dataset))]
+    return dataset
+
+
+def run(args, layout, results):
+    rss = resident_mb()
+    data = load(args, layout)
+    gc.collect()
+    rss = resident_mb() - rss
+    np.random.seed(0)
+    tic = time.time()
+    for batch in minibatches(data, args.batch_size):
+        if layout == 'lists':
+            # ragged batches still have to be padded before feeding
+            pad_sequences(batch[0])
+            pad_sequences(batch[2])
+    results.put((layout, len(data), rss, time.time() - tic))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="")
+    parser.add_argument("--num_examples", default=80000, type=int, help="size of the synthetic split")
+    parser.add_argument("--batch_size", default=32, type=int)
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    print("{:>10} {:>10} {:>10} {:>10}".format("layout", "examples", "MB", "epoch s"))
+    for layout in ['lists', 'QADataset']:
+        process = multiprocessing.Process(target=run, args=(args, layout, results))
+        process.start()
+        print("{:>10} {:>10} {:>10.1f} {:>10.2f}".format(*results.get()))
+        process.join()
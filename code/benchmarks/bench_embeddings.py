@@ -0,0 +1,90 @@
+"""
+Compares the embedding matrix baked into the graph as a constant, as
+setup_embeddings used to do, with the variable loaded through a
+placeholder. For each a full QASystem is built in its own process;
+reported are the seconds to build the graph, the size of the serialized
+GraphDef, the seconds to create a Saver and export the meta graph, the
+seconds to initialize the variables and the peak resident memory.
+
+    PYTHONPATH=code python code/benchmarks/bench_embeddings.py --vocab_size 115000 --embedding_size 100
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from six.moves import queue
+from tensorflow.python.ops import variable_scope as vs
+
+from qa_model import QASystem
+
+
+class ConstantEmbeddingQASystem(QASystem):
+    """QASystem with the former setup_embeddings"""
+    def setup_embeddings(self):
+        with vs.variable_scope("embeddings"):
+            pretrained_embeddings = tf.cast(self.pretrained_embeddings, tf.float32)
+            question_embeddings = tf.nn.embedding_lookup(pretrained_embeddings, self.question_placeholder)
+            question_embeddings = tf.reshape(question_embeddings, shape=[-1, self.JQ, self.config.embedding_size])
+            context_embeddings = tf.nn.embedding_lookup(pretrained_embeddings, self.context_placeholder)
+            context_embeddings = tf.reshape(context_embeddings, shape=[-1, self.JX, self.config.embedding_size])
+        return question_embeddings, context_embeddings
+
+    def load_embeddings(self, session):
+        pass
+
+
+def run(name, args, results):
+    config = argparse.Namespace(embedding_size=args.embedding_size, encoder_state_size=100, decoder_state_size=100,
+                                output_size=750, QA_ENCODER_SHARE=True, RE_TRAIN_EMBED=False, max_gradient_norm=10.,
+                                learning_rate=0.001, ema_weight_decay=None)
+    # float64, as np.load returned the trimmed GloVe matrix
+    embeddings = np.random.RandomState(0).randn(args.vocab_size, args.embedding_size)
+    tic = time.time()
+    model = (ConstantEmbeddingQASystem if name == 'constant' else QASystem)(embeddings, config)
+    build = time.time() - tic
+    graph_mb = tf.get_default_graph().as_graph_def().ByteSize() / float(1 << 20)
+    tmp = tempfile.mkdtemp()
+    try:
+        tic = time.time()
+        tf.train.Saver().export_meta_graph(os.path.join(tmp, 'model.meta'))
+        export = time.time() - tic
+    finally:
+        shutil.rmtree(tmp)
+    with tf.Session() as session:
+        tic = time.time()
+        session.run(tf.global_variables_initializer())
+        model.load_embeddings(session)
+        init = time.time() - tic
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    results.put((name, build, graph_mb, export, init, peak))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_size", default=115000, type=int)
+    parser.add_argument("--embedding_size", default=100, type=int)
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    print("{:>10} {:>8} {:>10} {:>9} {:>8} {:>12}".format("embedding", "build s", "GraphDef MB", "export s",
+                                                          "init s", "peak RSS MB"))
+    for name in ['constant', 'variable']:
+        process = multiprocessing.Process(target=run, args=(name, args, results))
+        process.start()
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError("The {} run failed".format(name))
+        process.join()
+        print("{:>10} {:>8.2f} {:>10.1f} {:>9.2f} {:>8.2f} {:>12.0f}".format(*result))
@@ -0,0 +1,76 @@
+"""
+Times parsing a GloVe text file with the former split()/map(float) loop and
+with utils.glove.iter_glove, and checks that both give the same vectors.
+Without --glove a synthetic file is generated.
+
+    PYTHONPATH=code python code/benchmarks/bench_glove.py --glove download/dwr/glove.6B.100d.txt --dim 100 --num_workers 1 4
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import utils.glove as glove_reader
+
+
+def parse_per_line(path, dim):
+    words = []
+    vectors = []
+    with open(path, 'r') as fh:
+        for line in fh:
+            array = line.lstrip().rstrip().split(" ")
+            words.append(array[0])
+            vectors.append(list(map(float, array[1:])))
+    return words, np.array(vectors, dtype=np.float32).reshape(len(words), dim)
+
+
+def parse_chunked(path, dim, num_workers):
+    words = []
+    vectors = []
+    for chunk_words, chunk_vectors in glove_reader.iter_glove(path, dim, num_workers=num_workers):
+        words.extend(chunk_words)
+        vectors.append(chunk_vectors)
+    return words, np.concatenate(vectors)
+
+
+def write_synthetic(path, num_words, dim):
+    rng = np.random.RandomState(0)
+    with open(path, 'w') as f:
+        for i in range(num_words):
+            f.write("w{} ".format(i) + " ".join("%.5f" % v for v in rng.randn(dim)) + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--glove", default="")
+    parser.add_argument("--dim", default=100, type=int)
+    parser.add_argument("--num_words", default=100000, type=int, help="size of the synthetic file")
+    parser.add_argument("--num_workers", default=[1, 2, 4], type=int, nargs='+')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = args.glove
+        if not path:
+            path = os.path.join(work_dir, "glove.txt")
+            write_synthetic(path, args.num_words, args.dim)
+
+        tic = time.time()
+        ref_words, ref_vectors = parse_per_line(path, args.dim)
+        baseline = time.time() - tic
+        print("{:>12} {:>10} {:>8} {:>10}".format("parser", "seconds", "speedup", "identical"))
+        print("{:>12} {:>10.2f} {:>8.2f} {:>10}".format("per line", baseline, 1.0, "True"))
+        for num_workers in args.num_workers:
+            tic = time.time()
+            words, vectors = parse_chunked(path, args.dim, num_workers)
+            elapsed = time.time() - tic
+            same = words == ref_words and np.array_equal(vectors, ref_vectors)
+            print("{:>12} {:>10.2f} {:>8.2f} {:>10}".format("chunked x{}".format(num_workers), elapsed,
+                                                           baseline / elapsed, str(same)))
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,54 @@
+"""
+Times preprocessing.squad_preprocess.read_write_dataset serially and with a
+process pool, and checks that both runs write byte-identical files.
+
+    PYTHONPATH=code python code/benchmarks/bench_preprocess.py --json download/squad/train-v1.1.json --num_workers 1 2 4 8
+"""
+from __future__ import print_function
+
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+from preprocessing.squad_preprocess import data_from_json, read_write_dataset
+
+OUTPUTS = ['.context', '.context_index', '.question', '.answer', '.span']
+
+
+def run(dataset, num_workers, out_dir):
+    tic = time.time()
+    read_write_dataset(dataset, 'train', out_dir, num_workers=num_workers)
+    return time.time() - tic
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", default=os.path.join("download", "squad", "train-v1.1.json"))
+    parser.add_argument("--num_workers", default=[1, 2, 4], type=int, nargs='+')
+    args = parser.parse_args()
+
+    dataset = data_from_json(args.json)
+    work_dir = tempfile.mkdtemp()
+    try:
+        serial_dir = os.path.join(work_dir, 'serial')
+        os.makedirs(serial_dir)
+        serial_time = run(dataset, 1, serial_dir)
+        results = [(1, serial_time, True)]
+        for num_workers in args.num_workers:
+            if num_workers == 1:
+                continue
+            out_dir = os.path.join(work_dir, 'workers_{}'.format(num_workers))
+            os.makedirs(out_dir)
+            elapsed = run(dataset, num_workers, out_dir)
+            same = all(filecmp.cmp(os.path.join(serial_dir, 'train' + ext), os.path.join(out_dir, 'train' + ext), shallow=False)
+                       for ext in OUTPUTS)
+            results.append((num_workers, elapsed, same))
+
+        print("{:>8} {:>10} {:>8} {:>10}".format("workers", "seconds", "speedup", "identical"))
+        for num_workers, elapsed, same in results:
+            print("{:>8} {:>10.2f} {:>8.2f} {:>10}".format(num_workers, elapsed, serial_time / elapsed, str(same)))
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,52 @@
+"""
+Compares decoding the answer spans of a batch with get_best_span, one
+example at a time, against get_best_spans on the whole batch. Logits are
+random, contexts have a sentence end every --sentence_len tokens on average
+and lengths are drawn between JX / 2 and JX. Reported are milliseconds per
+batch and whether both give the same spans and scores.
+
+    PYTHONPATH=code python code/benchmarks/bench_span_decoder.py --batch_size 32 --JX 400
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from utils.util import get_best_span, get_best_spans, get_sentence_starts, SENTENCE_END_ID
+
+
+def per_example(start_logits, end_logits, contexts, lengths):
+    return zip(*[get_best_span(s, e, c[:l]) for s, e, c, l in zip(start_logits, end_logits, contexts, lengths)])
+
+
+def batched(start_logits, end_logits, contexts, lengths, max_answer_len=None):
+    return get_best_spans(start_logits, end_logits, lengths, get_sentence_starts(contexts), max_answer_len)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--JX", default=400, type=int)
+    parser.add_argument("--sentence_len", default=25, type=int)
+    parser.add_argument("--repeat", default=20, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    shape = (args.batch_size, args.JX)
+    start_logits = rng.randn(*shape).astype(np.float32)
+    end_logits = rng.randn(*shape).astype(np.float32)
+    contexts = np.where(rng.rand(*shape) < 1. / args.sentence_len, SENTENCE_END_ID, SENTENCE_END_ID + 1)
+    lengths = rng.randint(args.JX // 2, args.JX + 1, size=args.batch_size)
+
+    spans, scores = per_example(start_logits, end_logits, contexts, lengths)
+    batch_spans, batch_scores = batched(start_logits, end_logits, contexts, lengths)
+    same = [tuple(span) for span in batch_spans.tolist()] == list(spans) and list(batch_scores) == list(scores)
+    print("identical spans and scores: {}".format(same))
+    print("{:>28} {:>10}".format("decoder", "ms/batch"))
+    for name, fn in [("get_best_span per example", lambda: per_example(start_logits, end_logits, contexts, lengths)),
+                     ("get_best_spans", lambda: batched(start_logits, end_logits, contexts, lengths)),
+                     ("get_best_spans, 30 tokens", lambda: batched(start_logits, end_logits, contexts, lengths, 30))]:
+        seconds = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print("{:>28} {:>10.2f}".format(name, seconds * 1000))
@@ -1,8 +1,17 @@
+import os
 import matplotlib.pyplot as plt
 import numpy as np
 
 # import plotly.plotly as py
 file = open('train.ids.context', 'r') 
+contexts = file.readlines()
+file.close()
+# with deduplicated contexts, train.ids.context holds one line per paragraph
+# and train.context_index maps each question to its paragraph
+if os.path.exists('train.context_index'):
+	file = open('train.context_index', 'r')
+	contexts = [contexts[int(line)] for line in file]
+	file.close()
 file_span = open('train.span', 'r')
 start_end = []
 for line in file_span:
@@ -12,7 +21,7 @@ file_span.close()
 
 # itere = 0
 # not_lovable = []
-# for line in file:
+# for line in contexts:
 # 	elements = np.array([int(i) for i in line.split()] )
 # 	se = start_end[itere]	
 # 	ans = elements[se[0]:se[1]+1]
@@ -24,7 +33,6 @@ file_span.close()
 # 		# print itere+1, np.sum(ans==6), se, elements[se[0]:se[1]+1]#, elements 
 # 		not_lovable.append(itere)
 # 	itere+=1
-# file.close()
 # print itere
 # print len(not_lovable)
 
@@ -40,7 +48,7 @@ file_span.close()
 
 s_num = []
 s_max  =[]
-for line in file:
+for line in contexts:
 	elements = np.array([int(i) for i in line.split()] )
 	ind = np.where(elements==6)[0]
 	s_num.append(len(ind))
@@ -53,7 +61,6 @@ for line in file:
 	else:
 		s_max.append(len(elements))
 	# itere+=1
-file.close()
 print max(s_max), max(s_num)
 start_end = np.array(start_end)
 print np.max(start_end[1]-start_end[0])
\ No newline at end of file
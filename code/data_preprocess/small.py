@@ -1,15 +1,63 @@
+import os
 import matplotlib.pyplot as plt
 import numpy as np
 
 # import plotly.plotly as py
-file = open('train.ids.context', 'r') 
 
-JXs = []
-for itere, line in enumerate(file):
-	elements = np.array([int(i) for i in line.split()] )
-	JXs.append(len(elements))
-file.close()
-JXs = np.array(JXs)
+# with deduplicated contexts, {tier}.ids.context and {tier}.context hold one line per paragraph
+# and {tier}.context_index maps each question to its paragraph
+def read_context_index(tier, num_questions):
+	if not os.path.exists(tier+'.context_index'):
+		return np.arange(num_questions)
+	file = open(tier+'.context_index', 'r')
+	index = np.array([int(line) for line in file])
+	file.close()
+	return index
+
+def count_questions(tier):
+	file = open(tier+'.span', 'r')
+	num_questions = sum(1 for line in file)
+	file.close()
+	return num_questions
+
+def question_context_lengths(tier):
+	"""length of the context of every question"""
+	file = open(tier+'.ids.context', 'r')
+	JXs = []
+	for itere, line in enumerate(file):
+		elements = np.array([int(i) for i in line.split()] )
+		JXs.append(len(elements))
+	file.close()
+	return np.array(JXs)[read_context_index(tier, count_questions(tier))]
+
+def write_lines(file_name, file_name_w, idx):
+	idx = set(idx)
+	file = open(file_name, 'r')
+	file_w = open(file_name_w, 'w')
+	written = 0
+	for itere, line in enumerate(file):
+		if itere in idx:
+			file_w.write(line)
+			written+=1
+	file.close()
+	file_w.close()
+	print written, ' written in ', file_name_w
+
+def write_subset(tier, idx, suffix):
+	"""writes the questions idx, the paragraphs they use and the context index remapped to them"""
+	idx = np.sort(idx)
+	context_index = read_context_index(tier, count_questions(tier))[idx]
+	rows = np.unique(context_index)
+	for file_name in [tier+'.ids.question', tier+'.question', tier+'.span', tier+'.answer']:
+		write_lines(file_name, file_name+'_'+suffix, idx)
+	for file_name in [tier+'.ids.context', tier+'.context']:
+		write_lines(file_name, file_name+'_'+suffix, rows)
+	file_w = open(tier+'.context_index_'+suffix, 'w')
+	for row in np.searchsorted(rows, context_index):
+		file_w.write('%d\n' % row)
+	file_w.close()
+
+JXs = question_context_lengths('train')
 print('training set', len(JXs))
 
 data_percent = 10
@@ -18,49 +66,18 @@ idx = np.argpartition(JXs, k)[:k]
 
 maxLen = (np.max(JXs[idx]))
 print('max len', maxLen)
-idx = np.append(idx, len(JXs)+1)
 idx = np.sort(idx)
 print('training set get ', len(idx), idx)
 
-# file_names = ['train.ids.context', 'train.ids.question', 'train.question', 'train.span', 'train.answer', 'train.context']
-# for file_name in file_names:
-# 	file = open(file_name, 'r')
-# 	file_w = open(file_name+'_'+str(data_percent), 'w') 
-# 	idx_i = 0
-# 	for itere, line in enumerate(file):
-# 		if itere == idx[idx_i]:
-# 			file_w.write(line)
-# 			idx_i+=1
-# 	file.close()
-# 	file_w.close()
-# 	print idx_i, ' written in ', file_name+'_'+str(data_percent)
+write_subset('train', idx, str(data_percent))
 
 maxLen = 100
 # if getting val_data, with len of percent max train data len
-file = open('val.ids.context', 'r') 
-JXs = []
-for itere, line in enumerate(file):
-	elements = np.array([int(i) for i in line.split()] )
-	JXs.append(len(elements))
-file.close()
-JXs = np.array(JXs)
+JXs = question_context_lengths('val')
 idx = np.where(JXs<maxLen)[0] # with len of percent max train data len, not its percent
 print(idx)
 maxLen = np.max(JXs[idx])
 print(np.max(JXs[idx]))
-idx = np.append(idx, len(JXs)+1)
-idx = np.sort(idx)
 print('val set get ', len(idx), idx)
 
-val_file_names = ['val.ids.context', 'val.ids.question', 'val.question', 'val.span', 'val.answer', 'val.context']      
-for file_name in val_file_names:
-	file = open(file_name, 'r')
-	file_w = open(file_name+'_'+str(maxLen), 'w') 
-	idx_i = 0
-	for itere, line in enumerate(file):
-		if itere == idx[idx_i]:
-			file_w.write(line)
-			idx_i+=1
-	file.close()
-	file_w.close()
-	print idx_i, ' written in ', file_name+'_'+str(maxLen)
+write_subset('val', idx, str(maxLen))
@@ -1,7 +1,13 @@
 
+import os
+import shutil
 import numpy as np
 val_file_names = ['val.ids.context', 'val.ids.question', 'val.question', 'val.span', 'val.answer', 'val.context']    
 file_names = ['train.ids.context', 'train.ids.question', 'train.question', 'train.span', 'train.answer', 'train.context']
+# with deduplicated contexts, train.ids.context and train.context hold one line per paragraph
+# and train.context_index maps each question to its paragraph
+table_names = ['train.ids.context', 'train.context']
+dedup = os.path.exists('train.context_index')
 
 file = open(file_names[0], 'r') 
 JXs = []
@@ -10,6 +16,13 @@ for line in file:
 	JXs.append(len(elements))
 file.close()
 JXs = np.array(JXs)
+if dedup:
+	file = open('train.context_index', 'r')
+	JXs = JXs[[int(line) for line in file]]
+	file.close()
+	file_names = [name for name in file_names if name not in table_names] + ['train.context_index']
+	for file_name in table_names:
+		shutil.copyfile(file_name, file_name+'_sorted')
 print('set len', len(JXs))
 JX_idx = np.argsort(JXs)
 
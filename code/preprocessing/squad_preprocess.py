@@ -1,10 +1,14 @@
 from __future__ import print_function
 import argparse
+import io
+import itertools
 import json
-import linecache
+import mmap
+import multiprocessing
 import nltk
 import numpy as np
 import os
+import re
 import sys
 from tqdm import tqdm
 import random
@@ -12,6 +16,8 @@ import random
 from collections import Counter
 from six.moves.urllib.request import urlretrieve
 
+from token_cache import TokenCache
+
 reload(sys)
 sys.setdefaultencoding('utf8')
 random.seed(42)
@@ -71,136 +77,418 @@ def data_from_json(filename):
     return data
 
 
+_JSON_DELIMITER = re.compile(r'[\s,\]}]')
+
+class _JsonReader(object):
+    """Decodes the JSON values of a file one at a time, refilling a text buffer"""
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        chunk = self.f.read(size or self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        """:return: the next non-whitespace character, '' at the end of the file"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expected one of {!r} at {!r}".format(chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        # every refill re-decodes the value from its start: doubling the reads
+        # keeps that linear in the size of the value
+        size = self.chunk_size
+        if self.peek() not in u'{["':
+            # numbers and literals end before a delimiter, which must be read
+            while not self.eof and not _JSON_DELIMITER.search(self.buf, self.pos):
+                self.fill(size)
+                size *= 2
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                value, end = None, len(self.buf)
+            # a value up to the end of the buffer, e.g. a number, may go on
+            if end < len(self.buf) or self.eof:
+                self.pos = end
+                return value
+            self.fill(size)
+            size *= 2
+
+
+def iter_articles(filename, chunk_size=1 << 20):
+    """
+    Yields the articles of the "data" list of a SQuAD JSON file one at a
+    time, so that only one article is in memory instead of the whole file
+    as with data_from_json.
+    """
+    with io.open(filename, encoding='utf-8') as f:
+        reader = _JsonReader(f, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key != 'data':
+                reader.value()
+            elif reader.expect('[') and reader.peek() != ']':
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+            else:
+                reader.expect(']')
+            if reader.expect(',}') == '}':
+                return
+
+
 def list_topics(data):
     list_topics = [data['data'][idx]['title'] for idx in range(0,len(data['data']))]
     return list_topics
 
 
-def tokenize(sequence):
+# Part of every token cache key: bump the suffix whenever tokenize() changes
+TOKENIZER_VERSION = 'nltk-{}-2'.format(nltk.__version__)
+# download/ of the repository, whatever directory the scripts are started from
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_TOKEN_CACHE_DIR = os.environ.get('TOKEN_CACHE_DIR', os.path.join(_REPO_DIR, "download", "token_cache"))
+
+token_cache = TokenCache(DEFAULT_TOKEN_CACHE_DIR, TOKENIZER_VERSION) if DEFAULT_TOKEN_CACHE_DIR else None
+
+
+def set_token_cache(cache_dir, max_bytes=1 << 30):
+    """Points tokenize() at another cache directory, or disables caching for a falsy cache_dir"""
+    global token_cache
+    token_cache = TokenCache(cache_dir, TOKENIZER_VERSION, max_bytes=max_bytes) if cache_dir else None
+
+
+_NON_SPACE = re.compile(r'\S', re.UNICODE)
+
+
+def align_tokens(sequence, tokens):
+    """Start/end character offsets [len(tokens), 2] of tokens in sequence,
+    found in a single left-to-right pass. Quote tokens match any of the
+    quote forms they may have been rewritten from. A token that cannot be
+    found gets an empty span at the current position."""
+    offsets = np.zeros((len(tokens), 2), dtype=np.int32)
+    position = 0
+    for i, token in enumerate(tokens):
+        if isinstance(token, bytes):
+            token = token.decode('utf8')
+        match = _NON_SPACE.search(sequence, position)
+        position = match.start() if match else len(sequence)
+        candidates = [u'"', u"``", u"''"] if token == u'"' else [token]
+        for candidate in candidates:
+            if sequence.startswith(candidate, position):
+                offsets[i] = position, position + len(candidate)
+                position += len(candidate)
+                break
+        else:
+            # bounded search, so a rewritten token cannot make this quadratic
+            start = sequence.find(token, position, position + len(token) + 16)
+            if start == -1:
+                offsets[i] = position, position
+            else:
+                offsets[i] = start, start + len(token)
+                position = start + len(token)
+    return offsets
+
+
+def align_tokens_bulk(sequences, token_lists):
+    """align_tokens over many paragraphs. Returns offsets [total_tokens, 2] and
+    row pointers [len(sequences) + 1]: paragraph i owns offsets[rows[i]:rows[i+1]]."""
+    rows = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(tokens) for tokens in token_lists], out=rows[1:])
+    offsets = np.zeros((rows[-1], 2), dtype=np.int32)
+    for i, (sequence, tokens) in enumerate(zip(sequences, token_lists)):
+        offsets[rows[i]:rows[i + 1]] = align_tokens(sequence, tokens)
+    return offsets, rows
+
+
+def char_to_token_span(offsets, char_start, char_end):
+    """Token span (first, last) covering characters [char_start, char_end),
+    or None if no token overlaps them"""
+    first = np.searchsorted(offsets[:, 1], char_start, side='right')
+    last = np.searchsorted(offsets[:, 0], char_end, side='left') - 1
+    if first >= len(offsets) or last < first:
+        return None
+    return int(first), int(last)
+
+
+def token_to_char_span(offsets, first, last):
+    """Characters [start, end) of tokens first..last, for slicing the original text"""
+    return int(offsets[first, 0]), int(offsets[last, 1])
+
+
+def nltk_tokenize(sequence):
     tokens = [token.replace("``", '"').replace("''", '"') for token in nltk.word_tokenize(sequence)]
-    return map(lambda x:x.encode('utf8'), tokens)
-
+    tokens = map(lambda x:x.encode('utf8'), tokens)
+    return tokens, align_tokens(sequence, tokens)
 
-def token_idx_map(context, context_tokens):
-    acc = ''
-    current_token_idx = 0
-    token_map = dict()
 
-    for char_idx, char in enumerate(context):
-        if char != u' ':
-            acc += char
-            context_token = unicode(context_tokens[current_token_idx])
-            if acc == context_token:
-                syn_start = char_idx - len(acc) + 1
-                token_map[syn_start] = [acc, current_token_idx]
-                acc = ''
-                current_token_idx += 1
-    return token_map
+def tokenize_with_offsets(sequence):
+    """(tokens, character offsets) of sequence, served from token_cache when possible"""
+    if token_cache is None:
+        return nltk_tokenize(sequence)
+    tokens, offsets = token_cache.tokenize(sequence, nltk_tokenize)
+    return list(tokens), offsets
 
 
-def invert_map(answer_map):
-    return {v[1]: [v[0], k] for k, v in answer_map.iteritems()}
+def tokenize(sequence):
+    return tokenize_with_offsets(sequence)[0]
 
 
-def read_write_dataset(dataset, tier, prefix):
-    """Reads the dataset, extracts context, question, answer,
-    and answer pointer in their own file. Returns the number
-    of questions and answers processed for the dataset"""
+def tokenize_article(article):
+    """Tokenizes one article for read_write_dataset. Returns the number of
+    questions and answers seen and, for every paragraph, the context line and
+    the (question, answer, span) lines of its questions, None for skipped ones.
+    Module level so that it can run in a multiprocessing.Pool."""
     qn, an = 0, 0
-    skipped = 0
+    paragraphs = []
+    article_paragraphs = article['paragraphs']
+    for pid in range(len(article_paragraphs)):
+        context = article_paragraphs[pid]['context']
+        # The following replacements are suggested in the paper
+        # BidAF (Seo et al., 2016)
+        context = context.replace("''", '" ')
+        context = context.replace("``", '" ')
 
-    with open(os.path.join(prefix, tier +'.context'), 'w') as context_file,  \
-         open(os.path.join(prefix, tier +'.question'), 'w') as question_file,\
-         open(os.path.join(prefix, tier +'.answer'), 'w') as text_file, \
-         open(os.path.join(prefix, tier +'.span'), 'w') as span_file:
+        context_tokens, context_offsets = tokenize_with_offsets(context)
+        examples = []
 
-        for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
-            article_paragraphs = dataset['data'][articles_id]['paragraphs']
-            for pid in range(len(article_paragraphs)):
-                context = article_paragraphs[pid]['context']
-                # The following replacements are suggested in the paper
-                # BidAF (Seo et al., 2016)
-                context = context.replace("''", '" ')
-                context = context.replace("``", '" ')
+        qas = article_paragraphs[pid]['qas']
+        for qid in range(len(qas)):
+            question = qas[qid]['question']
+            question_tokens = tokenize(question)
 
-                context_tokens = tokenize(context)
-                answer_map = token_idx_map(context, context_tokens)
+            answers = qas[qid]['answers']
+            qn += 1
 
-                qas = article_paragraphs[pid]['qas']
-                for qid in range(len(qas)):
-                    question = qas[qid]['question']
-                    question_tokens = tokenize(question)
+            num_answers = range(1)
 
-                    answers = qas[qid]['answers']
-                    qn += 1
+            for ans_id in num_answers:
+                # it contains answer_start, text
+                text = qas[qid]['answers'][ans_id]['text']
+                a_s = qas[qid]['answers'][ans_id]['answer_start']
 
-                    num_answers = range(1)
+                text_tokens = tokenize(text)
 
-                    for ans_id in num_answers:
-                        # it contains answer_start, text
-                        text = qas[qid]['answers'][ans_id]['text']
-                        a_s = qas[qid]['answers'][ans_id]['answer_start']
+                answer_start = qas[qid]['answers'][ans_id]['answer_start']
 
-                        text_tokens = tokenize(text)
+                answer_end = answer_start + len(text)
 
-                        answer_start = qas[qid]['answers'][ans_id]['answer_start']
+                # the replacements above keep the length of the context, so
+                # the character offsets still match the original answer_start
+                answer_span = char_to_token_span(context_offsets, answer_start, answer_end)
 
-                        answer_end = answer_start + len(text)
+                if answer_span is None:
+                    examples.append(None)
+                else:
+                    a_start_idx, a_end_idx = answer_span
+                    # remove length restraint since we deal with it later
+                    examples.append((' '.join(question_tokens) + '\n',
+                                     ' '.join(text_tokens) + '\n',
+                                     ' '.join([str(a_start_idx), str(a_end_idx)]) + '\n'))
 
-                        last_word_answer = len(text_tokens[-1]) # add one to get the first char
+                an += 1
 
-                        try:
-                            a_start_idx = answer_map[answer_start][1]
+        paragraphs.append((' '.join(context_tokens) + '\n', examples))
+    return qn, an, paragraphs
 
-                            a_end_idx = answer_map[answer_end - last_word_answer][1]
 
-                            # remove length restraint since we deal with it later
-                            context_file.write(' '.join(context_tokens) + '\n')
-                            question_file.write(' '.join(question_tokens) + '\n')
-                            text_file.write(' '.join(text_tokens) + '\n')
-                            span_file.write(' '.join([str(a_start_idx), str(a_end_idx)]) + '\n')
+def read_write_dataset(dataset, tier, prefix, num_workers=1, chunksize=4):
+    """Reads the dataset, extracts context, question, answer,
+    and answer pointer in their own file. Returns the number
+    of questions and answers processed for the dataset.
 
-                        except Exception as e:
-                            skipped += 1
+    Contexts are written once per paragraph to {tier}.context; line i of
+    {tier}.context_index gives the context row of question i.
+
+    With num_workers > 1 articles are tokenized by a process pool in chunks
+    of chunksize articles. Results are written in article order, so the
+    files are identical to the serial run."""
+    qn, an = 0, 0
+    skipped = 0
+    num_contexts = 0
 
-                        an += 1
+    articles = dataset['data']
+    pool = None
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        tokenized = pool.imap(tokenize_article, articles, chunksize)
+    else:
+        tokenized = itertools.imap(tokenize_article, articles)
+
+    try:
+        with open(os.path.join(prefix, tier +'.context'), 'w') as context_file,  \
+             open(os.path.join(prefix, tier +'.context_index'), 'w') as context_index_file,  \
+             open(os.path.join(prefix, tier +'.question'), 'w') as question_file,\
+             open(os.path.join(prefix, tier +'.answer'), 'w') as text_file, \
+             open(os.path.join(prefix, tier +'.span'), 'w') as span_file:
+
+            for article_qn, article_an, paragraphs in tqdm(tokenized, total=len(articles), desc="Preprocessing {}".format(tier)):
+                qn += article_qn
+                an += article_an
+                for context_line, examples in paragraphs:
+                    # row of this paragraph in the context file, written with its first kept question
+                    context_row = None
+                    for example in examples:
+                        if example is None:
+                            skipped += 1
+                            continue
+                        if context_row is None:
+                            context_row = num_contexts
+                            num_contexts += 1
+                            context_file.write(context_line)
+                        question_line, text_line, span_line = example
+                        context_index_file.write(str(context_row) + '\n')
+                        question_file.write(question_line)
+                        text_file.write(text_line)
+                        span_file.write(span_line)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
     print("Skipped {} question/answer pairs in {}".format(skipped, tier))
+    print("Wrote {} unique contexts in {}".format(num_contexts, tier))
     return qn,an
 
 
-def save_files(prefix, tier, indices):
-  with open(os.path.join(prefix, tier + '.context'), 'w') as context_file,  \
-     open(os.path.join(prefix, tier + '.question'), 'w') as question_file,\
-     open(os.path.join(prefix, tier + '.answer'), 'w') as text_file, \
-     open(os.path.join(prefix, tier + '.span'), 'w') as span_file:
-
-    for i in indices:
-      context_file.write(linecache.getline(os.path.join(prefix, 'train.context'), i))
-      question_file.write(linecache.getline(os.path.join(prefix, 'train.question'), i))
-      text_file.write(linecache.getline(os.path.join(prefix, 'train.answer'), i))
-      span_file.write(linecache.getline(os.path.join(prefix, 'train.span'), i))
+def line_offsets(path, chunk_size=1 << 24):
+  """Byte offset of every line start plus the file size, built in one sequential pass"""
+  offsets = [np.zeros(1, dtype=np.int64)]
+  position = 0
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+      newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+      offsets.append(newlines.astype(np.int64) + position + 1)
+      position += len(chunk)
+  offsets = np.concatenate(offsets)
+  if offsets[-1] != position:
+    # last line without a trailing newline
+    offsets = np.append(offsets, position)
+  return offsets
+
+
+class LineFile(object):
+  """Memory mapped text file with random access to its lines"""
+  def __init__(self, path):
+    self.offsets = line_offsets(path)
+    with open(path, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b''
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def line(self, i):
+    return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+  def write_lines(self, out, rows):
+    offsets, data = self.offsets, self.data
+    for i in rows:
+      line = data[offsets[i]:offsets[i + 1]]
+      out.write(line if line.endswith(b'\n') else line + b'\n')
+
+  def close(self):
+    if isinstance(self.data, mmap.mmap):
+      self.data.close()
+
+
+def open_tier(prefix, tier):
+  return dict((ext, LineFile(os.path.join(prefix, tier + '.' + ext)))
+              for ext in ('context', 'context_index', 'question', 'answer', 'span'))
+
+
+def save_files(prefix, tier, indices, source=None):
+  # Contexts are stored once per paragraph: keep the rows this tier refers to,
+  # in order of first use, and renumber the per-question index accordingly.
+  # Every file is written next to its target and renamed at the end, so tier
+  # may be 'train' itself while source still maps the original files.
+  own_source = source is None
+  if own_source:
+    source = open_tier(prefix, 'train')
+  try:
+    indices = np.asarray(indices, dtype=np.int64)
+    index_file = source['context_index']
+    context_index = np.fromstring(index_file.data[:index_file.offsets[-1]], dtype=np.int64, sep=' ')
+    rows = context_index[indices]
+    used, first_use = np.unique(rows, return_index=True)
+    used = used[np.argsort(first_use)]
+    renumber = np.empty(len(source['context']), dtype=np.int64)
+    renumber[used] = np.arange(len(used))
+
+    paths = []
+    for ext in ('context', 'context_index', 'question', 'answer', 'span'):
+      path = os.path.join(prefix, tier + '.' + ext)
+      paths.append((path + '.part', path))
+      with open(path + '.part', 'wb', 1 << 20) as out:
+        if ext == 'context':
+          source[ext].write_lines(out, used)
+        elif ext == 'context_index':
+          if len(rows):
+            out.write('\n'.join(map(str, renumber[rows].tolist())) + '\n')
+        else:
+          source[ext].write_lines(out, indices)
+    for tmp_path, path in paths:
+      os.rename(tmp_path, path)
+  finally:
+    if own_source:
+      for f in source.values():
+        f.close()
 
 
 def split_tier(prefix, train_percentage = 0.9, shuffle=False):
-    # Get number of lines in file
-    context_filename = os.path.join(prefix, 'train' + '.context')
-    # Get the number of lines
-    with open(context_filename) as current_file:
-        num_lines = sum(1 for line in current_file)
-    # Get indices and split into two files
-    indices_dev = range(num_lines)[int(num_lines * train_percentage)::]
-    if shuffle:
-        np.random.shuffle(indices_dev)
-        print("Shuffling...")
-    save_files(prefix, 'val', indices_dev)
-    indices_train = range(num_lines)[:int(num_lines * train_percentage)]
-    if shuffle:
-        np.random.shuffle(indices_train)
-    save_files(prefix, 'train', indices_train)
+    # Index every line of the train files once (one line per question;
+    # contexts are deduplicated) and cut both shards from the same mappings
+    source = open_tier(prefix, 'train')
+    try:
+        num_lines = len(source['question'])
+        # Get indices and split into two files
+        indices_dev = range(num_lines)[int(num_lines * train_percentage)::]
+        if shuffle:
+            np.random.shuffle(indices_dev)
+            print("Shuffling...")
+        save_files(prefix, 'val', indices_dev, source)
+        indices_train = range(num_lines)[:int(num_lines * train_percentage)]
+        if shuffle:
+            np.random.shuffle(indices_train)
+        save_files(prefix, 'train', indices_train, source)
+    finally:
+        for f in source.values():
+            f.close()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_workers", default=multiprocessing.cpu_count(), type=int,
+                        help="processes used to tokenize the dataset (1: serial)")
+    parser.add_argument("--token_cache_dir", default=DEFAULT_TOKEN_CACHE_DIR,
+                        help="persistent tokenization cache, empty to disable")
+    args = parser.parse_args()
+    set_token_cache(args.token_cache_dir)
 
     download_prefix = os.path.join("download", "squad")
     data_prefix = os.path.join("data", "squad")
@@ -220,7 +508,7 @@ if __name__ == '__main__':
 
     train_data = data_from_json(os.path.join(download_prefix, train_filename))
 
-    train_num_questions, train_num_answers = read_write_dataset(train_data, 'train', data_prefix)
+    train_num_questions, train_num_answers = read_write_dataset(train_data, 'train', data_prefix, num_workers=args.num_workers)
 
     # In train we have 87k+ questions, and one answer per question.
     # The answer start range is also indicated
@@ -0,0 +1,246 @@
+"""
+Persistent, content-addressed cache of tokenized text.
+
+Entries are keyed by sha1(tokenizer version + text), so the same paragraph or
+question is tokenized once no matter which script (squad_preprocess.py,
+qa_answer.py) or process asks for it. They are appended to a few large
+segment files <cache_dir>/<number>.tkc, a new segment being started once the
+current one holds max_bytes / num_segments bytes. Every entry is a record
+
+    magic        4 bytes   'TKC2'
+    key          20 bytes  sha1 digest
+    num_tokens   uint32    little endian
+    size         uint32    bytes of the payload that follows
+    offsets      int32     [num_tokens, 2] start/end character offsets
+    tokens       bytes     utf8 tokens joined by '\\0'
+
+written with a single append, so concurrent writers (e.g. a
+multiprocessing.Pool) never interleave records, and readers skip a record
+that is not complete yet. A process indexes the record headers of all
+segments on its first lookup and catches up with records appended by other
+processes on later misses.
+
+When the segments take more than max_bytes on disk (allocated blocks, not
+file sizes) the oldest ones are deleted. A hit on an entry in the older half
+of the segments appends it again to the current one, so entries in use
+survive: eviction is least recently used at segment granularity. A bounded
+LRU in memory in front of the disk serves repeats within one process.
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+import struct
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_MAGIC = b'TKC2'
+_RECORD = struct.Struct('<4s20sII')
+_SUFFIX = '.tkc'
+# a miss rescans the segments for other processes' records at most this often
+_SCAN_INTERVAL = 1.0
+
+
+def _disk_usage(stat):
+    # st_blocks counts 512 byte units on every POSIX system
+    return stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+
+
+class TokenCache(object):
+    def __init__(self, cache_dir, version, max_bytes=1 << 30, memory_entries=20000, num_segments=16):
+        """
+        :param version: tokenizer version, part of every key so that a new
+                        tokenizer never reads stale entries
+        :param num_segments: the disk budget is split into this many segments,
+                             the unit of eviction
+        """
+        self.cache_dir = cache_dir
+        self.version = version
+        self.max_bytes = max_bytes
+        self.num_segments = num_segments
+        self.segment_bytes = max(1, max_bytes // num_segments)
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writable = True
+        # key -> (segment, payload offset, num_tokens, payload size)
+        self.index = {}
+        self._scanned = {}
+        self._last_scan = None
+        self._readers = {}
+        self._current = None
+        self._fd = None
+
+    def key(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf8')
+        return hashlib.sha1(self.version.encode('utf8') + b'\0' + text).digest()
+
+    def _path(self, segment):
+        return os.path.join(self.cache_dir, '{:08d}{}'.format(segment, _SUFFIX))
+
+    def segments(self):
+        """Numbers of the segment files, oldest first"""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        return sorted(int(name[:-len(_SUFFIX)]) for name in names
+                      if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+
+    def _scan(self):
+        """Indexes the records appended to the segments since the last scan"""
+        self._last_scan = time.time()
+        segments = self.segments()
+        for segment in set(self._scanned) - set(segments):
+            self._forget(segment)
+        for segment in segments:
+            position = self._scanned.get(segment, 0)
+            try:
+                with open(self._path(segment), 'rb') as f:
+                    f.seek(position)
+                    data = f.read()
+            except (IOError, OSError):
+                continue
+            offset = 0
+            while offset + _RECORD.size <= len(data):
+                magic, key, num_tokens, size = _RECORD.unpack_from(data, offset)
+                if magic != _MAGIC or offset + _RECORD.size + size > len(data):
+                    break
+                self.index[key] = (segment, position + offset + _RECORD.size, num_tokens, size)
+                offset += _RECORD.size + size
+            self._scanned[segment] = position + offset
+        if self._current is None and segments:
+            self._current = segments[-1]
+
+    def _forget(self, segment):
+        for key in [key for key, location in self.index.items() if location[0] == segment]:
+            del self.index[key]
+        self._scanned.pop(segment, None)
+        reader = self._readers.pop(segment, None)
+        if reader is not None:
+            reader.close()
+
+    def _read(self, segment, offset, size):
+        reader = self._readers.get(segment)
+        if reader is None:
+            reader = self._readers[segment] = open(self._path(segment), 'rb')
+        reader.seek(offset)
+        return reader.read(size)
+
+    def _remember(self, key, entry):
+        self.memory.pop(key, None)
+        self.memory[key] = entry
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, text):
+        """Returns (tokens, offsets) or None"""
+        key = self.key(text)
+        entry = self.memory.get(key)
+        if entry is not None:
+            self._remember(key, entry)
+            self.hits += 1
+            return entry
+        if key not in self.index and (self._last_scan is None or time.time() - self._last_scan > _SCAN_INTERVAL):
+            self._scan()
+        location = self.index.get(key)
+        if location is None:
+            self.misses += 1
+            return None
+        segment, offset, num_tokens, size = location
+        try:
+            payload = self._read(segment, offset, size)
+        except (IOError, OSError):
+            payload = b''
+        if len(payload) != size:
+            # evicted by another process
+            del self.index[key]
+            self.misses += 1
+            return None
+        end = num_tokens * 2 * 4
+        offsets = np.frombuffer(payload[:end], dtype='<i4').reshape(num_tokens, 2)
+        tokens = payload[end:].split(b'\0') if num_tokens else []
+        entry = (tokens, offsets)
+        self._remember(key, entry)
+        if self._current is not None and segment <= self._current - self.num_segments // 2:
+            self._append(key, num_tokens, payload)
+        self.hits += 1
+        return entry
+
+    def put(self, text, tokens, offsets):
+        key = self.key(text)
+        self._remember(key, (tokens, offsets))
+        payload = np.asarray(offsets, dtype='<i4').reshape(len(tokens), 2).tobytes() + b'\0'.join(tokens)
+        self._append(key, len(tokens), payload)
+
+    def _append(self, key, num_tokens, payload):
+        if not self.writable:
+            return
+        record = _RECORD.pack(_MAGIC, key, num_tokens, len(payload)) + payload
+        try:
+            if self._fd is None:
+                if self._current is None:
+                    if not os.path.isdir(self.cache_dir):
+                        try:
+                            os.makedirs(self.cache_dir)
+                        except OSError:
+                            # created by another process in the meantime
+                            if not os.path.isdir(self.cache_dir):
+                                raise
+                    segments = self.segments()
+                    self._current = segments[-1] if segments else 0
+                self._fd = os.open(self._path(self._current), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            # one write per record: O_APPEND writes of other processes go before or after it
+            os.write(self._fd, record)
+            end = os.lseek(self._fd, 0, os.SEEK_CUR)
+        except (IOError, OSError) as e:
+            print("Token cache {} is not writable ({}), continuing without it".format(self.cache_dir, e))
+            self.writable = False
+            return
+        self.index[key] = (self._current, end - len(payload), num_tokens, len(payload))
+        if end >= self.segment_bytes:
+            os.close(self._fd)
+            self._fd = None
+            self._current += 1
+            self.evict()
+
+    def tokenize(self, text, tokenizer):
+        """tokenizer(text) -> (tokens, offsets), called on cache misses only"""
+        entry = self.get(text)
+        if entry is None:
+            entry = tokenizer(text)
+            self.put(text, *entry)
+        return entry
+
+    def disk_usage(self):
+        """Bytes allocated on disk by the segments"""
+        total = 0
+        for segment in self.segments():
+            try:
+                total += _disk_usage(os.stat(self._path(segment)))
+            except OSError:
+                continue
+        return total
+
+    def evict(self):
+        """Deletes the oldest segments until the cache fits in max_bytes on disk"""
+        sizes = []
+        for segment in self.segments():
+            try:
+                sizes.append((segment, _disk_usage(os.stat(self._path(segment)))))
+            except OSError:
+                continue
+        total = sum(size for _, size in sizes)
+        for segment, size in sizes:
+            if total <= self.max_bytes or segment >= self._current:
+                break
+            try:
+                os.remove(self._path(segment))
+            except OSError:
+                continue
+            total -= size
+            self._forget(segment)
@@ -7,6 +7,7 @@ import os
 import re
 import tarfile
 import argparse
+import multiprocessing
 
 from six.moves import urllib
 
@@ -15,6 +16,8 @@ from tqdm import *
 import numpy as np
 from os.path import join as pjoin
 
+import utils.glove as glove_reader
+
 _PAD = b"<pad>"
 _SOS = b"<sos>"
 _UNK = b"<unk>"
@@ -37,31 +40,33 @@ def setup_args():
     parser.add_argument("--vocab_dir", default=vocab_dir)
     parser.add_argument("--glove_dim", default=100, type=int)
     parser.add_argument("--random_init", default=True, type=bool)
+    parser.add_argument("--num_workers", default=multiprocessing.cpu_count(), type=int,
+                        help="processes used to parse the GloVe file")
     return parser.parse_args()
 
 
 
 def process_glove(args, save_path, size=4e5):
     """
-    :param vocab_list: [vocab]
-    :return:
+    Writes the full GloVe matrix to the embedding file save_path.emb, its
+    words, one per line in row order, to save_path.vocab and the word -> row
+    lookup table to save_path.index
     """
-    if not gfile.Exists(save_path + ".npz"):
+    if not gfile.Exists(save_path + ".emb"):
         glove_path = os.path.join(args.glove_dir, "glove.6B.{}d.txt".format(args.glove_dim))
+        glove = glove_reader.open_output(save_path + ".emb", (glove_reader.count_lines(glove_path), args.glove_dim))
         glove_vocab = []
-        glove = np.random.randn(int(size), args.glove_dim)
         idx = 0
-        with open(glove_path, 'r') as fh:
-            for line in tqdm(fh, total=size):
-                array = line.lstrip().rstrip().split(" ")
-                word = array[0]
-                vector = list(map(float, array[1:]))
-                glove_vocab.append(word)
-                glove[idx, :] = vector
-                idx += 1
-        
-        glove_vocab_dict = dict(zip(glove_vocab, range(len(glove_vocab))))
-        np.savez_compressed(save_path, glove=glove, glove_vocab_dict= glove_vocab_dict)
+        with open(save_path + ".vocab", 'wb') as vocab_file, tqdm(total=size) as progress:
+            for words, vectors in glove_reader.iter_glove(glove_path, args.glove_dim, num_workers=args.num_workers):
+                glove[idx:idx + len(words)] = vectors
+                vocab_file.write(b'\n'.join(words) + b'\n')
+                glove_vocab.extend(words)
+                idx += len(words)
+                progress.update(len(words))
+
+        glove_reader.commit_output(glove[:idx], save_path + ".emb", glove_reader.vocab_checksum(glove_vocab))
+        glove_reader.write_word_index(save_path + ".index", glove_vocab)
         print("saved untrimmed glove matrix at: {}".format(save_path))
 
 if __name__ == '__main__':
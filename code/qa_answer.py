@@ -4,6 +4,8 @@ from __future__ import print_function
 
 import io
 import os
+import binascii
+import hashlib
 import json
 import sys
 import random
@@ -12,24 +14,43 @@ from os.path import join as pjoin
 from tqdm import tqdm
 import numpy as np
 from six.moves import xrange
+from six.moves import cPickle as pickle
 import tensorflow as tf
 
 from qa_model import Encoder, QASystem, Decoder
-from preprocessing.squad_preprocess import data_from_json, maybe_download, squad_base_url, \
-    invert_map, tokenize, token_idx_map
+from preprocessing.squad_preprocess import iter_articles, maybe_download, squad_base_url, \
+    tokenize, tokenize_with_offsets, token_to_char_span, set_token_cache, DEFAULT_TOKEN_CACHE_DIR
+import preprocessing.squad_preprocess as squad_preprocess
+import utils.glove as glove_reader
 from utils.data_reader import preprocess_dataset, load_glove_embeddings
+from utils.util import QADataset
+from utils.prefetch import Prefetcher
 import qa_data
 
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+DEV_CACHE_VERSION = 'dev-2' # part of the load_dev cache key, bump when its output changes
+
 FLAGS = tf.app.flags.FLAGS
 
 tf.app.flags.DEFINE_float("learning_rate", 0.005, "Learning rate.")
 tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.15, "Fraction of units randomly dropped on non-recurrent connections.")
 tf.app.flags.DEFINE_integer("batch_size", 32, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("max_batch_tokens", 0, "Pack batches up to this many padded context tokens, max(JX) * batch examples, instead of batch_size examples (0: off).")
+tf.app.flags.DEFINE_integer("max_question_tokens", 0, "With max_batch_tokens, also limit the padded question tokens of a batch (0: no limit).")
+tf.app.flags.DEFINE_integer("window_size", 0, "Split contexts into windows of this many tokens and run the model on each (0: whole contexts).")
+tf.app.flags.DEFINE_integer("window_stride", 128, "Tokens between the starts of consecutive windows, at most window_size.")
+tf.app.flags.DEFINE_integer("max_answer_len", 0, "Longest answer span in tokens that is predicted (0: no limit).")
+tf.app.flags.DEFINE_boolean("span_in_graph", False, "Pick the answer spans in the TensorFlow graph and fetch only the spans instead of the logits.")
+tf.app.flags.DEFINE_integer("top_k", 0, "Also write the top_k non-overlapping answer spans of every question with their probabilities (0: off).")
+tf.app.flags.DEFINE_string("length_prior", "", "Comma separated weights of answer lengths 1, 2, ... for top_k (default: uniform).")
+tf.app.flags.DEFINE_string("candidates_path", "dev-candidates.json", "Where the top_k answers are written.")
+tf.app.flags.DEFINE_boolean("stream", False, "Read the dev set one article at a time and write the answers as JSON lines as they are predicted. Questions and contexts are read against the training vocabulary in a single pass, words outside it become <unk> instead of getting GloVe rows, so memory does not grow with the file.")
+tf.app.flags.DEFINE_integer("stream_questions", 2000, "With stream, predict on chunks of about this many questions.")
+tf.app.flags.DEFINE_string("stream_output", "dev-prediction.jsonl", "With stream, where the JSON lines of answers are written.")
 tf.app.flags.DEFINE_integer("epochs", 0, "Number of epochs to train.")
 tf.app.flags.DEFINE_integer("state_size", 200, "Size of each model layer.")
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained vocabulary.")
@@ -40,7 +61,7 @@ tf.app.flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicate
 tf.app.flags.DEFINE_string("train_dir", "train", "Training directory (default: ./train).")
 tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (default: ./log)")
 tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab file (default: ./data/squad/vocab.dat)")
-tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
+tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.emb)")
 tf.app.flags.DEFINE_string("dev_path", "data/squad/dev-v1.1.json", "Path to the JSON dev set to evaluate against (default: ./data/squad/dev-v1.1.json)")
 
 tf.app.flags.DEFINE_string("question_maxlen", 60, "Max length of question (default: 30")
@@ -52,6 +73,8 @@ tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
 tf.app.flags.DEFINE_string("decoder_hidden_size", 100, "Number of decoder_hidden_size.")
 tf.app.flags.DEFINE_string("QA_ENCODER_SHARE", True, "QA_ENCODER_SHARE weights.")
 tf.app.flags.DEFINE_string("ema_weight_decay", 0.9999, "exponential decay for moving averages ")
+tf.app.flags.DEFINE_string("token_cache_dir", DEFAULT_TOKEN_CACHE_DIR, "Persistent tokenization cache directory, empty to disable (default: download/token_cache of the repository)")
+tf.app.flags.DEFINE_string("dev_cache_dir", pjoin("download", "dev_cache"), "Directory of the preprocessed dev sets, empty to disable (default: ./download/dev_cache)")
 
 def initialize_model(session, model, train_dir):
     ckpt = tf.train.get_checkpoint_state(train_dir)
@@ -60,9 +83,12 @@ def initialize_model(session, model, train_dir):
         logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
         saver = tf.train.Saver()
         saver.restore(session, ckpt.model_checkpoint_path)
+        if not model.config.RE_TRAIN_EMBED:
+            model.load_embeddings(session)
     else:
         logging.info("Created model with fresh parameters.")
         session.run(tf.global_variables_initializer())
+        model.load_embeddings(session)
         logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
     return model
 
@@ -79,165 +105,157 @@ def initialize_vocab(vocab_path):
         raise ValueError("Vocabulary file %s not found.", vocab_path)
 
 
-def read_dataset(dataset, tier, vocab):
-    """Reads the dataset, extracts context, question, answer,
-    and answer pointer in their own file. Returns the number
-    of questions and answers processed for the dataset"""
-
-    context_data = []
-    query_data = []
-    question_uuid_data = []
+def tokenize_dev(articles, vocab, rev_vocab, expand=True):
+    """
+    Tokenizes the paragraphs of articles straight to token ids. Words
+    missing from vocab are appended to rev_vocab and added to vocab, both
+    in place, so ids always refer to the expanded vocabulary. With
+    expand=False they are mapped to UNK_ID and vocab is left as it is.
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
-            context = article_paragraphs[pid]['context']
+    Yields for every paragraph (context ids, token character offsets,
+    original context text, [(question ids, question uuid)]).
+    """
+    def ids(tokens):
+        token_ids = np.empty(len(tokens), dtype=np.int32)
+        for i, w in enumerate(tokens):
+            token_id = vocab.get(w)
+            if token_id is None and not expand:
+                token_id = qa_data.UNK_ID
+            elif token_id is None:
+                token_id = vocab[w] = len(rev_vocab)
+                rev_vocab.append(w)
+            token_ids[i] = token_id
+        return token_ids
+
+    for article in articles:
+        for paragraph in article['paragraphs']:
+            context = paragraph['context']
             # The following replacements are suggested in the paper
             # BidAF (Seo et al., 2016)
             context = context.replace("''", '" ')
             context = context.replace("``", '" ')
 
-            context_tokens = tokenize(context)
-
-            qas = article_paragraphs[pid]['qas']
-            for qid in range(len(qas)):
-                question = qas[qid]['question']
-                question_tokens = tokenize(question)
-                question_uuid = qas[qid]['id']
-
-                context_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in context_tokens]
-                qustion_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in question_tokens]
-
-                context_data.append(' '.join(context_ids))
-                query_data.append(' '.join(qustion_ids))
-                question_uuid_data.append(question_uuid)
-
-    return context_data, query_data, question_uuid_data
-
+            context_tokens, context_offsets = tokenize_with_offsets(context)
+            questions = [(ids(tokenize(qa['question'])), qa['id']) for qa in paragraph['qas']]
+            yield ids(context_tokens), context_offsets, paragraph['context'], questions
 
-def prepare_dev(prefix, dev_filename, vocab):
-    # Don't check file size, since we could be using other datasets
-    dev_dataset = maybe_download(squad_base_url, dev_filename, prefix)
-
-    dev_data = data_from_json(os.path.join(prefix, dev_filename))
-    context_data, question_data, question_uuid_data = read_dataset(dev_data, 'dev', vocab)
-
-    return context_data, question_data, question_uuid_data
 
-def expand_vocab(prefix, dev_filename, vocab, embd, raw_glove, raw_glove_vocab):
+def read_dev(articles, vocab, rev_vocab, expand=True):
+    """
+    Reads the dev set in one pass, see tokenize_dev.
 
-    # Don't check file size, since we could be using other datasets
-    dev_dataset = maybe_download(squad_base_url, dev_filename, prefix)
-    dev_data = data_from_json(os.path.join(prefix, dev_filename))
-    #context_data, question_data, question_uuid_data = read_dataset(dev_data, 'dev', vocab)
-    dataset = dev_data
-    context_data = []
-    query_data = []
+    :return: the dataset of generate_answers: (QADataset, None, context
+             lengths, question uuids, original context texts, token
+             character offsets), the last two per question and shared by
+             the questions of one paragraph
+    """
+    examples = []
     question_uuid_data = []
-    tier = 'dev'
-    new_vocab = {}
+    context_text_data = []
+    context_offsets_data = []
+    for context, offsets, text, questions in tokenize_dev(articles, vocab, rev_vocab, expand):
+        for question, uuid in questions:
+            examples.append([question, len(question), context, len(context), None])
+            question_uuid_data.append(uuid)
+            context_text_data.append(text)
+            context_offsets_data.append(offsets)
+    mydata = QADataset.from_examples(examples)
+    return mydata, None, mydata.context_lengths, question_uuid_data, context_text_data, context_offsets_data
+
+
+def expand_embeddings(new_words, dim, raw_embed_path):
+    """
+    :return: [len(new_words), dim] rows for the words new to the trimmed
+             vocabulary, from the untrimmed GloVe matrix when it has the
+             word (capitalized or upper case preferred), random otherwise
+    """
+    raw_glove = load_glove_embeddings(raw_embed_path + ".emb")
+    if not tf.gfile.Exists(raw_embed_path + ".index"):
+        # untrimmed matrices written before the index existed
+        with open(raw_embed_path + ".vocab", 'rb') as f:
+            glove_reader.write_word_index(raw_embed_path + ".index", [line.rstrip(b'\n') for line in f])
+    raw_glove_vocab = glove_reader.WordIndex(raw_embed_path + ".index")
+    if raw_glove_vocab.checksum != glove_reader.read_header(raw_embed_path + ".emb")[2]:
+        raise ValueError("{}.index does not belong to {}.emb, rerun process_glove.py".format(raw_embed_path, raw_embed_path))
+
+    new_rows = np.random.randn(len(new_words), dim).astype(np.float32)
     found = 0
-    notfound = 0
+    for i, word in enumerate(new_words):
+        for variant in (word, word.capitalize(), word.upper()):
+            if variant in raw_glove_vocab:
+                found += 1
+                new_rows[i, :] = raw_glove[raw_glove_vocab[variant], :]
+    print('New vocabulary:', len(new_words))
+    print("{} unseen words found embeddings".format(found))
+    return new_rows
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
-            context = article_paragraphs[pid]['context']
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
 
-            context_tokens = tokenize(context)
-
-            qas = article_paragraphs[pid]['qas']
-            for qid in range(len(qas)):
-                question = qas[qid]['question']
-                question_tokens = tokenize(question)
-                question_uuid = qas[qid]['id']
-
-                #context_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in context_tokens]
-                #qustion_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in question_tokens]
-                #print(context_ids)
-                for w in context_tokens:
-                    if not w in vocab:
-                        if not w in new_vocab:
-                            new_vocab[w] = 1
-                        else:
-                            new_vocab[w] += 1
-                        notfound +=1
-                    else:
-                        found += 1
-
-                for w in question_tokens:
-                    if not w in vocab:
-                        if not w in new_vocab:
-                            new_vocab[w] = 1
-                        else:
-                            new_vocab[w] += 1
-                        notfound +=1
-                    else:
-                        found +=1
-
-
-    print('found/not found: {}/{}, {}% not found'.format(found, notfound, 100 * notfound/float(found + notfound)))
-    print('New vocabulary:',len(new_vocab))
-
-    vocab_list = list(vocab.items())
-    vn = len(vocab_list)
-    for i in range((len(new_vocab))):
-        vocab_list.append((new_vocab.keys()[i], vn+i))
-
-    vocab = dict(vocab_list)
-    rev_vocab = dict([(x, y) for (y,x) in vocab_list])
-                #context_data.append(' '.join(context_ids))
-                #query_data.append(' '.join(qustion_ids))
-                #question_uuid_data.append(question_uuid)
-    #return context_data, question_data, question_uuid_data
-    _, dim = embd.shape
-    new_glove = np.random.randn(len(vocab), dim)
-    new_glove[:vn, :] = embd
+def file_sha1(path, chunk_size=1 << 24):
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
 
-    found = 0
-    for i in range(vn, vn+(len(new_vocab))):
-        word = vocab_list[i][0]
-        if word in raw_glove_vocab:
-            found += 1
-            idx = raw_glove_vocab[word]
-            new_glove[i, :] = raw_glove[idx, :]
-        if word.capitalize() in raw_glove_vocab:
-            found += 1
-            idx = raw_glove_vocab[word.capitalize()]
-            new_glove[i, :] = raw_glove[idx, :]
-        if word.upper() in raw_glove_vocab:
-            found += 1
-            idx = raw_glove_vocab[word.upper()]
-            new_glove[i, :] = raw_glove[idx, :]
-    #from IPython import embed; embed()
-    print("{} unseen words found embeddings".format(found))
 
-    return vocab, rev_vocab, new_glove
-
-def strip(x):
-    return map(int, x.strip().split(" "))
-
-def preprocessing(context_data, question_data, context_maxlen, question_maxlen):
-    logging.debug("Preprocessing evaluation data...")
-    dataset = []
-    max_q_len = 0
-    max_c_len = 0
-    for c_data, q_data in zip(context_data, question_data):
-        question = strip(q_data)
-        context = strip(c_data)
-        sample = [question, len(question), context, len(context), None]
-        dataset.append(sample)
-        max_q_len = max(max_q_len, len(question))
-        max_c_len = max(max_c_len, len(context))
-    logging.debug("Max question length %d" % max_q_len)
-    logging.debug("Max context length %d" % max_c_len)
-    return dataset
-
-def generate_answers(sess, model, dataset, rev_vocab):
+def load_dev(dev_path, vocab, rev_vocab, embeddings, raw_embed_path, cache_dir=None):
+    """
+    Expands the vocabulary and the embeddings with the words of the dev set
+    and reads it with read_dev, in one pass over the file. The result is
+    cached in cache_dir under a key made of the dev file's sha1, the
+    trimmed vocabulary, the untrimmed GloVe checksum and the tokenizer
+    version, so that a second run on the same file skips all of it.
+
+    :return: (vocab, rev_vocab, embeddings, dataset)
+    """
+    key = hashlib.sha1('\n'.join([DEV_CACHE_VERSION, squad_preprocess.TOKENIZER_VERSION, file_sha1(dev_path),
+                                  binascii.hexlify(glove_reader.vocab_checksum(rev_vocab)),
+                                  binascii.hexlify(glove_reader.read_header(raw_embed_path + ".emb")[2])]
+                                 ).encode('utf8')).hexdigest()
+    cache_path = os.path.join(cache_dir, key + '.pkl') if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        logging.info("Reading the preprocessed dev set from {}".format(cache_path))
+        with open(cache_path, 'rb') as f:
+            new_words, new_rows, dataset = pickle.load(f)
+    else:
+        new_vocab, new_rev_vocab = dict(vocab), list(rev_vocab)
+        dataset = read_dev(tqdm(iter_articles(dev_path), desc="Preprocessing dev"), new_vocab, new_rev_vocab)
+        new_words = new_rev_vocab[len(rev_vocab):]
+        new_rows = expand_embeddings(new_words, embeddings.shape[1], raw_embed_path)
+        if cache_path:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache_path + '.part', 'wb') as f:
+                pickle.dump((new_words, new_rows, dataset), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_path + '.part', cache_path)
+
+    vocab = dict(vocab)
+    vocab.update((word, len(rev_vocab) + i) for i, word in enumerate(new_words))
+    rev_vocab = list(rev_vocab) + list(new_words)
+    embeddings = np.concatenate([embeddings, new_rows])
+    return vocab, rev_vocab, embeddings, dataset
+
+
+def stream_dev(dev_path, vocab, rev_vocab, chunk_questions):
+    """
+    Reads the dev set one article at a time and yields the dataset of
+    generate_answers for every chunk of at least chunk_questions questions
+    (whole articles), so that memory use does not grow with the file.
+    Words outside vocab, the training vocabulary, are read as UNK_ID.
+    """
+    articles = []
+    num_questions = 0
+    for article in iter_articles(dev_path):
+        articles.append(article)
+        num_questions += sum(len(paragraph['qas']) for paragraph in article['paragraphs'])
+        if num_questions >= chunk_questions:
+            yield read_dev(articles, vocab, rev_vocab, expand=False)
+            articles = []
+            num_questions = 0
+    if articles:
+        yield read_dev(articles, vocab, rev_vocab, expand=False)
+
+def generate_answers(sess, model, dataset, rev_vocab, window_size=0, window_stride=0, top_k=0, length_prior=None):
     """
     Loop over the dev or test dataset and generate answer.
 
@@ -254,24 +272,48 @@ def generate_answers(sess, model, dataset, rev_vocab):
     :param sess: active TF session
     :param model: a built QASystem model
     :param rev_vocab: this is a list of vocabulary that maps index to actual words
-    :return:
+    :param window_size: when set, predict on windows of this many context tokens
+                        every window_stride tokens (see QASystem.predict_on_windows)
+    :param top_k: also return candidates[uuid], the top_k answers as dicts
+                  of text, start, end and probability (see get_top_spans)
+    :param length_prior: weights of the answer lengths for top_k
+    :return: answers, or (answers, candidates) with top_k
     """
     answers = {}
 
-    mydata, context_data, context_len_data, question_uuid_data = dataset
-    predicts = model.predict_on_batch(sess, mydata)
+    mydata, context_data, context_len_data, question_uuid_data = dataset[:4]
+    # original context text and token offsets, when available answers are cut out of the text
+    context_text_data, context_offsets_data = dataset[4:6] if len(dataset) >= 6 else (None, None)
+    if window_size and top_k:
+        raise ValueError("top_k answers are not supported with window_size")
+    if window_size:
+        predicts = model.predict_on_windows(sess, mydata, window_size, window_stride)
+    elif top_k:
+        predicts, probs = model.predict_on_batch(sess, mydata, with_scores=True, top_k=top_k, length_prior=length_prior)
+    else:
+        predicts = model.predict_on_batch(sess, mydata)
+
+    def answer_text(i, start, end):
+        end = min(end, context_len_data[i] - 1)
+        if start > end:
+            return ''
+        elif context_text_data is not None:
+            char_start, char_end = token_to_char_span(context_offsets_data[i], start, end)
+            return context_text_data[i][char_start:char_end]
+        context = mydata.context(i)
+        return ' '.join(rev_vocab[vocab_index] for vocab_index in context[start : end + 1])
+
+    if top_k:
+        candidates = {}
+        for i, uuid in enumerate(question_uuid_data):
+            candidates[uuid] = [{"text": answer_text(i, start, end), "start": start, "end": end, "probability": prob}
+                                for (start, end), prob in zip(predicts[i], probs[i])]
+            answers[uuid] = candidates[uuid][0]["text"] if candidates[uuid] else ''
+        return answers, candidates
 
     for i, uuid in enumerate(question_uuid_data):
         start, end = predicts[i]
-
-        context_length = context_len_data[i]
-        context = strip(context_data[i])
-        end = min(end, context_length - 1)
-        if start <= end:
-            predict_answer = ' '.join(rev_vocab[vocab_index] for vocab_index in context[start : end + 1])
-        else:
-            predict_answer = ''
-        answers[uuid] = predict_answer
+        answers[uuid] = answer_text(i, start, end)
 
     return answers
 
@@ -296,9 +338,10 @@ def get_normalized_train_dir(train_dir):
 
 def main(_):
 
+    set_token_cache(FLAGS.token_cache_dir)
     vocab, rev_vocab = initialize_vocab(FLAGS.vocab_path)
 
-    embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
+    embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.emb".format(FLAGS.embedding_size))
 
     if not os.path.exists(FLAGS.log_dir):
         os.makedirs(FLAGS.log_dir)
@@ -315,23 +358,24 @@ def main(_):
     dev_dirname = os.path.dirname(os.path.abspath(FLAGS.dev_path))
     dev_filename = os.path.basename(FLAGS.dev_path)
 
-    embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
-    embeddings = load_glove_embeddings(embed_path)
-
+    embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.emb".format(FLAGS.embedding_size))
+    embeddings = load_glove_embeddings(embed_path, rev_vocab)
+    raw_embed_path = pjoin("data", "squad", "glove.untrimmed.{}".format(FLAGS.embedding_size))
 
-    raw_embed_path = pjoin("data", "squad", "glove.untrimmed.{}.npz".format(FLAGS.embedding_size))
-    raw_glove_data = np.load(raw_embed_path)
-    raw_glove = raw_glove_data['glove']
-    raw_glove_vocab = raw_glove_data['glove_vocab_dict'][()]
-
-
-    # expand vocab
-    vocab, rev_vocab, embeddings = expand_vocab(dev_dirname, dev_filename, vocab, embeddings, raw_glove, raw_glove_vocab)
+    # Don't check file size, since we could be using other datasets
+    maybe_download(squad_base_url, dev_filename, dev_dirname)
+    dev_path = os.path.join(dev_dirname, dev_filename)
 
-    context_data, question_data, question_uuid_data = prepare_dev(dev_dirname, dev_filename, vocab)
-    context_len_data = [len(context.split()) for context in context_data]
-    mydata = preprocessing(context_data, question_data, FLAGS.context_maxlen, FLAGS.question_maxlen)
-    dataset = (mydata, context_data, context_len_data, question_uuid_data)
+    if FLAGS.stream:
+        # read with the training vocabulary by stream_dev below
+        dataset = None
+    else:
+        # expand vocab and read the dev set in one pass
+        vocab, rev_vocab, embeddings, dataset = load_dev(dev_path, vocab, rev_vocab, embeddings, raw_embed_path,
+                                                         FLAGS.dev_cache_dir)
+        if squad_preprocess.token_cache is not None:
+            logging.info("Token cache hits/misses: {}/{}".format(squad_preprocess.token_cache.hits,
+                                                                 squad_preprocess.token_cache.misses))
 
     # ========= Model-specific =========
     # You must change the following code to adjust to your model
@@ -345,7 +389,33 @@ def main(_):
     with tf.Session() as sess:
         train_dir = get_normalized_train_dir(FLAGS.train_dir)
         initialize_model(sess, qa, train_dir)
-        answers = generate_answers(sess, qa, dataset, rev_vocab)
+        length_prior = [float(w) for w in FLAGS.length_prior.split(',')] if FLAGS.length_prior else None
+        if FLAGS.stream:
+            # the next chunk is read and tokenized while the model answers the current one
+            chunks = Prefetcher(stream_dev(dev_path, vocab, rev_vocab, FLAGS.stream_questions), depth=1)
+            num_answers = 0
+            with io.open(FLAGS.stream_output, 'w', encoding='utf-8') as f:
+                for dataset in chunks:
+                    answers = generate_answers(sess, qa, dataset, rev_vocab, FLAGS.window_size, FLAGS.window_stride,
+                                               top_k=FLAGS.top_k, length_prior=length_prior)
+                    answers, candidates = answers if FLAGS.top_k else (answers, None)
+                    for uuid in dataset[3]:
+                        line = {"id": uuid, "answer": answers[uuid]}
+                        if candidates is not None:
+                            line["candidates"] = candidates[uuid]
+                        f.write(unicode(json.dumps(line, ensure_ascii=False)) + u'\n')
+                    f.flush()
+                    num_answers += len(answers)
+            logging.info("Wrote {} answers to {}, waited {:.1f}s for input".format(num_answers, FLAGS.stream_output,
+                                                                                 chunks.wait_time))
+            return
+        if FLAGS.top_k:
+            answers, candidates = generate_answers(sess, qa, dataset, rev_vocab, FLAGS.window_size, FLAGS.window_stride,
+                                                   top_k=FLAGS.top_k, length_prior=length_prior)
+            with io.open(FLAGS.candidates_path, 'w', encoding='utf-8') as f:
+                f.write(unicode(json.dumps(candidates, ensure_ascii=False)))
+        else:
+            answers = generate_answers(sess, qa, dataset, rev_vocab, FLAGS.window_size, FLAGS.window_stride)
 
         # write to json file to root dir
         with io.open('dev-prediction.json', 'w', encoding='utf-8') as f:
@@ -7,6 +7,7 @@ import os
 import re
 import tarfile
 import argparse
+import multiprocessing
 
 from six.moves import urllib
 
@@ -15,6 +16,9 @@ from tqdm import *
 import numpy as np
 from os.path import join as pjoin
 
+from utils.data_reader import compile_data
+import utils.glove as glove_reader
+
 _PAD = b"<pad>"
 _SOS = b"<sos>"
 _UNK = b"<unk>"
@@ -36,6 +40,8 @@ def setup_args():
     parser.add_argument("--vocab_dir", default=vocab_dir)
     parser.add_argument("--glove_dim", default=100, type=int)
     parser.add_argument("--random_init", default=True, type=bool)
+    parser.add_argument("--num_workers", default=multiprocessing.cpu_count(), type=int,
+                        help="processes used to parse the GloVe file")
     return parser.parse_args()
 
 
@@ -65,57 +71,79 @@ def process_glove(args, vocab_list, save_path, size=4e5, random_init=True):
     :return:
     """
 
-    if not gfile.Exists(save_path + ".npz"):
+    if not gfile.Exists(save_path + ".emb"):
         glove_path = os.path.join(args.glove_dir, "glove.6B.{}d.txt".format(args.glove_dim))
-        if random_init:
-            glove = np.random.randn(len(vocab_list), args.glove_dim)
-        else:
-            glove = np.zeros((len(vocab_list), args.glove_dim))
+        glove = glove_reader.open_output(save_path + ".emb", (len(vocab_list), args.glove_dim))
+        # filled in blocks so that the float64 draws never cover the whole matrix
+        for start in range(0, len(vocab_list), 10000):
+            end = min(start + 10000, len(vocab_list))
+            if random_init:
+                glove[start:end] = np.random.randn(end - start, args.glove_dim)
+            else:
+                glove[start:end] = 0
         found = 0
 
         vocab_dict = dict(zip(vocab_list, range(len(vocab_list))))
 
-
-        with open(glove_path, 'r') as fh:
-            for line in tqdm(fh, total=size):
-                array = line.lstrip().rstrip().split(" ")
-                word = array[0]
-                vector = list(map(float, array[1:]))
-                if word in vocab_dict:
-                    idx = vocab_dict[word]
-                    glove[idx, :] = vector
-                    found += 1
-                if word.capitalize() in vocab_dict:
-                    idx = vocab_dict[word.capitalize()]
-                    glove[idx, :] = vector
-                    found += 1
-                if word.upper() in vocab_dict:
-                    idx = vocab_dict[word.upper()]
-                    glove[idx, :] = vector
-                    found += 1
+        with tqdm(total=size) as progress:
+            for words, vectors in glove_reader.iter_glove(glove_path, args.glove_dim, num_workers=args.num_workers):
+                for i, word in enumerate(words):
+                    if word in vocab_dict:
+                        idx = vocab_dict[word]
+                        glove[idx, :] = vectors[i]
+                        found += 1
+                    if word.capitalize() in vocab_dict:
+                        idx = vocab_dict[word.capitalize()]
+                        glove[idx, :] = vectors[i]
+                        found += 1
+                    if word.upper() in vocab_dict:
+                        idx = vocab_dict[word.upper()]
+                        glove[idx, :] = vectors[i]
+                        found += 1
+                progress.update(len(words))
 
         print("{}/{} of word vocab have corresponding vectors in {}".format(found, len(vocab_list), glove_path))
-        np.savez_compressed(save_path, glove=glove)
+        glove_reader.commit_output(glove, save_path + ".emb", glove_reader.vocab_checksum(vocab_list))
         print("saved trimmed glove matrix at: {}".format(save_path))
 
 
-def create_vocabulary(vocabulary_path, data_paths, tokenizer=None):
+def read_line_counts(index_path):
+    """Number of times each row is referenced by an index file such as train.context_index"""
+    counts = {}
+    with open(index_path, mode="rb") as f:
+        for line in f:
+            row = int(line)
+            counts[row] = counts.get(row, 0) + 1
+    return counts
+
+
+def create_vocabulary(vocabulary_path, data_paths, tokenizer=None, index_paths=None):
+    """
+    :param index_paths: optional {data_path: index_path}. Lines of data_path are
+        counted once per reference in index_path, so word frequencies of the
+        deduplicated context files match one context per question.
+    """
+    index_paths = index_paths or {}
     if not gfile.Exists(vocabulary_path):
         print("Creating vocabulary %s from data %s" % (vocabulary_path, str(data_paths)))
         vocab = {}
         for path in data_paths:
+            line_counts = read_line_counts(index_paths[path]) if path in index_paths else None
             with open(path, mode="rb") as f:
                 counter = 0
                 for line in f:
                     counter += 1
                     if counter % 100000 == 0:
                         print("processing line %d" % counter)
+                    weight = line_counts.get(counter - 1, 0) if line_counts is not None else 1
+                    if weight == 0:
+                        continue
                     tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
                     for w in tokens:
                         if w in vocab:
-                            vocab[w] += 1
+                            vocab[w] += weight
                         else:
-                            vocab[w] = 1
+                            vocab[w] = weight
         vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
         print("Vocabulary size: %d" % len(vocab_list))
         with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
@@ -161,7 +189,9 @@ if __name__ == '__main__':
                        pjoin(args.source_dir, "val.context"),
                        pjoin(args.source_dir, "val.question"),
                        #pjoin(args.source_dir, "dev-v1.1.json")
-                       ])
+                       ],
+                      index_paths={pjoin(args.source_dir, "train.context"): pjoin(args.source_dir, "train.context_index"),
+                                   pjoin(args.source_dir, "val.context"): pjoin(args.source_dir, "val.context_index")})
     vocab, rev_vocab = initialize_vocabulary(pjoin(args.vocab_dir, "vocab.dat"))
 
     # ======== Trim Distributed Word Representation =======
@@ -184,3 +214,9 @@ if __name__ == '__main__':
     y_ids_path = valid_path + ".ids.question"
     data_to_token_ids(valid_path + ".context", x_dis_path, vocab_path)
     data_to_token_ids(valid_path + ".question", y_ids_path, vocab_path)
+
+    # Binary, memory-mapped copies of the id files for utils.data_reader.read_data, which reads
+    # the _sorted training files written by data_preprocess/sort_data.py (compiled when present,
+    # otherwise on first read)
+    compile_data(args.source_dir, sorted_data=False)
+    compile_data(args.source_dir, sorted_data=True)
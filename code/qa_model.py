@@ -4,13 +4,17 @@ from __future__ import print_function
 
 import time, datetime
 import logging
+import json
+import os
 from tqdm import tqdm
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
-from operator import mul
 from tensorflow.python.ops import variable_scope as vs
-from utils.util import ConfusionMatrix, Progbar, minibatches, one_hot, minibatch, get_best_span
+from utils.util import ConfusionMatrix, Progbar, minibatches, one_hot, minibatch, get_best_spans, get_sentence_starts, \
+    get_top_spans, SENTENCE_END_ID, BucketSampler, PaddedBatches, pad_sequences, parse_boundaries, QADataset, merge_window_spans
+from utils.data_reader import DataStream
+from utils.prefetch import Prefetcher
 
 from evaluate import exact_match_score, f1_score
 
@@ -64,6 +68,34 @@ def softmax_mask_prepro(tensor, mask): # set huge neg number(-1e10) in padding a
     tensor = tf.select(mask, tensor, paddings)
     return tensor
 
+def best_spans_in_graph(start_logits, end_logits, mask, sentence, max_answer_len=None):
+    """
+    get_best_spans as graph ops. Only the [N, JX, L] band of spans is scored,
+    L = min(JX, max_answer_len): band[n, j, k] is the span (j - L + 1 + k, j),
+    laid out end first with growing starts so that argmax breaks ties as
+    get_best_spans.
+    :param mask: [N, JX] bool, the tokens in the context
+    :param sentence: [N, JX] sentence number of every token
+    :param max_answer_len: at most this many tokens per span, None for no limit
+    :return: [N, 2] spans, [N] scores; rows of length 0 give (0, 0)
+    """
+    JX = tf.shape(start_logits)[1]
+    L = tf.minimum(JX, max_answer_len) if max_answer_len else JX
+    starts = tf.expand_dims(tf.range(JX), 1) + tf.expand_dims(tf.range(L), 0) - L + 1 # [JX, L]
+    in_band = tf.greater_equal(starts, 0)
+    starts = tf.maximum(starts, 0)
+    def at_starts(x): # [N, JX] -> [N, JX, L]
+        return tf.transpose(tf.gather(tf.transpose(x), starts), [2, 0, 1])
+    # the mask is a prefix, so the end being in the context is enough
+    valid = tf.logical_and(tf.expand_dims(in_band, 0), tf.expand_dims(mask, 2))
+    valid = tf.logical_and(valid, tf.equal(at_starts(sentence), tf.expand_dims(sentence, 2)))
+    scores = softmax_mask_prepro(at_starts(start_logits) + tf.expand_dims(end_logits, 2), valid)
+    scores = tf.reshape(scores, [-1, JX * L])
+    best = tf.cast(tf.argmax(scores, 1), 'int32')
+    ends = best // L
+    spans = tf.stack([tf.maximum(ends - L + 1 + best % L, 0), ends], axis=1)
+    return spans, tf.reduce_max(scores, 1)
+
 class Attention(object):
     def __init__(self):
         pass
@@ -90,95 +122,64 @@ class Attention(object):
         # h [None, JX, d_en]
         # u [None, JQ, d_en]
 
-        # get similarity
-        h_aug = tf.tile(tf.reshape(h, shape = [-1, JX, 1, d_en]),[1, 1, JQ, 1])
-        u_aug = tf.tile(tf.reshape(u, shape = [-1, 1, JQ, d_en]),[1, JX, 1, 1])
-        h_mask_aug = tf.tile(tf.expand_dims(h_mask, -1), [1, 1, JQ]) # [N, JX] -(expend)-> [N, JX, 1] -(tile)-> [N, JX, JQ]
-        u_mask_aug = tf.tile(tf.expand_dims(u_mask, -2), [1, JX, 1]) # [N, JQ] -(expend)-> [N, 1, JQ] -(tile)-> [N, JX, JQ]
-        # s = tf.reduce_sum(tf.multiply(h_aug, u_aug), axis = -1) # h * u: [N, JX, d_en] * [N, JQ, d_en] -> [N, JX, JQ]
-        s = self.get_logits([h_aug, u_aug], None, True, is_train=(dropout<1.0), func='tri_linear', input_keep_prob=dropout)  # [N, M, JX, JQ]
-        hu_mask_aug = h_mask_aug & u_mask_aug
-        s = softmax_mask_prepro(s, hu_mask_aug)
+        # get similarity, without building [N, JX, JQ, d_en] tensors
+        s = self.get_logits(h, u, is_train=(dropout<1.0), input_keep_prob=dropout)  # [N, JX, JQ]
+        hu_mask = tf.logical_and(tf.expand_dims(h_mask, -1), tf.expand_dims(u_mask, -2)) # [N, JX, 1] & [N, 1, JQ] -> [N, JX, JQ]
+        s = softmax_mask_prepro(s, hu_mask)
 
         # get a_x
         a_x = tf.nn.softmax(s, dim=-1) # softmax -> [N, JX, softmax(JQ)]
 
         #     use a_x to get u_a
-        a_x = tf.reshape(a_x, shape = [-1, JX, JQ, 1])
-        u_aug = tf.reshape(u, shape = [-1, 1, JQ, d_en])
-        u_a = tf.reduce_sum(tf.multiply(a_x, u_aug), axis = -2)# a_x * u: [N, JX, JQ](weight) * [N, JQ, d_en] -> [N, JX, d_en]
+        u_a = tf.batch_matmul(a_x, u) # a_x * u: [N, JX, JQ](weight) * [N, JQ, d_en] -> [N, JX, d_en]
         logging.debug('Context with attention: %s' % str(u_a))
 
         # get a_q
         a_q = tf.reduce_max(s, axis=-1) # max -> [N, JX]
         a_q = tf.nn.softmax(a_q, dim=-1) # softmax -> [N, softmax(JX)]
         #     use a_q to get h_a
-        a_q = tf.reshape(a_q, shape = [-1, JX, 1])
-        h_aug = tf.reshape(h, shape = [-1, JX, d_en])
+        a_q = tf.expand_dims(a_q, -1) # [N, JX, 1]
 
-        h_a = tf.reduce_sum(tf.multiply(a_q, h_aug), axis = -2)# a_q * h: [N, JX](weight) * [N, JX, d_en] -> [N, d_en]
+        h_a = tf.reduce_sum(tf.multiply(a_q, h), axis = -2)# a_q * h: [N, JX](weight) * [N, JX, d_en] -> [N, d_en]
         assert h_a.get_shape().as_list() == [None, d_en]
-        h_a = tf.tile(tf.expand_dims(h_a, -2), [1, JX, 1]) # [None, JX, d_en]
+        h_a = tf.expand_dims(h_a, -2) # [None, 1, d_en], broadcast over JX
 
         h_0_u_a = h*u_a #[None, JX, d_en]
         h_0_h_a = h*h_a #[None, JX, d_en]
         return tf.concat(2,[h, u_a, h_0_u_a, h_0_h_a])
 
-    # this function is from https://github.com/allenai/bi-att-flow/tree/master/my/tensorflow
-    def get_logits(args, size, bias, bias_start=0.0, scope=None, mask=None, wd=0.0, input_keep_prob=1.0, is_train=None, func=None):
-
-        def linear_logits(args, bias, bias_start=0.0, scope=None, mask=None, wd=0.0, input_keep_prob=1.0, is_train=None):
-
-            def linear(args, output_size, bias, bias_start=0.0, scope=None, squeeze=False, wd=0.0, input_keep_prob=1.0,
-                       is_train=None):
-                if args is None or (nest.is_sequence(args) and not args):
-                    raise ValueError("`args` must be specified")
-                if not nest.is_sequence(args):
-                    args = [args]
-
-                def flatten(tensor, keep):
-                    fixed_shape = tensor.get_shape().as_list()
-                    start = len(fixed_shape) - keep
-                    left = reduce(mul, [fixed_shape[i] or tf.shape(tensor)[i] for i in range(start)])
-                    out_shape = [left] + [fixed_shape[i] or tf.shape(tensor)[i] for i in range(start, len(fixed_shape))]
-                    flat = tf.reshape(tensor, out_shape)
-                    return flat
-
-                flat_args = [flatten(arg, 1) for arg in args]
-                #if input_keep_prob < 1.0:
-                #   assert is_train is not None
-                flat_args = [tf.cond(is_train, lambda: tf.nn.dropout(arg, input_keep_prob), lambda: arg)
-                                 for arg in flat_args]
-                flat_out = _linear(flat_args, output_size, bias, bias_start=bias_start, scope=scope)
-                
-                def reconstruct(tensor, ref, keep):
-                    ref_shape = ref.get_shape().as_list()
-                    tensor_shape = tensor.get_shape().as_list()
-                    ref_stop = len(ref_shape) - keep
-                    tensor_start = len(tensor_shape) - keep
-                    pre_shape = [ref_shape[i] or tf.shape(ref)[i] for i in range(ref_stop)]
-                    keep_shape = [tensor_shape[i] or tf.shape(tensor)[i] for i in range(tensor_start, len(tensor_shape))]
-                    # pre_shape = [tf.shape(ref)[i] for i in range(len(ref.get_shape().as_list()[:-keep]))]
-                    # keep_shape = tensor.get_shape().as_list()[-keep:]
-                    target_shape = pre_shape + keep_shape
-                    out = tf.reshape(tensor, target_shape)
-                    return out
-
-                out = reconstruct(flat_out, args[0], 1)
-                if squeeze:
-                    out = tf.squeeze(out, [len(args[0].get_shape().as_list())-1])
-
-                return out
-
-            with tf.variable_scope(scope or "Linear_Logits"):
-                logits = linear(args, 1, bias, bias_start=bias_start, squeeze=True, scope='first',
-                                wd=wd, input_keep_prob=input_keep_prob, is_train=is_train)
-                return logits
-
-        assert len(args) == 2
-        new_arg = args[0] * args[1]
-        return linear_logits([args[0], args[1], new_arg], bias, bias_start=bias_start, scope=scope, mask=mask, wd=wd, input_keep_prob=input_keep_prob,
-                             is_train=is_train)
+    def get_logits(self, h, u, bias_start=0.0, scope=None, input_keep_prob=1.0, is_train=None):
+        """
+        Tri-linear logits of bi-att-flow (https://github.com/allenai/bi-att-flow),
+        s[n, x, q] = w . [h[n, x]; u[n, q]; h[n, x] * u[n, q]] + b.
+        w is split into w_h, w_u and w_hu, so that s is the sum of the two
+        projections h w_h [N, JX, 1] and u w_u [N, 1, JQ] and of the batched
+        matmul (h * w_hu) u^T [N, JX, JQ]. The variables are those of a
+        linear layer over the concatenation [3 * d_en, 1], as before.
+
+        :param h: [N, JX, d_en]
+        :param u: [N, JQ, d_en]
+        :return: [N, JX, JQ]
+        """
+        d_en = h.get_shape().as_list()[-1]
+        with tf.variable_scope(scope or "Linear_Logits"):
+            with tf.variable_scope("first"):
+                matrix = tf.get_variable("Matrix", [3 * d_en, 1])
+                bias = tf.get_variable("Bias", [1], initializer=tf.constant_initializer(bias_start))
+        w_h, w_u, w_hu = tf.split(0, 3, matrix) # [d_en, 1] each
+
+        if isinstance(is_train, bool):
+            if is_train:
+                h, u = tf.nn.dropout(h, input_keep_prob), tf.nn.dropout(u, input_keep_prob)
+        elif is_train is not None:
+            h = tf.cond(is_train, lambda: tf.nn.dropout(h, input_keep_prob), lambda: h)
+            u = tf.cond(is_train, lambda: tf.nn.dropout(u, input_keep_prob), lambda: u)
+
+        N, JX, JQ = tf.shape(h)[0], tf.shape(h)[1], tf.shape(u)[1]
+        h_logits = tf.reshape(tf.matmul(tf.reshape(h, [-1, d_en]), w_h), [N, JX, 1])
+        u_logits = tf.reshape(tf.matmul(tf.reshape(u, [-1, d_en]), w_u), [N, 1, JQ])
+        hu_logits = tf.batch_matmul(h * tf.reshape(w_hu, [d_en]), u, adj_y=True)
+        return hu_logits + h_logits + u_logits + bias
 
 class Encoder(object):
     def __init__(self, vocab_dim, state_size, dropout = 0):
@@ -351,6 +352,35 @@ class Decoder(object):
         pred2 = tf.matmul(pred2_1, W_se)+b_se
         return pred1, pred2
 
+def _rng_state_to_json(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)]
+
+def _rng_state_from_json(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian
+
+def write_training_state(checkpoint_path, state):
+    """Stores the bookkeeping of QASystem.train next to a checkpoint"""
+    with open(checkpoint_path + '.state.json.part', 'w') as f:
+        json.dump(state, f)
+    os.rename(checkpoint_path + '.state.json.part', checkpoint_path + '.state.json')
+
+def read_training_state(checkpoint_path):
+    """:return: the state written with the checkpoint, None for checkpoints without one"""
+    if not os.path.exists(checkpoint_path + '.state.json'):
+        return None
+    with open(checkpoint_path + '.state.json') as f:
+        return json.load(f)
+
+def unpack_batch(batch):
+    """
+    :param batch: [questions, question lengths, contexts, context lengths,
+                  spans] with an optional sixth field, the context index
+    :return: the six fields, context index None when missing
+    """
+    return tuple(batch[:5]) + ((batch[5] if len(batch) > 5 else None),)
+
 class QASystem(object):
     def __init__(self, pretrained_embeddings, config):
         """
@@ -368,15 +398,21 @@ class QASystem(object):
 
         # ==== set up placeholder tokens ====
         self.question_placeholder = tf.placeholder(dtype=tf.int32, name="q", shape=(None, None))
-        self.question_mask_placeholder = tf.placeholder(dtype=tf.bool, name="q_mask", shape=(None, None))
+        self.question_len_placeholder = tf.placeholder(dtype=tf.int32, name="q_len", shape=(None,))
+        # contexts are fed once per paragraph, c_index gives the row of every question's context
         self.context_placeholder = tf.placeholder(dtype=tf.int32, name="c", shape=(None, None))
-        self.context_mask_placeholder = tf.placeholder(dtype=tf.bool, name="c_mask", shape=(None, None))
+        self.context_len_placeholder = tf.placeholder(dtype=tf.int32, name="c_len", shape=(None,))
+        self.context_index_placeholder = tf.placeholder(dtype=tf.int32, name="c_index", shape=(None,))
         # self.answer_placeholders = tf.placeholder(dtype=tf.int32, name="a", shape=(None, config.answer_size))
         self.answer_start_placeholders = tf.placeholder(dtype=tf.int32, name="a_s", shape=(None,))
         self.answer_end_placeholders = tf.placeholder(dtype=tf.int32, name="a_e", shape=(None,))
         self.dropout_placeholder = tf.placeholder(dtype=tf.float32, name="dropout", shape=())
-        self.JX = tf.placeholder(dtype=tf.int32, name='JX', shape=())
-        self.JQ = tf.placeholder(dtype=tf.int32, name='JQ', shape=())
+        # padded lengths and masks follow from the fed matrices and lengths
+        self.JX = tf.shape(self.context_placeholder)[1]
+        self.JQ = tf.shape(self.question_placeholder)[1]
+        self.question_mask = tf.sequence_mask(self.question_len_placeholder, self.JQ)
+        self.paragraph_mask = tf.sequence_mask(self.context_len_placeholder, self.JX)
+        self.context_mask = tf.gather(self.paragraph_mask, self.context_index_placeholder)
 
 
         # ==== assemble pieces ====
@@ -384,6 +420,8 @@ class QASystem(object):
             self.q, self.x = self.setup_embeddings()
             self.preds = self.setup_system(self.x, self.q)
             self.loss = self.setup_loss(self.preds)
+            if config.span_in_graph:
+                self.best_spans, self.best_span_scores = self.setup_span_decoder(self.preds)
 
         # ==== set up training/updating procedure ====
         # No gradient clipping:
@@ -416,18 +454,20 @@ class QASystem(object):
         # Step 1: encode x and q, respectively, with independent weights
         #         e.g. u = encode_question(q)  # get U (2d*J) as representation of q
         #         e.g. h = encode_context(x, u_state)   # get H (2d*T) as representation of x
+        #         x holds each paragraph once, h is gathered for the questions afterwards
         with tf.variable_scope('q'):
             u, question_repr, u_state = \
-                 self.encoder.encode(inputs=q, mask=self.question_mask_placeholder, encoder_state_input=None, dropout = self.dropout_placeholder)
+                 self.encoder.encode(inputs=q, mask=self.question_mask, encoder_state_input=None, dropout = self.dropout_placeholder)
             if self.config.QA_ENCODER_SHARE:
                 tf.get_variable_scope().reuse_variables()
                 h, context_repr, context_state =\
-                     self.encoder.encode(inputs=x, mask=self.context_mask_placeholder, encoder_state_input=None, dropout = self.dropout_placeholder)
+                     self.encoder.encode(inputs=x, mask=self.paragraph_mask, encoder_state_input=None, dropout = self.dropout_placeholder)
         if not self.config.QA_ENCODER_SHARE:
             with tf.variable_scope('c'):
                 h, context_repr, context_state =\
-                     self.encoder.encode(inputs=x, mask=self.context_mask_placeholder, encoder_state_input=None, dropout = self.dropout_placeholder)
-                 # self.encoder.encode(inputs=x, mask=self.context_mask_placeholder, encoder_state_input=None)
+                     self.encoder.encode(inputs=x, mask=self.paragraph_mask, encoder_state_input=None, dropout = self.dropout_placeholder)
+                 # self.encoder.encode(inputs=x, mask=self.context_mask, encoder_state_input=None)
+        h = tf.gather(h, self.context_index_placeholder) # [N_paragraphs, JX, d_en] -> [N, JX, d_en]
         d_en = self.config.encoder_state_size*2
         assert h.get_shape().as_list() == [None, None, d_en], "Expected {}, got {}".format([None, JX, d_en], h.get_shape().as_list())
         assert u.get_shape().as_list() == [None, None, d_en], "Expected {}, got {}".format([None, JQ, d_en], u.get_shape().as_list())
@@ -441,14 +481,14 @@ class QASystem(object):
         #              h_hat = sum(a_q*h)
         #              g = combine(u, h, u_hat, h_hat)
         # --------op1--------------
-        g = self.attention.calculate(h, u, self.context_mask_placeholder, self.question_mask_placeholder, JX = self.JX, JQ = self.JQ, dropout = self.dropout_placeholder) # concat[h, u_a, h*u_a, h*h_a]
+        g = self.attention.calculate(h, u, self.context_mask, self.question_mask, JX = self.JX, JQ = self.JQ, dropout = self.dropout_placeholder) # concat[h, u_a, h*u_a, h*h_a]
         d_com = d_en*4
         assert g.get_shape().as_list() == [None, None, d_com], "Expected {}, got {}".format([None, JX, d_com], g.get_shape().as_list())
 
         # Step 3:
         # 2 LSTM layers
         # logistic regressions
-        pred1, pred2 = self.decoder.decode(g, self.context_mask_placeholder, dropout = self.dropout_placeholder, JX = self.JX)
+        pred1, pred2 = self.decoder.decode(g, self.context_mask, dropout = self.dropout_placeholder, JX = self.JX)
         return pred1, pred2
 
     def setup_loss(self, preds):
@@ -464,12 +504,32 @@ class QASystem(object):
         tf.summary.scalar('loss', loss)
         return loss
 
+    def setup_span_decoder(self, preds):
+        """
+        get_best_spans inside the graph, so that only the spans are fetched:
+        the best start + end over all pairs in the context and in one sentence,
+        start <= end < start + config.max_answer_len, the smallest end and then
+        the smallest start on ties.
+        :return: [N, 2] spans, [N] scores
+        """
+        with vs.variable_scope("span"):
+            s, e = preds # [None, JX]*2
+            # sentence of every token: the number of sentence ends before it
+            sentence = tf.cumsum(tf.cast(tf.equal(self.context_placeholder, SENTENCE_END_ID), 'int32'), axis=1, exclusive=True)
+            sentence = tf.gather(sentence, self.context_index_placeholder) # [N, JX]
+            return best_spans_in_graph(s, e, self.context_mask, sentence, self.config.max_answer_len or None)
+
     def setup_embeddings(self):
         with vs.variable_scope("embeddings"):
-            if self.config.RE_TRAIN_EMBED:
-                pretrained_embeddings = tf.Variable(self.pretrained_embeddings, name="Emb", dtype=tf.float32)
-            else:
-                pretrained_embeddings = tf.cast(self.pretrained_embeddings, tf.float32)
+            # the matrix is fed once by load_embeddings instead of being a graph
+            # constant; kept out of checkpoints unless it is trained
+            shape = self.pretrained_embeddings.shape
+            self.embeddings_placeholder = tf.placeholder(tf.float32, shape=shape, name="pretrained")
+            pretrained_embeddings = tf.get_variable(
+                "Emb", shape=shape, dtype=tf.float32, initializer=tf.constant_initializer(0.),
+                trainable=bool(self.config.RE_TRAIN_EMBED),
+                collections=[tf.GraphKeys.GLOBAL_VARIABLES] if self.config.RE_TRAIN_EMBED else [tf.GraphKeys.LOCAL_VARIABLES])
+            self.embeddings_init = pretrained_embeddings.assign(self.embeddings_placeholder)
 
             question_embeddings = tf.nn.embedding_lookup(pretrained_embeddings, self.question_placeholder)
             question_embeddings = tf.reshape(question_embeddings, shape = [-1, self.JQ, self.config.embedding_size])
@@ -479,40 +539,47 @@ class QASystem(object):
 
         return question_embeddings, context_embeddings
 
-    def create_feed_dict(self, question_batch, question_len_batch, context_batch, context_len_batch, JX=10, JQ=10, answer_batch=None, is_train = True):
+    def load_embeddings(self, session):
+        """Copies the pretrained embeddings into the embedding variable"""
+        session.run(self.embeddings_init, {self.embeddings_placeholder: self.pretrained_embeddings})
+
+    def create_feed_dict(self, question_batch, question_len_batch, context_batch, context_len_batch, JX=10, JQ=10, answer_batch=None, is_train = True,
+                         context_index=None):
+        """
+        :param context_index: row of context_batch of every question, None
+                              when context_batch has a row per question
+        """
         feed_dict = {}
         JQ = np.max(question_len_batch)
         JX = np.max(context_len_batch)
         # print('This batch len: JX = %d, JQ = %d', JX, JQ)
-        def add_paddings(sentence, max_length):
-            mask = [True] * len(sentence)
-            pad_len = max_length - len(sentence)
-            if pad_len > 0:
-                padded_sentence = sentence + [0] * pad_len
-                mask += [False] * pad_len
-            else:
-                padded_sentence = sentence[:max_length]
-                mask = mask[:max_length]
-            return padded_sentence, mask
-
-        def padding_batch(data, max_len):
-            padded_data = []
-            padded_mask = []
-            for sentence in data:
-                d, m = add_paddings(sentence, max_len)
-                padded_data.append(d)
-                padded_mask.append(m)
-            return (padded_data, padded_mask)
-
-        question, question_mask = padding_batch(question_batch, JQ)
-        context, context_mask = padding_batch(context_batch, JX)
+        if isinstance(question_batch, np.ndarray) and question_batch.ndim == 2:
+            # already padded, e.g. by PaddedBatches
+            question = question_batch[:, :JQ]
+        else:
+            question, _ = pad_sequences(question_batch, JQ)
+        if isinstance(context_batch, np.ndarray) and context_batch.ndim == 2:
+            context = context_batch[:, :JX]
+            if context_index is None:
+                context_index = np.arange(len(context), dtype=np.int32)
+        else:
+            unique_contexts = context_batch
+            if context_index is None:
+                # questions on the same paragraph share one context object: feed it once
+                context_rows = {}
+                context_index = [context_rows.setdefault(id(c), len(context_rows)) for c in context_batch]
+                unique_contexts = [None] * len(context_rows)
+                for c, row in zip(context_batch, context_index):
+                    unique_contexts[row] = c
+            context, _ = pad_sequences(unique_contexts, JX)
+        context_len = np.zeros(len(context), dtype=np.int32)
+        context_len[context_index] = context_len_batch
 
         feed_dict[self.question_placeholder] = question
-        feed_dict[self.question_mask_placeholder] = question_mask
+        feed_dict[self.question_len_placeholder] = question_len_batch
         feed_dict[self.context_placeholder] = context
-        feed_dict[self.context_mask_placeholder] = context_mask
-        feed_dict[self.JQ] = JQ
-        feed_dict[self.JX] = JX
+        feed_dict[self.context_len_placeholder] = context_len
+        feed_dict[self.context_index_placeholder] = context_index
 
         if answer_batch is not None:
             start = answer_batch[:,0]
@@ -532,8 +599,9 @@ class QASystem(object):
         This method is equivalent to a step() function
         :return:
         """
-        question_batch, question_len_batch, context_batch, context_len_batch, answer_batch = training_set
-        input_feed = self.create_feed_dict(question_batch, question_len_batch, context_batch, context_len_batch, answer_batch=answer_batch, is_train = True)
+        question_batch, question_len_batch, context_batch, context_len_batch, answer_batch, context_index = unpack_batch(training_set)
+        input_feed = self.create_feed_dict(question_batch, question_len_batch, context_batch, context_len_batch, answer_batch=answer_batch, is_train = True,
+                                           context_index=context_index)
 
         output_feed = [self.train_op, self.merged, self.loss]
 
@@ -546,52 +614,108 @@ class QASystem(object):
         and tune your hyperparameters according to the validation set performance
         :return:
         """
-        question_batch, question_len_batch, context_batch, context_len_batch, answer_batch = validation_set
-        input_feed = self.create_feed_dict(question_batch, question_len_batch, context_batch, context_len_batch, answer_batch=answer_batch, is_train = False)
+        question_batch, question_len_batch, context_batch, context_len_batch, answer_batch, context_index = unpack_batch(validation_set)
+        input_feed = self.create_feed_dict(question_batch, question_len_batch, context_batch, context_len_batch, answer_batch=answer_batch, is_train = False,
+                                           context_index=context_index)
 
         output_feed = [self.loss]
         outputs = session.run(output_feed, input_feed)
         return outputs
 
-    def answer(self, session, test_batch):
+    def answer(self, session, test_batch, with_scores=False, top_k=0, length_prior=None):
         """
         Returns the probability distribution over different positions in the paragraph
         so that other methods like self.answer() will be able to work properly
+        :param with_scores: also return the scores of the spans (see get_best_spans)
+        :param top_k: when set, the top_k best non-overlapping spans of every
+                      question and their probabilities (see get_top_spans)
         :return:
         """
 
         # fill in this feed_dictionary like:
         # input_feed['test_x'] = test_x
 
-        question_batch, question_len_batch, context_batch, context_len_batch, answer_batch = test_batch
-        input_feed =  self.create_feed_dict(question_batch, question_len_batch, context_batch, context_len_batch, answer_batch=None, is_train = False)
+        question_batch, question_len_batch, context_batch, context_len_batch, answer_batch, context_index = unpack_batch(test_batch)
+        input_feed =  self.create_feed_dict(question_batch, question_len_batch, context_batch, context_len_batch, answer_batch=None, is_train = False,
+                                            context_index=context_index)
+        if self.config.span_in_graph and not top_k:
+            best_spans, scores = session.run([self.best_spans, self.best_span_scores], input_feed)
+            best_spans = [tuple(span) for span in best_spans.tolist()]
+            if with_scores:
+                return best_spans, scores
+            return best_spans
+
         output_feed = [self.preds[0], self.preds[1]]
         outputs = session.run(output_feed, input_feed)
 
         s, e = outputs
-
-        best_spans, scores = zip(*[get_best_span(si, ei, ci) for si, ei, ci in zip(s, e, context_batch)])
+        if not (isinstance(context_batch, np.ndarray) and context_batch.ndim == 2):
+            context_batch, _ = pad_sequences(context_batch, s.shape[1])
+        sentence_starts = get_sentence_starts(context_batch[:, :s.shape[1]])
+        if context_index is not None:
+            sentence_starts = sentence_starts[context_index]
+
+        if top_k:
+            best_spans, scores = get_top_spans(s, e, context_len_batch, top_k, self.config.max_answer_len or None,
+                                               sentence_starts, length_prior)
+        else:
+            best_spans, scores = get_best_spans(s, e, context_len_batch, sentence_starts,
+                                                max_answer_len=self.config.max_answer_len or None)
+            best_spans = [tuple(span) for span in best_spans.tolist()]
+        if with_scores:
+            return best_spans, scores
         return best_spans
 
-    def predict_on_batch(self, session, dataset):
-        batch_num = int(np.ceil(len(dataset) * 1.0 / self.config.batch_size))
-        # prog = Progbar(target=batch_num)
-        predicts = []
-        for i, batch in tqdm(enumerate(minibatches(dataset, self.config.batch_size, shuffle=False))):
-            pred = self.answer(session, batch)
-            # prog.update(i + 1)
-            predicts.extend(pred)
-        return predicts
+    def batch_sampler(self, dataset, shuffle=True, **kwargs):
+        """BucketSampler over an in-memory dataset, packing up to config.max_batch_tokens when set"""
+        if isinstance(dataset, QADataset):
+            context_lengths, question_lengths = dataset.context_lengths, dataset.question_lengths
+            # questions on one paragraph in the same batches share its encoding
+            if not shuffle or self.config.group_by_context:
+                kwargs.setdefault('groups', dataset.context_index)
+        else:
+            context_lengths, question_lengths = [x[3] for x in dataset], [x[1] for x in dataset]
+        return BucketSampler(context_lengths, question_lengths, self.config.batch_size,
+                             shuffle=shuffle, max_tokens=self.config.max_batch_tokens or None,
+                             max_question_tokens=self.config.max_question_tokens or None, **kwargs)
 
-    def predict_on_batch(self, session, dataset):
+    def predict_on_batch(self, session, dataset, with_scores=False, top_k=0, length_prior=None):
+        """
+        :param with_scores: return (spans, scores) instead of the spans
+        :param top_k: predict lists of top_k spans, see answer
+        """
         batch_num = int(np.ceil(len(dataset) * 1.0 / self.config.batch_size))
         # prog = Progbar(target=batch_num)
+        if self.config.max_batch_tokens:
+            # length sorted batches, predictions are put back in dataset order
+            plan = list(self.batch_sampler(dataset, shuffle=False))
+            predicts = [None] * len(dataset)
+            scores = [None] * len(dataset)
+            for indices, batch in tqdm(zip(plan, minibatches(dataset, self.config.batch_size, sampler=plan))):
+                answers = self.answer(session, batch, with_scores=True, top_k=top_k, length_prior=length_prior)
+                for j, pred, score in zip(indices, *answers):
+                    predicts[j] = pred
+                    scores[j] = score
+            return (predicts, scores) if with_scores else predicts
         predicts = []
+        scores = []
         for i, batch in tqdm(enumerate(minibatches(dataset, self.config.batch_size, shuffle=False))):
-            pred = self.answer(session, batch)
+            pred, score = self.answer(session, batch, with_scores=True, top_k=top_k, length_prior=length_prior)
             # prog.update(i + 1)
             predicts.extend(pred)
-        return predicts
+            scores.extend(score)
+        return (predicts, scores) if with_scores else predicts
+
+    def predict_on_windows(self, session, dataset, window, stride):
+        """
+        Predicts on windows of window context tokens taken every stride
+        tokens, so that batches stay bounded however long the contexts are,
+        and merges the spans with merge_window_spans.
+        """
+        chunks, example_of, window_start = dataset.chunk(window, stride)
+        logging.info("Predicting on %d windows of %d questions", len(chunks), len(dataset))
+        predicts, scores = self.predict_on_batch(session, chunks, with_scores=True)
+        return merge_window_spans(predicts, scores, example_of, window_start, len(dataset))
 
     def validate(self, sess, valid_dataset):
         """
@@ -606,13 +730,22 @@ class QASystem(object):
         :return:
         """
         batch_num = int(np.ceil(len(valid_dataset) * 1.0 / self.config.batch_size))
+        if isinstance(valid_dataset, DataStream):
+            batches = valid_dataset
+        elif self.config.max_batch_tokens:
+            if getattr(self, 'valid_batches', None) is None or self.valid_batches.data is not valid_dataset:
+                self.valid_batches = PaddedBatches(valid_dataset, self.batch_sampler(valid_dataset, shuffle=False))
+            batches = self.valid_batches
+            batch_num = len(batches)
+        else:
+            batches = minibatches(valid_dataset, self.config.batch_size)
         prog = Progbar(target=batch_num)
         avg_loss = 0
-        for i, batch in enumerate(minibatches(valid_dataset, self.config.batch_size)):
+        for i, batch in enumerate(batches):
             loss = self.test(sess, batch)[0]
             prog.update(i + 1, [("validation loss", loss)])
             avg_loss += loss
-        avg_loss /= batch_num
+        avg_loss /= (i + 1)
         logging.info("Average validation loss: {}".format(avg_loss))
         return avg_loss
 
@@ -620,9 +753,14 @@ class QASystem(object):
         f1 = 0.
         em = 0.
 
-        N = len(dataset)
-        sampleIndices = np.random.choice(N, sample, replace=False)
-        evaluate_set = [dataset[i] for i in sampleIndices]
+        if isinstance(dataset, DataStream):
+            evaluate_set = dataset.take(sample)
+            sample = len(evaluate_set)
+        else:
+            N = len(dataset)
+            sampleIndices = np.random.choice(N, sample, replace=False)
+            evaluate_set = dataset[sampleIndices] if isinstance(dataset, QADataset) else \
+                [dataset[i] for i in sampleIndices]
         predicts = self.predict_on_batch(session, evaluate_set)
 
         for example, (start, end) in zip(evaluate_set, predicts):
@@ -647,17 +785,64 @@ class QASystem(object):
 
         return f1, em
 
-    def run_epoch(self, session, epoch_num, training_set, vocab, validation_set, sample_size=400):
+    def save_checkpoint(self, session, saver, path, global_step=None):
+        """Saves the variables and, next to them, self.training_state with the NumPy RNG state"""
+        path = saver.save(session, path, global_step=global_step)
+        state = dict(self.training_state, rng_state=_rng_state_to_json(np.random.get_state()))
+        write_training_state(path, state)
+        return path
+
+    def run_epoch(self, session, epoch_num, training_set, vocab, validation_set, sample_size=400, train_dir=None):
+        """
+        Trains from batch self.training_state['batch'] of the epoch on,
+        saving a checkpoint in train_dir every config.checkpoint_every steps.
+        """
         set_num = len(training_set)
         batch_size = self.config.batch_size
         batch_num = int(np.ceil(set_num * 1.0 / batch_size))
         sample_size = 400
+        state = self.training_state
+        start = state['batch']
+        if start == 0:
+            # the epoch's batches are drawn from this state, a resumed run draws them again
+            state['epoch_rng_state'] = _rng_state_to_json(np.random.get_state())
+        else:
+            logging.info("Resuming the epoch at batch %d", start)
+
+        sampler = None
+        if isinstance(training_set, DataStream):
+            # streamed from disk; buckets may add a few partial batches to batch_num
+            if start == 0:
+                # the stream shuffles from its own RNG, whose state goes into the checkpoints
+                state['epoch_seed'] = training_set.next_seed()
+                state['stream_rng_state'] = _rng_state_to_json(training_set.rng.get_state())
+            # finished batches are read again, but not built nor trained on
+            batches = training_set.epoch(state['epoch_seed'], start)
+        else:
+            if getattr(self, 'train_batches', None) is None or self.train_batches.data is not training_set:
+                sampler = self.batch_sampler(training_set,
+                                             context_boundaries=parse_boundaries(self.config.context_buckets),
+                                             question_boundaries=parse_boundaries(self.config.question_buckets),
+                                             num_buckets=self.config.num_buckets)
+                self.train_batches = PaddedBatches(training_set, sampler)
+            batches = self.train_batches
+            sampler = batches.sampler
+            sampler.reset_stats()
+            if start:
+                sampler.resume(start, _rng_state_from_json(state['epoch_rng_state']))
+            batch_num = len(batches)
+        if self.config.prefetch:
+            batches = Prefetcher(batches, depth=self.config.prefetch, mode=self.config.prefetch_mode,
+                                 num_workers=self.config.prefetch_workers)
 
         prog = Progbar(target=batch_num)
         avg_loss = 0
-        for i, batch in enumerate(minibatches(training_set, self.config.batch_size, window_batch = self.config.window_batch)):
-            global_batch_num = batch_num * epoch_num + i
+        steps = 0
+        for i, batch in enumerate(batches, start):
+            global_batch_num = state['global_step']
             _, summary, loss = self.optimize(session, batch)
+            state['global_step'] += 1
+            state['batch'] = i + 1
             prog.update(i + 1, [("training loss", loss)])
             if self.config.tensorboard and global_batch_num % self.config.log_batch_num == 0:
                 self.train_writer.add_summary(summary, global_batch_num)
@@ -665,13 +850,36 @@ class QASystem(object):
                 logging.info('')
                 self.evaluate_answer(session, training_set, vocab, sample=sample_size, log=True)
                 self.evaluate_answer(session, validation_set, vocab, sample=sample_size, log=True)
+            if train_dir and self.config.checkpoint_every and state['global_step'] % self.config.checkpoint_every == 0:
+                self.save_step_checkpoint(session, train_dir)
             avg_loss += loss
-        avg_loss /= batch_num
+            steps += 1
+        avg_loss /= max(steps, 1)
         logging.info("Average training loss: {}".format(avg_loss))
+        if sampler is not None:
+            logging.info("Padding: {:.1%} of context tokens, {:.1%} of question tokens".format(*sampler.padding_fraction()))
+        if self.config.prefetch:
+            logging.info("Input pipeline: waited for {} of {} batches, {:.1f}s in total".format(
+                batches.starved, batches.batches, batches.wait_time))
         return avg_loss
 
+    def save_step_checkpoint(self, session, train_dir):
+        saver = self.step_saver
+        kept = set(saver.last_checkpoints)
+        path = self.save_checkpoint(session, saver, train_dir + '/fancier_model_step',
+                                    global_step=self.training_state['global_step'])
+        # the saver deletes checkpoints beyond config.keep, drop their states too
+        for old_path in kept - set(saver.last_checkpoints):
+            if os.path.exists(old_path + '.state.json'):
+                os.remove(old_path + '.state.json')
+        logging.info("Saved checkpoint %s", path)
+
 
-    def train(self, session, dataset, train_dir, vocab):
+    def train(self, session, dataset, train_dir, vocab, training_state=None):
+        """
+        :param training_state: state saved with the checkpoint the variables
+                               were restored from, training continues from it
+        """
         tic = time.time()
         params = tf.trainable_variables()
         num_params = sum(map(lambda t: np.prod(tf.shape(t.value()).eval()), params))
@@ -680,24 +888,36 @@ class QASystem(object):
 
         training_set = dataset['training'] # [question, len(question), context, len(context), answer]
         validation_set = dataset['validation']
-        f1_best = 0
+        self.training_state = state = {'epoch': 0, 'batch': 0, 'global_step': 0, 'f1_best': 0}
+        if training_state is not None:
+            state.update(training_state)
+            np.random.set_state(_rng_state_from_json(state.pop('rng_state')))
+            if isinstance(training_set, DataStream) and 'stream_rng_state' in state:
+                training_set.rng.set_state(_rng_state_from_json(state['stream_rng_state']))
+            logging.info("Resuming training at epoch %d, batch %d (step %d, best f1 %.2f)",
+                         state['epoch'] + 1, state['batch'], state['global_step'], state['f1_best'])
+        # step checkpoints rotate with config.keep, the epoch ones are all kept
+        self.step_saver = tf.train.Saver(max_to_keep=self.config.keep)
+        saver = tf.train.Saver(max_to_keep=0)
         if self.config.tensorboard:
             train_writer_dir = self.config.log_dir + '/train/' # + datetime.datetime.now().strftime('%m-%d_%H-%M-%S')
             self.train_writer = tf.summary.FileWriter(train_writer_dir, session.graph)
-        for epoch in range(self.config.epochs):
+        for epoch in range(state['epoch'], self.config.epochs):
             logging.info("="* 10 + " Epoch %d out of %d " + "="* 10, epoch + 1, self.config.epochs)
 
-            score = self.run_epoch(session, epoch, training_set, vocab, validation_set, sample_size=self.config.evaluate_sample_size)
+            score = self.run_epoch(session, epoch, training_set, vocab, validation_set, sample_size=self.config.evaluate_sample_size,
+                                   train_dir=train_dir)
             logging.info("-- validation --")
             self.validate(session, validation_set)
 
             f1, em = self.evaluate_answer(session, validation_set, vocab, sample=self.config.model_selection_sample_size, log=True)
+            state['epoch'] = epoch + 1
+            state['batch'] = 0
             # Saving the model
-            if f1>f1_best:
-            	f1_best = f1
-                saver = tf.train.Saver()
+            if f1>state['f1_best']:
+                state['f1_best'] = f1
                 saver.save(session, train_dir+'/fancier_model')
                 logging.info('New best f1 in val set')
                 logging.info('')
-            saver = tf.train.Saver()
-            saver.save(session, train_dir+'/fancier_model_' + str(epoch))
+            # saved last, so a resumed run starts from here with the next epoch
+            self.save_checkpoint(session, saver, train_dir+'/fancier_model_' + str(epoch))
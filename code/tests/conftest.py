@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import their modules relative to code/, e.g. `from utils.util import ...`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,117 @@
+import numpy as np
+
+from utils.util import BucketSampler, PaddedBatches, QADataset, pack_by_tokens, parse_boundaries
+
+
+def random_dataset(num_questions=60, num_contexts=20, seed=0):
+    rng = np.random.RandomState(seed)
+    contexts = [list(rng.randint(1, 100, rng.randint(5, 40))) for _ in range(num_contexts)]
+    examples = []
+    for i in range(num_questions):
+        context = contexts[rng.randint(num_contexts)]
+        question = list(rng.randint(1, 100, rng.randint(2, 12)))
+        start = rng.randint(len(context))
+        examples.append([question, len(question), context, len(context), (start, start)])
+    return QADataset.from_examples(examples)
+
+
+def unpad(batch):
+    """per question (question, context, span) of a batch with a context index"""
+    questions, question_lengths, contexts, context_lengths, spans, context_index = batch
+    return [(list(questions[i, :question_lengths[i]]), list(contexts[context_index[i], :context_lengths[i]]),
+             tuple(spans[i])) for i in range(len(question_lengths))]
+
+
+def test_padded_batches_match_dataset_batches():
+    data = random_dataset()
+    sampler = BucketSampler(data.context_lengths, data.question_lengths, 8, num_buckets=4)
+    batches = PaddedBatches(data, sampler)
+    for bucket, stored in zip(sampler.buckets, batches.buckets):
+        # distinct contexts only
+        assert len(stored[2]) == len(np.unique(data.context_index[bucket]))
+    seen = []
+    for indices in sampler:
+        batch = batches.batch(indices)
+        assert len(batch[2]) == len(np.unique(data.context_index[indices]))
+        assert batch[2].shape[1] == batch[3].max()
+        assert unpad(batch) == unpad(data.batch(indices))
+        seen.extend(indices)
+    assert sorted(seen) == list(range(len(data)))
+
+
+def random_lengths(n=500, seed=1):
+    rng = np.random.RandomState(seed)
+    return rng.randint(5, 300, n), rng.randint(2, 30, n)
+
+
+def test_bucket_sampler_covers_every_example_once_per_epoch():
+    context_lengths, question_lengths = random_lengths()
+    sampler = BucketSampler(context_lengths, question_lengths, 16, context_boundaries=[50, 100, 200],
+                            question_boundaries=[10])
+    bucket_of = np.empty(len(context_lengths), dtype=np.int64)
+    for b, bucket in enumerate(sampler.buckets):
+        bucket_of[bucket] = b
+    epochs = []
+    for _ in range(2):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert all(len(batch) <= 16 for batch in batches)
+        assert all(len(set(bucket_of[batch])) == 1 for batch in batches)
+        indices = np.concatenate(batches)
+        assert sorted(indices) == list(range(len(context_lengths)))
+        epochs.append(indices)
+    assert list(epochs[0]) != list(epochs[1])
+    for bucket in sampler.buckets:
+        lengths = context_lengths[bucket]
+        assert len(set(np.searchsorted([50, 100, 200], lengths, side='right'))) == 1
+
+
+def test_bucket_sampler_without_shuffle_sorts_by_context_length():
+    context_lengths, question_lengths = random_lengths()
+    sampler = BucketSampler(context_lengths, question_lengths, 16, num_buckets=8, shuffle=False)
+    indices = np.concatenate(list(sampler))
+    assert list(context_lengths[indices]) == sorted(context_lengths)
+    assert 0 < sampler.padding_fraction()[0] < 1
+
+
+def test_bucket_sampler_keeps_groups_together():
+    context_lengths, question_lengths = random_lengths()
+    groups = np.arange(len(context_lengths)) // 5
+    context_lengths = context_lengths[groups * 5]
+    sampler = BucketSampler(context_lengths, question_lengths, 10, num_buckets=4, groups=groups)
+    for batch in sampler:
+        # a batch of 10 holds two whole groups of 5
+        assert len(set(groups[batch])) <= 2
+
+
+def test_parse_boundaries():
+    assert parse_boundaries('100,150,200') == [100, 150, 200]
+    assert parse_boundaries('') is None
+
+
+def test_pack_by_tokens_respects_the_budget():
+    context_lengths, question_lengths = random_lengths()
+    indices = np.random.RandomState(0).permutation(len(context_lengths))
+    batches = pack_by_tokens(indices, context_lengths, question_lengths, 1000, max_question_tokens=120)
+    assert list(np.concatenate(batches)) == list(indices)
+    for batch, following in zip(batches, batches[1:] + [None]):
+        padded = context_lengths[batch].max() * len(batch)
+        assert padded <= 1000 and question_lengths[batch].max() * len(batch) <= 120
+        if following is not None:
+            # greedy: the next example would not have fit
+            grown = np.append(batch, following[0])
+            assert context_lengths[grown].max() * len(grown) > 1000 or \
+                question_lengths[grown].max() * len(grown) > 120
+
+
+def test_pack_by_tokens_gives_long_examples_their_own_batch():
+    batches = pack_by_tokens(np.arange(4), np.array([10, 500, 10, 10]), np.ones(4, dtype=int), 100)
+    assert [list(b) for b in batches] == [[0], [1], [2, 3]]
+
+
+def test_bucket_sampler_with_max_tokens():
+    context_lengths, question_lengths = random_lengths()
+    sampler = BucketSampler(context_lengths, question_lengths, 16, num_buckets=8, max_tokens=2000)
+    batches = list(sampler)
+    assert sorted(np.concatenate(batches)) == list(range(len(context_lengths)))
+    assert all(context_lengths[b].max() * len(b) <= 2000 for b in batches)
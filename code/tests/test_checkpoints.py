@@ -0,0 +1,44 @@
+import json
+
+import numpy as np
+
+from qa_model import _rng_state_from_json, _rng_state_to_json, read_training_state, write_training_state
+from utils.util import BucketSampler
+
+
+def test_rng_state_survives_json():
+    rng = np.random.RandomState(4)
+    rng.randn(3)  # leaves a cached gaussian
+    state = json.loads(json.dumps(_rng_state_to_json(rng.get_state())))
+    restored = np.random.RandomState()
+    restored.set_state(_rng_state_from_json(state))
+    np.testing.assert_array_equal(restored.randn(5), rng.randn(5))
+
+
+def test_training_state_next_to_the_checkpoint(tmpdir):
+    path = str(tmpdir.join('model-100'))
+    assert read_training_state(path) is None
+    state = {'epoch': 2, 'batch': 17, 'global_step': 100, 'f1_best': 0.5,
+             'rng_state': _rng_state_to_json(np.random.get_state())}
+    write_training_state(path, state)
+    assert read_training_state(path) == json.loads(json.dumps(state))
+    assert not tmpdir.join('model-100.state.json.part').check()
+
+
+def test_bucket_sampler_resumes_the_epoch():
+    rng = np.random.RandomState(0)
+    context_lengths, question_lengths = rng.randint(5, 300, 300), rng.randint(2, 30, 300)
+    sampler = BucketSampler(context_lengths, question_lengths, 8, num_buckets=6)
+    epoch_state = np.random.get_state()
+    epoch = [list(b) for b in sampler]
+
+    resumed = BucketSampler(context_lengths, question_lengths, 8, num_buckets=6)
+    np.random.seed(123)
+    global_state = np.random.get_state()
+    resumed.resume(10, epoch_state)
+    # the global RNG is left as it was
+    assert np.random.get_state()[2] == global_state[2]
+    np.testing.assert_array_equal(np.random.get_state()[1], global_state[1])
+    assert [list(b) for b in resumed] == epoch[10:]
+    # and the epoch after that is a full one
+    assert len(list(resumed)) == len(epoch)
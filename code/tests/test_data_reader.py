@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pytest
+
+import utils.data_reader as data_reader
+from utils.data_reader import DataStream, _maybe_compile, _read_split
+
+
+def write_split(tmpdir, num_questions=40, num_contexts=15):
+    rng = np.random.RandomState(0)
+    contexts = [rng.randint(1, 50, rng.randint(3, 20)) for _ in range(num_contexts)]
+    index = rng.randint(num_contexts, size=num_questions)
+    files = [tmpdir.join(name) for name in ['q', 'c', 's', 'i']]
+    files[0].write(''.join(' '.join(map(str, rng.randint(1, 50, rng.randint(1, 6)))) + '\n'
+                           for _ in range(num_questions)))
+    files[1].write(''.join(' '.join(map(str, c)) + '\n' for c in contexts))
+    files[2].write(''.join('{} {}\n'.format(0, rng.randint(len(contexts[i]))) for i in index))
+    files[3].write(''.join('{}\n'.format(i) for i in index))
+    return [str(f) for f in files]
+
+
+def assert_same_examples(a, b):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        np.testing.assert_array_equal(x[0], y[0])
+        np.testing.assert_array_equal(x[2], y[2])
+        np.testing.assert_array_equal(x[4], y[4])
+        assert (x[1], x[3]) == (y[1], y[3])
+
+
+def test_binary_split_matches_text(tmpdir):
+    files = write_split(tmpdir)
+    for kwargs in [{}, {'context_maxlen': 8}, {'max_samples': 10}, {'context_maxlen': 8, 'max_samples': 5}]:
+        text = _read_split(*files, binary=False, **kwargs)
+        binary = _read_split(*files, binary=True, **kwargs)
+        assert_same_examples(text[0], binary[0])
+        assert text[1:] == binary[1:]
+
+
+def test_binary_split_maps_the_files(tmpdir):
+    files = write_split(tmpdir)
+    data = _read_split(*files, binary=True)[0]
+    assert not data.question_tokens.flags.owndata
+    assert not data.context_tokens.flags.owndata
+    subset = _read_split(*files, binary=True, max_samples=10)[0]
+    assert subset.question_tokens.flags.owndata
+    assert not subset.context_tokens.flags.owndata
+
+
+def test_binary_split_without_index_needs_a_context_per_question(tmpdir):
+    files = write_split(tmpdir)
+    with pytest.raises(ValueError):
+        _read_split(files[0], files[1], files[2], None, binary=True)
+
+
+def test_stream_max_lengths_match_read_split(tmpdir):
+    files = write_split(tmpdir)
+    _maybe_compile(*files)
+    for context_maxlen in [None, 8]:
+        _, max_q_len, max_c_len, _ = _read_split(*files, binary=False, context_maxlen=context_maxlen)
+        for binary in [False, True]:
+            stream = DataStream(files[0], files[1], files[2], files[3], context_maxlen=context_maxlen, binary=binary)
+            assert stream.max_lengths() == (max_q_len, max_c_len)
+
+
+def test_binaries_are_recompiled_when_the_text_changes(tmpdir, monkeypatch):
+    files = write_split(tmpdir)
+    _maybe_compile(*files)
+    question_file = files[0]
+    binaries = data_reader.ids_binary_paths(question_file)
+    assert data_reader._is_fresh(binaries, question_file)
+
+    # same modification time, different size
+    stat = os.stat(question_file)
+    with open(question_file, 'a') as f:
+        f.write('1 2 3\n')
+    os.utime(question_file, (stat.st_atime, stat.st_mtime))
+    assert not data_reader._is_fresh(binaries, question_file)
+    _maybe_compile(*files)
+    assert data_reader._is_fresh(binaries, question_file)
+    assert len(data_reader.open_ids_file(question_file)[1]) == 42
+
+    # replaced by an older file of the same size
+    os.utime(question_file, (stat.st_atime, stat.st_mtime - 100))
+    assert not data_reader._is_fresh(binaries, question_file)
+    _maybe_compile(*files)
+
+    monkeypatch.setattr(data_reader, 'BINARY_FORMAT_VERSION', data_reader.BINARY_FORMAT_VERSION + 1)
+    assert not data_reader._is_fresh(binaries, question_file)
+
+
+def test_compile_data_skips_missing_splits(tmpdir):
+    names = ['train.ids.question', 'train.ids.context', 'train.span']
+    for name, path in zip(names, write_split(tmpdir)):
+        os.rename(path, str(tmpdir.join(name)))
+    data_reader.compile_data(str(tmpdir), sorted_data=False)
+    data_reader.compile_data(str(tmpdir), sorted_data=True)
+    assert tmpdir.join('train.span.npy').check()
+    assert not tmpdir.join('val.span.npy').check()
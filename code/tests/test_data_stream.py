@@ -0,0 +1,52 @@
+import itertools
+
+import numpy as np
+
+from utils.data_reader import DataStream
+
+
+def write_split(tmpdir, num_records=50):
+    questions = tmpdir.join('train.ids.question')
+    contexts = tmpdir.join('train.ids.context')
+    spans = tmpdir.join('train.span')
+    questions.write(''.join('{} {}\n'.format(i, i + 1) for i in range(num_records)))
+    contexts.write(''.join(' '.join(['7'] * (5 + i % 13)) + '\n' for i in range(num_records)))
+    spans.write(''.join('0 {}\n'.format(i % 3) for i in range(num_records)))
+    return str(questions), str(contexts), str(spans)
+
+
+def order(batches):
+    return [int(q[0]) for batch in batches for q in batch[0]]
+
+
+def test_resumed_epoch_has_the_same_order(tmpdir):
+    files = write_split(tmpdir)
+    for boundaries in [None, [8, 12]]:
+        stream = DataStream(*files, batch_size=4, shuffle_buffer=16, bucket_boundaries=boundaries, seed=3)
+        seed = stream.next_seed()
+        rng_state = stream.rng.get_state()
+        uninterrupted = order(stream.epoch(seed))
+
+        stream = DataStream(*files, batch_size=4, shuffle_buffer=16, bucket_boundaries=boundaries, seed=3)
+        seed = stream.next_seed()
+        first = order(itertools.islice(stream.epoch(seed), 5))
+        # evaluation draws from the global RNG in between
+        np.random.rand(7)
+        stream.take(10)
+
+        resumed = DataStream(*files, batch_size=4, shuffle_buffer=16, bucket_boundaries=boundaries, seed=99)
+        resumed.rng.set_state(rng_state)
+        assert first + order(resumed.epoch(seed, 5)) == uninterrupted
+        assert resumed.next_seed() == stream.next_seed()
+
+
+def test_epochs_do_not_depend_on_the_global_rng(tmpdir):
+    files = write_split(tmpdir)
+    orders = []
+    for global_seed in [0, 1]:
+        np.random.seed(global_seed)
+        stream = DataStream(*files, batch_size=4, shuffle_buffer=16, seed=5)
+        orders.append([order(stream) for _ in range(2)])
+    assert orders[0] == orders[1]
+    assert orders[0][0] != orders[0][1]
+    assert sorted(orders[0][0]) == list(range(50))
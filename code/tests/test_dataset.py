@@ -0,0 +1,109 @@
+import pickle
+
+import numpy as np
+
+from utils.util import QADataset, merge_window_spans
+
+
+def examples():
+    shared = [5, 6, 7, 8]
+    return [[[1, 2], 2, shared, 4, (0, 1)],
+            [[3], 1, [9, 10], 2, (1, 1)],
+            [[4, 4, 4], 3, shared, 4, None],
+            [[2], 1, list(shared), 4, (3, 3)]]
+
+
+def test_from_examples_stores_shared_contexts_once():
+    data = QADataset.from_examples(examples())
+    assert len(data) == 4
+    # the same object is stored once, an equal copy is not
+    assert list(data.context_index) == [0, 1, 0, 2]
+    assert len(data.context_offsets) == 4
+    assert list(data.question_lengths) == [2, 1, 3, 1]
+    assert list(data.context_lengths) == [4, 2, 4, 4]
+    assert data.spans.tolist() == [[0, 1], [1, 1], [-1, -1], [3, 3]]
+
+
+def test_items_and_take():
+    data = QADataset.from_examples(examples())
+    question, question_len, context, context_len, span = data[-2]
+    assert list(question) == [4, 4, 4] and question_len == 3
+    assert list(context) == [5, 6, 7, 8] and context_len == 4
+    assert list(span) == [-1, -1]
+
+    subset = data[1::2]
+    assert len(subset) == 2
+    assert [list(x[0]) for x in subset] == [[3], [2]]
+    assert [list(x[2]) for x in subset] == [[9, 10], [5, 6, 7, 8]]
+    assert subset.context_tokens is data.context_tokens
+
+
+def test_batch_pads_distinct_contexts():
+    data = QADataset.from_examples(examples())
+    questions, question_lengths, contexts, context_lengths, spans, context_index = data.batch([2, 1, 0])
+    assert questions.tolist() == [[4, 4, 4], [3, 0, 0], [1, 2, 0]]
+    assert list(question_lengths) == [3, 1, 2]
+    assert contexts.tolist() == [[5, 6, 7, 8], [9, 10, 0, 0]]
+    assert list(context_index) == [0, 1, 0]
+    assert list(context_lengths) == [4, 2, 4]
+    assert spans.tolist() == [[-1, -1], [1, 1], [0, 1]]
+    assert questions.dtype == contexts.dtype == np.int32
+
+
+def test_pickle_round_trip():
+    data = QADataset.from_examples(examples())
+    copy = pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    for name in QADataset.__slots__:
+        np.testing.assert_array_equal(getattr(copy, name), getattr(data, name))
+
+
+def windowed():
+    long_context, short_context = list(range(100, 110)), [7, 8, 9]
+    return QADataset.from_examples([[[1], 1, long_context, 10, (2, 3)],
+                                    [[2], 1, long_context, 10, (6, 9)],
+                                    [[3], 1, short_context, 3, (0, 2)],
+                                    [[4], 1, long_context, 10, None],
+                                    [[5], 1, long_context, 10, (3, 7)]])
+
+
+def test_window_starts_reach_the_end_of_the_context():
+    for length, starts in [(1, [0]), (4, [0]), (5, [0, 3]), (10, [0, 3, 6]), (11, [0, 3, 6, 9])]:
+        data = QADataset.from_examples([[[1], 1, list(range(length)), length, (0, 0)]])
+        chunks, example_of, window_start = data.chunk(4, 3)
+        assert window_start.tolist() == starts
+        assert example_of.tolist() == [0] * len(starts)
+        assert [list(chunk[2]) for chunk in chunks] == [list(range(length))[s:s + 4] for s in starts]
+
+
+def test_chunk_spans_are_relative_to_the_windows():
+    data = windowed()
+    chunks, example_of, window_start = data.chunk(4, 3)
+    assert example_of.tolist() == [0, 0, 0, 1, 1, 1, 2, 3, 3, 3, 4, 4, 4]
+    assert window_start.tolist() == [0, 3, 6, 0, 3, 6, 0, 0, 3, 6, 0, 3, 6]
+    # answers not inside a window, e.g. crossing two of them, get (-1, -1)
+    assert chunks.spans.tolist() == [[2, 3], [-1, -1], [-1, -1],
+                                     [-1, -1], [-1, -1], [0, 3],
+                                     [0, 2],
+                                     [-1, -1], [-1, -1], [-1, -1],
+                                     [-1, -1], [-1, -1], [-1, -1]]
+    for chunk, n, start in zip(chunks, example_of, window_start):
+        assert list(chunk[0]) == list(data[n][0])
+        assert list(chunk[2]) == list(data[n][2][start:start + 4])
+    # windows of one context are stored once, whatever the number of questions
+    assert len(chunks.context_offsets) - 1 == 4
+
+
+def test_chunk_answers_only():
+    chunks, example_of, window_start = windowed().chunk(4, 3, answers_only=True)
+    assert example_of.tolist() == [0, 1, 2]
+    assert window_start.tolist() == [0, 6, 0]
+    assert chunks.spans.tolist() == [[2, 3], [0, 3], [0, 2]]
+
+
+def test_merge_window_spans_prefers_the_earliest_window_on_ties():
+    spans = [(0, 1), (1, 2), (0, 0), (2, 2)]
+    merged = merge_window_spans(spans, [1., 5., 5., 2.], [0, 0, 0, 2], [0, 3, 6, 4], 3)
+    assert merged == [(4, 5), (0, 0), (6, 6)]
+    # the earliest window, not the first one listed
+    merged = merge_window_spans(spans[::-1], [2., 5., 5., 1.], [2, 0, 0, 0], [4, 6, 3, 0], 3)
+    assert merged == [(4, 5), (0, 0), (6, 6)]
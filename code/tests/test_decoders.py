@@ -0,0 +1,102 @@
+import numpy as np
+
+from utils.util import DEFAULT_MAX_ANSWER_LEN, SENTENCE_END_ID, get_best_spans, get_sentence_starts, get_top_spans
+
+
+def random_batch(rng, N=40, JX=25, integer=False):
+    if integer:
+        # small integers give plenty of ties
+        start_logits = rng.randint(-3, 4, (N, JX)).astype(np.float64)
+        end_logits = rng.randint(-3, 4, (N, JX)).astype(np.float64)
+    else:
+        start_logits, end_logits = rng.randn(N, JX), rng.randn(N, JX)
+    lengths = rng.randint(0, JX + 1, N)
+    context_ids = np.where(rng.rand(N, JX) < 0.15, SENTENCE_END_ID, 1)
+    return start_logits, end_logits, lengths, context_ids
+
+
+def allowed(i, j, length, sentence_starts=None, max_answer_len=None):
+    return i <= j < length and (sentence_starts is None or sentence_starts[j] <= i) and \
+        (not max_answer_len or j - i < max_answer_len)
+
+
+def brute_force_best_span(start_logits, end_logits, length, sentence_starts=None, max_answer_len=None):
+    best, best_span = -np.inf, (0, 0)
+    for j in range(len(start_logits)):
+        for i in range(j + 1):
+            if allowed(i, j, length, sentence_starts, max_answer_len) and start_logits[i] + end_logits[j] > best:
+                best, best_span = start_logits[i] + end_logits[j], (i, j)
+    return best_span
+
+
+def test_sentence_starts():
+    starts = get_sentence_starts([[1, SENTENCE_END_ID, 1, 1, SENTENCE_END_ID, 1], [1] * 6])
+    assert starts.tolist() == [[0, 0, 2, 2, 2, 5], [0] * 6]
+
+
+def test_best_spans_match_brute_force():
+    rng = np.random.RandomState(0)
+    for integer in [False, True]:
+        start_logits, end_logits, lengths, context_ids = random_batch(rng, integer=integer)
+        sentence_starts = get_sentence_starts(context_ids)
+        for starts, max_answer_len in [(None, None), (sentence_starts, None), (None, 4), (sentence_starts, 3)]:
+            spans, scores = get_best_spans(start_logits, end_logits, lengths, starts, max_answer_len)
+            for n in range(len(lengths)):
+                expected = brute_force_best_span(start_logits[n], end_logits[n], lengths[n],
+                                                 None if starts is None else starts[n], max_answer_len)
+                assert tuple(spans[n]) == expected
+                assert scores[n] == start_logits[n, expected[0]] + end_logits[n, expected[1]]
+
+
+def softmax(logits):
+    e = np.exp(logits - logits.max())
+    return e / e.sum()
+
+
+def brute_force_top_spans(start_logits, end_logits, length, k, max_answer_len, sentence_starts=None,
+                          length_prior=None):
+    if not length:
+        return [], []
+    p_start, p_end = softmax(start_logits[:length]), softmax(end_logits[:length])
+    weights = {}
+    for i in range(length):
+        for j in range(i, length):
+            if allowed(i, j, length, sentence_starts, max_answer_len):
+                prior = 1. if length_prior is None else (length_prior[j - i] if j - i < len(length_prior) else 0.)
+                if prior > 0:
+                    weights[i, j] = p_start[i] * p_end[j] * prior
+    total = sum(weights.values())
+    spans, probs = [], []
+    for (i, j), weight in sorted(weights.items(), key=lambda item: -item[1]):
+        if len(spans) == k:
+            break
+        if all(j < a or i > b for a, b in spans):
+            spans.append((i, j))
+            probs.append(weight / total)
+    return spans, probs
+
+
+def test_top_spans_match_brute_force():
+    rng = np.random.RandomState(1)
+    start_logits, end_logits, lengths, context_ids = random_batch(rng, N=30, JX=20)
+    sentence_starts = get_sentence_starts(context_ids)
+    for starts, max_answer_len, prior in [(None, None, None), (None, 4, None), (sentence_starts, 6, None),
+                                          (None, 5, [0.5, 1., 2.])]:
+        spans, probs = get_top_spans(start_logits, end_logits, lengths, 4, max_answer_len=max_answer_len,
+                                     sentence_starts=starts, length_prior=prior)
+        for n in range(len(lengths)):
+            expected_spans, expected_probs = brute_force_top_spans(
+                start_logits[n], end_logits[n], lengths[n], 4, max_answer_len or DEFAULT_MAX_ANSWER_LEN,
+                None if starts is None else starts[n], prior)
+            assert spans[n] == expected_spans
+            np.testing.assert_allclose(probs[n], expected_probs, rtol=1e-9)
+
+
+def test_top_span_agrees_with_best_span():
+    rng = np.random.RandomState(2)
+    start_logits, end_logits, lengths, _ = random_batch(rng)
+    lengths = np.maximum(lengths, 1)
+    spans, probs = get_top_spans(start_logits, end_logits, lengths, 1, max_answer_len=8)
+    best, _ = get_best_spans(start_logits, end_logits, lengths, max_answer_len=8)
+    assert [row[0] for row in spans] == [tuple(span) for span in best]
+    assert all(0 < row[0] <= 1 for row in probs)
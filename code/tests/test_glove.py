@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import utils.glove as glove
+
+
+def test_embedding_file_round_trip(tmpdir):
+    path = str(tmpdir.join('glove.emb'))
+    words = [b'<pad>', b'the', b'caf\xc3\xa9']
+    vectors = np.random.RandomState(0).randn(3, 5).astype(np.float32)
+    matrix = glove.open_output(path, vectors.shape)
+    matrix[:] = vectors
+    glove.commit_output(matrix, path, glove.vocab_checksum(words))
+    del matrix
+
+    assert glove.read_header(path) == (3, 5, glove.vocab_checksum(words))
+    np.testing.assert_array_equal(glove.open_embeddings(path, words), vectors)
+    np.testing.assert_array_equal(glove.open_embeddings(path), vectors)
+    with pytest.raises(ValueError):
+        glove.open_embeddings(path, words[::-1])
+    with pytest.raises(ValueError):
+        glove.open_embeddings(path, words[:2])
+
+
+def test_read_header_rejects_other_files(tmpdir):
+    path = tmpdir.join('glove.txt')
+    path.write_binary(b'the 0.1 0.2\n' * 10)
+    with pytest.raises(ValueError):
+        glove.read_header(str(path))
+
+
+def test_word_index_round_trip(tmpdir):
+    path = str(tmpdir.join('glove.index'))
+    words = [b'the', b'The', b'caf\xc3\xa9', b'a', b'the', b'zebra', b'']
+    glove.write_word_index(path, words)
+    index = glove.WordIndex(path)
+    assert len(index) == len(words)
+    assert index.checksum == glove.vocab_checksum(words)
+    expected = dict((w, i) for i, w in enumerate(words))
+    for word, row in expected.items():
+        assert index[word] == row
+    for missing in [b'th', b'thee', b'zz', b'A', b'\x00']:
+        assert missing not in index
+        assert index.get(missing, -1) == -1
+    with pytest.raises(KeyError):
+        index[b'missing']
+    index.close()
+
+
+def test_empty_word_index(tmpdir):
+    path = str(tmpdir.join('empty.index'))
+    glove.write_word_index(path, [])
+    index = glove.WordIndex(path)
+    assert len(index) == 0 and b'the' not in index
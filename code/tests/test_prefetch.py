@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from utils.data_reader import DataStream
+from utils.prefetch import Prefetcher
+from test_data_stream import order, write_split
+
+
+def test_thread_keeps_order():
+    batches = [[np.arange(i, i + 3)] for i in range(10)]
+    prefetcher = Prefetcher(batches, depth=2)
+    for expected, batch in zip(batches, prefetcher):
+        np.testing.assert_array_equal(batch[0], expected[0])
+    assert prefetcher.batches == 10
+
+
+def test_thread_reports_errors():
+    def failing():
+        yield [np.zeros(1)]
+        yield [np.zeros(1)]
+        raise ValueError("broken source")
+
+    with pytest.raises(RuntimeError) as error:
+        list(Prefetcher(failing(), depth=1))
+    assert "broken source" in str(error.value)
+
+
+def test_stream_order_is_reproducible_with_a_concurrent_global_rng(tmpdir):
+    files = write_split(tmpdir, num_records=200)
+    expected = order(DataStream(*files, batch_size=4, shuffle_buffer=32, seed=7))
+    stream = DataStream(*files, batch_size=4, shuffle_buffer=32, seed=7)
+    seen = []
+    for batch in Prefetcher(stream, depth=3):
+        # the main thread samples for evaluation while the thread shuffles
+        np.random.choice(100, 10, replace=False)
+        seen.extend(int(q[0]) for q in batch[0])
+    assert seen == expected
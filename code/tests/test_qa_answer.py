@@ -0,0 +1,35 @@
+import numpy as np
+
+import qa_answer
+
+
+def whitespace_tokenize(text):
+    tokens, offsets, position = [], [], 0
+    for token in text.split(' '):
+        tokens.append(token)
+        offsets.append((position, position + len(token)))
+        position += len(token) + 1
+    return tokens, np.array(offsets, dtype=np.int32)
+
+
+ARTICLES = [{'paragraphs': [{'context': 'the cat sat', 'qas': [{'question': 'who sat', 'id': 'q1'}]},
+                            {'context': 'a dog ran', 'qas': [{'question': 'who ran', 'id': 'q2'},
+                                                             {'question': 'what ran', 'id': 'q3'}]}]}]
+
+
+def test_read_dev_expands_or_maps_to_unk(monkeypatch):
+    monkeypatch.setattr(qa_answer, 'tokenize_with_offsets', whitespace_tokenize)
+    monkeypatch.setattr(qa_answer, 'tokenize', lambda text: whitespace_tokenize(text)[0])
+    rev_vocab = ['<pad>', '<sos>', '<unk>', 'the', 'sat', 'who']
+    vocab = dict((w, i) for i, w in enumerate(rev_vocab))
+
+    data, _, lengths, uuids, texts, _ = qa_answer.read_dev(ARTICLES, dict(vocab), list(rev_vocab), expand=False)
+    assert uuids == ['q1', 'q2', 'q3']
+    assert list(data.context(0)) == [3, 2, 4]
+    assert list(data.question(2)) == [2, 2]
+    assert texts[1] is texts[2] and list(lengths) == [3, 3, 3]
+
+    expanded_vocab, expanded_rev_vocab = dict(vocab), list(rev_vocab)
+    data = qa_answer.read_dev(ARTICLES, expanded_vocab, expanded_rev_vocab)[0]
+    assert expanded_rev_vocab[len(rev_vocab):] == ['cat', 'ran', 'what', 'a', 'dog']
+    assert [expanded_rev_vocab[i] for i in data.context(1)] == ['a', 'dog', 'ran']
@@ -0,0 +1,58 @@
+import numpy as np
+import tensorflow as tf
+
+from qa_model import QASystem, best_spans_in_graph
+from test_decoders import random_batch
+from utils.util import SENTENCE_END_ID, get_best_spans, get_sentence_starts
+
+
+class Placeholders(object):
+    """The placeholders of create_feed_dict, without building the graph"""
+    def __init__(self):
+        for name in ['question_placeholder', 'question_len_placeholder', 'context_placeholder',
+                     'context_len_placeholder', 'context_index_placeholder', 'answer_start_placeholders',
+                     'answer_end_placeholders', 'dropout_placeholder']:
+            setattr(self, name, name)
+
+
+def create_feed_dict(*args, **kwargs):
+    return QASystem.create_feed_dict.__func__(Placeholders(), *args, **kwargs)
+
+
+def test_ragged_contexts_are_fed_once():
+    shared = [5, 6, 7]
+    feed = create_feed_dict([[1], [2, 3], [4]], [1, 2, 1], [shared, [8, 9], shared], [3, 2, 3])
+    np.testing.assert_array_equal(feed['context_placeholder'], [[5, 6, 7], [8, 9, 0]])
+    assert list(feed['context_index_placeholder']) == [0, 1, 0]
+    assert list(feed['context_len_placeholder']) == [3, 2]
+
+
+def test_ragged_contexts_keep_the_given_index():
+    # equal contexts that are different objects, with the index of the batch
+    feed = create_feed_dict([[1], [2, 3], [4]], [1, 2, 1], [[8, 9], [5, 6, 7]], [3, 2, 3],
+                            context_index=np.array([1, 0, 1], dtype=np.int32))
+    np.testing.assert_array_equal(feed['context_placeholder'], [[8, 9, 0], [5, 6, 7]])
+    assert list(feed['context_index_placeholder']) == [1, 0, 1]
+    assert list(feed['context_len_placeholder']) == [2, 3]
+
+
+def test_span_decoder_in_graph_matches_get_best_spans():
+    rng = np.random.RandomState(0)
+    s = tf.placeholder(tf.float32, shape=(None, None))
+    e = tf.placeholder(tf.float32, shape=(None, None))
+    lengths = tf.placeholder(tf.int32, shape=(None,))
+    context = tf.placeholder(tf.int32, shape=(None, None))
+    sentence = tf.cumsum(tf.cast(tf.equal(context, SENTENCE_END_ID), 'int32'), axis=1, exclusive=True)
+    mask = tf.sequence_mask(lengths, tf.shape(context)[1])
+    with tf.Session() as session:
+        for integer in [False, True]:
+            start_logits, end_logits, row_lengths, context_ids = random_batch(rng, integer=integer)
+            start_logits, end_logits = start_logits.astype(np.float32), end_logits.astype(np.float32)
+            for max_answer_len in [None, 1, 4, 100]:
+                spans, scores = session.run(best_spans_in_graph(s, e, mask, sentence, max_answer_len), {
+                    s: start_logits, e: end_logits, lengths: row_lengths, context: context_ids})
+                expected, expected_scores = get_best_spans(start_logits, end_logits, row_lengths,
+                                                           get_sentence_starts(context_ids), max_answer_len)
+                np.testing.assert_array_equal(spans, expected)
+                nonempty = row_lengths > 0
+                np.testing.assert_allclose(scores[nonempty], expected_scores[nonempty], rtol=1e-6)
@@ -0,0 +1,238 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from preprocessing import squad_preprocess
+from preprocessing.squad_preprocess import LineFile, align_tokens, align_tokens_bulk, char_to_token_span, \
+    iter_articles, line_offsets, split_tier, token_to_char_span
+
+
+def test_line_offsets_across_chunks(tmpdir):
+    path = tmpdir.join('lines')
+    for content in [b'', b'a\n', b'a\nbb\n\nccc', b'first line\nsecond\nthird\n']:
+        path.write_binary(content)
+        lines = content.splitlines(True)
+        expected = [sum(len(l) for l in lines[:i]) for i in range(len(lines) + 1)]
+        for chunk_size in [1, 2, 3, 1 << 20]:
+            assert list(line_offsets(str(path), chunk_size)) == expected
+
+
+def test_line_file(tmpdir):
+    path = tmpdir.join('lines')
+    path.write_binary(b'zero\none\ntwo')
+    lines = LineFile(str(path))
+    assert len(lines) == 3
+    assert [lines.line(i) for i in range(3)] == [b'zero\n', b'one\n', b'two']
+    out = io.BytesIO()
+    lines.write_lines(out, [2, 0])
+    assert out.getvalue() == b'two\nzero\n'
+    lines.close()
+
+    path.write_binary(b'')
+    assert len(LineFile(str(path))) == 0
+
+
+def test_split_tier_keeps_questions_with_their_contexts(tmpdir):
+    contexts = [b'c0', b'c1', b'c2', b'c3']
+    index = [0, 0, 1, 2, 2, 2, 3, 3, 1, 0]
+    tmpdir.join('train.context').write_binary(b''.join(c + b'\n' for c in contexts))
+    tmpdir.join('train.context_index').write_binary(b''.join(b'%d\n' % i for i in index))
+    for ext in ['question', 'answer', 'span']:
+        tmpdir.join('train.' + ext).write_binary(b''.join(b'%s%d\n' % (ext[0], q) for q in range(len(index))))
+
+    split_tier(str(tmpdir), train_percentage=0.7)
+
+    examples = []
+    for tier in ['train', 'val']:
+        tier_contexts = tmpdir.join(tier + '.context').read_binary().splitlines()
+        tier_index = [int(i) for i in tmpdir.join(tier + '.context_index').read_binary().splitlines()]
+        questions = tmpdir.join(tier + '.question').read_binary().splitlines()
+        spans = tmpdir.join(tier + '.span').read_binary().splitlines()
+        # every context row is used, once per paragraph
+        assert sorted(set(tier_index)) == list(range(len(tier_contexts)))
+        assert len(set(tier_contexts)) == len(tier_contexts)
+        examples.extend((q, s, tier_contexts[i]) for q, s, i in zip(questions, spans, tier_index))
+    assert len(examples) == len(index)
+    assert sorted(examples) == sorted((b'q%d' % q, b's%d' % q, contexts[i]) for q, i in enumerate(index))
+
+
+def test_iter_articles_matches_json_load(tmpdir):
+    articles = [
+        {u'title': u'Caf\xe9 "quoted" \\ title', u'paragraphs': [
+            {u'context': u'line\nbreak, tab\t and \u00e9\u4e2d]}', u'qas': [
+                {u'id': u'1', u'question': u'why?', u'answers': [{u'answer_start': 12345, u'text': u'x'}]},
+                {u'id': u'2', u'question': u'', u'answers': [], u'score': -1.5e-3, u'flag': None, u'ok': True}]}]},
+        {u'title': u'empty', u'paragraphs': []},
+    ]
+    path = tmpdir.join('squad.json')
+    for data in [{u'version': 1.1, u'data': articles},
+                 {u'data': articles, u'version': u'1.1', u'extra': [1, {u'a': 2}]},
+                 {u'data': []},
+                 {}]:
+        for indent in [None, 2]:
+            path.write_binary(json.dumps(data, indent=indent).encode('utf-8'))
+            with io.open(str(path), encoding='utf-8') as f:
+                expected = json.load(f).get(u'data', [])
+            for chunk_size in [1, 2, 3, 7, 1 << 20]:
+                assert list(iter_articles(str(path), chunk_size)) == expected
+
+
+def test_iter_articles_rejects_truncated_files(tmpdir):
+    path = tmpdir.join('squad.json')
+    path.write_binary(b'{"data": [{"title": "a"}, {"title": ')
+    with pytest.raises(ValueError):
+        list(iter_articles(str(path), chunk_size=4))
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    """nltk_tokenize without the punkt models and without the token cache"""
+    word_tokenize = squad_preprocess.nltk.word_tokenize
+    monkeypatch.setattr(squad_preprocess.nltk, 'word_tokenize', lambda s: word_tokenize(s, preserve_line=True))
+    monkeypatch.setattr(squad_preprocess, 'token_cache', None)
+    return squad_preprocess.nltk_tokenize
+
+
+def token_idx_map(context, context_tokens):
+    """The character -> token mapping that char_to_token_span replaced"""
+    acc = ''
+    current_token_idx = 0
+    token_map = dict()
+    for char_idx, char in enumerate(context):
+        if char != u' ':
+            acc += char
+            context_token = unicode(context_tokens[current_token_idx])
+            if acc == context_token:
+                syn_start = char_idx - len(acc) + 1
+                token_map[syn_start] = [acc, current_token_idx]
+                acc = ''
+                current_token_idx += 1
+    return token_map
+
+
+PARAGRAPHS = [
+    u'Architecturally, the school has a Catholic character. Atop the Main Building\'s gold dome is a golden '
+    u'statue of the Virgin Mary. It is a replica of the grotto at Lourdes, France where the Virgin Mary '
+    u'reputedly appeared to Saint Bernadette Soubirous in 1858.',
+    u'The Broncos defeated the Panthers 24-10 (in Super Bowl 50) to earn their third title; it cost $5,000,000 '
+    u'for a 30-second ad. He said " we won " and left - quickly.',
+]
+
+
+def test_char_to_token_span_agrees_with_token_idx_map(tokenizer):
+    for context in PARAGRAPHS:
+        tokens, offsets = tokenizer(context)
+        answer_map = token_idx_map(context, tokens)
+        token_start = dict((v[1], k) for k, v in answer_map.items())
+        checked = 0
+        for first in range(len(tokens)):
+            for last in range(first, min(first + 6, len(tokens))):
+                if first not in token_start or last not in token_start:
+                    continue
+                answer_start = token_start[first]
+                answer_end = token_start[last] + len(tokens[last])
+                text_tokens = tokens[first:last + 1]
+                expected = (answer_map[answer_start][1], answer_map[answer_end - len(text_tokens[-1])][1])
+                assert char_to_token_span(offsets, answer_start, answer_end) == expected
+                assert token_to_char_span(offsets, first, last) == (answer_start, answer_end)
+                checked += 1
+        assert checked > 5 * len(tokens)
+
+
+def test_rewritten_quotes_are_aligned(tokenizer):
+    context = u'He said ``hi\'\' to "me", then \'\'left``.'
+    tokens, offsets = tokenizer(context)
+    assert tokens == [b'He', b'said', b'"', b'hi', b'"', b'to', b'"', b'me', b'"', b',', b'then', b'"', b'left', b'"', b'.']
+    texts = [context[start:end] for start, end in offsets]
+    assert texts == [u'He', u'said', u'``', u'hi', u"''", u'to', u'"', u'me', u'"', u',', u'then', u"''", u'left', u'``', u'.']
+    # an answer right after a rewritten quote
+    assert char_to_token_span(offsets, context.index(u'hi'), context.index(u'hi') + 2) == (3, 3)
+    assert char_to_token_span(offsets, context.index(u'``'), context.index(u'to') + 2) == (2, 5)
+
+
+def test_answers_inside_tokens_cover_the_whole_tokens(tokenizer):
+    context = u'It cost $5,000,000 for 30-second ads.'
+    tokens, offsets = tokenizer(context)
+    number = tokens.index(b'5,000,000')
+    start = context.index(u'000')
+    # starting inside the number, ending inside it or inside the next word
+    assert char_to_token_span(offsets, start, start + 3) == (number, number)
+    assert char_to_token_span(offsets, start, context.index(u'for') + 2) == (number, number + 1)
+    # ending one character into a token
+    assert char_to_token_span(offsets, 0, context.index(u'cost') + 1) == (0, 1)
+    # whitespace only
+    assert char_to_token_span(offsets, 2, 3) is None
+
+
+def test_answers_at_the_ends_of_the_context(tokenizer):
+    context = PARAGRAPHS[0]
+    tokens, offsets = tokenizer(context)
+    assert char_to_token_span(offsets, 0, len(u'Architecturally')) == (0, 0)
+    assert char_to_token_span(offsets, len(context) - len(u'1858.'), len(context)) == (len(tokens) - 2, len(tokens) - 1)
+    assert char_to_token_span(offsets, 0, len(context)) == (0, len(tokens) - 1)
+    assert token_to_char_span(offsets, 0, len(tokens) - 1) == (0, len(context))
+    assert char_to_token_span(offsets, len(context), len(context)) is None
+
+
+def test_align_tokens_bulk(tokenizer):
+    token_lists = [tokenizer(context)[0] for context in PARAGRAPHS] + [[]]
+    offsets, rows = align_tokens_bulk(PARAGRAPHS + [u''], token_lists)
+    lengths = [len(tokens) for tokens in token_lists]
+    assert rows.tolist() == [0, lengths[0], lengths[0] + lengths[1], lengths[0] + lengths[1]]
+    for i, (context, tokens) in enumerate(zip(PARAGRAPHS, token_lists)):
+        np.testing.assert_array_equal(offsets[rows[i]:rows[i + 1]], align_tokens(context, tokens))
+
+
+def squad_json(num_articles=11):
+    rng = np.random.RandomState(0)
+    articles = []
+    for a in range(num_articles):
+        paragraphs = []
+        for context in PARAGRAPHS[a % 2:] + [u'Article {} is short .'.format(a)]:
+            qas = []
+            for q in range(rng.randint(0, 4)):
+                start = rng.randint(len(context) - 10)
+                qas.append({u'id': u'{}-{}'.format(a, q), u'question': u'What is {} ?'.format(q),
+                            u'answers': [{u'answer_start': start, u'text': context[start:start + rng.randint(1, 10)]}]})
+            if a == 3:
+                # whitespace only, skipped
+                qas.append({u'id': u'skipped', u'question': u'Why ?',
+                            u'answers': [{u'answer_start': context.index(u' '), u'text': u' '}]})
+            paragraphs.append({u'context': context, u'qas': qas})
+        articles.append({u'title': u'article {}'.format(a), u'paragraphs': paragraphs})
+    return {u'version': u'1.1', u'data': articles}
+
+
+def test_pool_writes_the_same_files_as_a_serial_run(tmpdir, tokenizer):
+    path = tmpdir.join('train-v1.1.json')
+    path.write_binary(json.dumps(squad_json()).encode('utf-8'))
+    outputs = []
+    for num_workers in [1, 2]:
+        prefix = tmpdir.mkdir('workers{}'.format(num_workers))
+        dataset = squad_preprocess.data_from_json(str(path))
+        counts = squad_preprocess.read_write_dataset(dataset, 'train', str(prefix), num_workers=num_workers, chunksize=2)
+        files = dict((ext, prefix.join('train.' + ext).read_binary())
+                     for ext in ['context', 'context_index', 'question', 'answer', 'span'])
+        outputs.append((counts, files))
+    assert outputs[0] == outputs[1]
+    counts, files = outputs[0]
+    # with skipped questions and their paragraphs
+    assert 0 < len(files['question'].splitlines()) < counts[0]
+    assert len(files['context'].splitlines()) == len(set(files['context_index'].splitlines()))
+
+
+def test_iter_articles_reads_large_articles_in_few_refills(tmpdir, monkeypatch):
+    articles = [{u'title': u'big', u'paragraphs': [{u'context': u'word ' * 20000, u'qas': []}]}, {u'title': u'small'}]
+    path = tmpdir.join('squad.json')
+    path.write_binary(json.dumps({u'data': articles}).encode('utf-8'))
+    reads = []
+    fill = squad_preprocess._JsonReader.fill
+    def counting_fill(self, size=None):
+        reads.append(size)
+        return fill(self, size)
+    monkeypatch.setattr(squad_preprocess._JsonReader, 'fill', counting_fill)
+    assert list(iter_articles(str(path), chunk_size=64)) == articles
+    # 100 kB in 64 byte reads, doubled on every refill within one value
+    assert len(reads) < 20
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+
+from preprocessing.token_cache import TokenCache
+
+
+def tokenize(text):
+    tokens, offsets, position = [], [], 0
+    for token in text.split(' '):
+        tokens.append(token.encode('utf8'))
+        offsets.append((position, position + len(token)))
+        position += len(token) + 1
+    return tokens, np.array(offsets, dtype=np.int32).reshape(-1, 2)
+
+
+def test_round_trip_across_instances(tmpdir):
+    cache = TokenCache(str(tmpdir), 'v1')
+    text = u'caf\xe9 au lait'
+    tokens, offsets = cache.tokenize(text, tokenize)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    reopened = TokenCache(str(tmpdir), 'v1')
+    cached_tokens, cached_offsets = reopened.get(text)
+    assert cached_tokens == tokens
+    np.testing.assert_array_equal(cached_offsets, offsets)
+    assert reopened.get(u'') is None
+    assert TokenCache(str(tmpdir), 'v2').get(text) is None
+
+
+def test_empty_text(tmpdir):
+    cache = TokenCache(str(tmpdir), 'v1')
+    cache.put(u'', [], np.zeros((0, 2), dtype=np.int32))
+    tokens, offsets = TokenCache(str(tmpdir), 'v1').get(u'')
+    assert tokens == [] and offsets.shape == (0, 2)
+
+
+def test_entries_share_segment_files(tmpdir):
+    cache = TokenCache(str(tmpdir), 'v1')
+    for i in range(100):
+        cache.tokenize(u'sentence number {}'.format(i), tokenize)
+    assert os.listdir(str(tmpdir)) == ['00000000.tkc']
+
+
+def test_sees_entries_of_other_writers(tmpdir):
+    reader = TokenCache(str(tmpdir), 'v1')
+    assert reader.get(u'a b') is None
+    TokenCache(str(tmpdir), 'v1').tokenize(u'a b', tokenize)
+    reader._last_scan = None
+    assert reader.get(u'a b')[0] == [b'a', b'b']
+
+
+def test_evicts_oldest_segments(tmpdir):
+    cache = TokenCache(str(tmpdir), 'v1', max_bytes=64 * 1024, num_segments=4)
+    texts = [u' '.join([u'word{}'.format(i)] * 200) for i in range(200)]
+    for text in texts:
+        cache.tokenize(text, tokenize)
+    assert cache.disk_usage() <= cache.max_bytes + cache.segment_bytes + 4096
+    assert len(cache.segments()) < 200
+    fresh = TokenCache(str(tmpdir), 'v1', max_bytes=64 * 1024, num_segments=4)
+    assert fresh.get(texts[0]) is None
+    assert fresh.get(texts[-1]) is not None
+
+
+def test_memory_layer_is_lru(tmpdir):
+    cache = TokenCache(str(tmpdir), 'v1', memory_entries=2)
+    for text in [u'a', u'b', u'a', u'c']:
+        cache.tokenize(text, tokenize)
+    assert list(cache.memory) == [cache.key(u'a'), cache.key(u'c')]
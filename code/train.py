@@ -5,12 +5,15 @@ from __future__ import print_function
 import os
 import json
 
+import numpy as np
+
 import tensorflow as tf
 
-from qa_model import Encoder, QASystem, Decoder
+from qa_model import Encoder, QASystem, Decoder, read_training_state
 from os.path import join as pjoin
 
-from utils.data_reader import read_data, load_glove_embeddings
+from utils.data_reader import read_data, stream_data, load_glove_embeddings
+from utils.util import parse_boundaries
 
 import logging
 
@@ -20,6 +23,12 @@ tf.app.flags.DEFINE_float("learning_rate", 0.0005, "Learning rate.")
 tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.20, "Fraction of units randomly dropped on non-recurrent connections.")
 tf.app.flags.DEFINE_integer("batch_size", 24, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("max_batch_tokens", 0, "Pack batches up to this many padded context tokens, max(JX) * batch examples, instead of batch_size examples (0: off).")
+tf.app.flags.DEFINE_integer("max_question_tokens", 0, "With max_batch_tokens, also limit the padded question tokens of a batch (0: no limit).")
+tf.app.flags.DEFINE_integer("window_size", 0, "Split contexts into windows of this many tokens and run the model on each (0: whole contexts).")
+tf.app.flags.DEFINE_integer("window_stride", 128, "Tokens between the starts of consecutive windows, at most window_size.")
+tf.app.flags.DEFINE_integer("max_answer_len", 0, "Longest answer span in tokens that is predicted (0: no limit).")
+tf.app.flags.DEFINE_boolean("span_in_graph", False, "Pick the answer spans in the TensorFlow graph and fetch only the spans instead of the logits.")
 tf.app.flags.DEFINE_integer("epochs", 25, "Number of epochs to train.")
 tf.app.flags.DEFINE_integer("encoder_state_size", 100, "Size of each encoder model layer.")
 tf.app.flags.DEFINE_integer("decoder_state_size", 100, "Size of each decoder model layer.")
@@ -32,8 +41,9 @@ tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (
 tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
 tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
 tf.app.flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicates keep all.")
+tf.app.flags.DEFINE_integer("checkpoint_every", 1000, "Save a resumable checkpoint every this many training steps (0: only at the end of each epoch).")
 tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab file (default: ./data/squad/vocab.dat)")
-tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
+tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.emb)")
 
 tf.app.flags.DEFINE_string("question_maxlen", None, "Max length of question (default: 30")
 tf.app.flags.DEFINE_string("context_maxlen", None, "Max length of the context (default: 400)")
@@ -47,7 +57,16 @@ tf.app.flags.DEFINE_string("debug_train_samples", None, "number of samples for d
 tf.app.flags.DEFINE_string("ema_weight_decay", 0.999, "exponential decay for moving averages ")
 tf.app.flags.DEFINE_string("evaluate_sample_size", 400, "number of samples for evaluation (default: 400)")
 tf.app.flags.DEFINE_string("model_selection_sample_size", 1000, "number of samples for selecting best model (default: 1000)")
-tf.app.flags.DEFINE_integer("window_batch", 3, "window size / batch size")
+tf.app.flags.DEFINE_boolean("stream_data", False, "Stream the data from disk every epoch instead of loading it into memory.")
+tf.app.flags.DEFINE_integer("shuffle_buffer", 10000, "Number of records in the shuffle buffer when streaming (0 keeps file order).")
+tf.app.flags.DEFINE_integer("shuffle_seed", None, "Seed of the shuffle when streaming, saved with the checkpoints (default: random).")
+tf.app.flags.DEFINE_string("context_buckets", "", "Comma separated context length boundaries for bucketing, e.g. 100,150,200,300 (default: num_buckets quantiles in memory, no bucketing when streaming)")
+tf.app.flags.DEFINE_string("question_buckets", "", "Comma separated question length boundaries for bucketing in memory, e.g. 10,15 (default: no split)")
+tf.app.flags.DEFINE_boolean("group_by_context", False, "Keep the questions of a paragraph together in training batches, so that it is encoded once for all of them.")
+tf.app.flags.DEFINE_integer("num_buckets", 32, "Number of context length buckets when context_buckets is not given.")
+tf.app.flags.DEFINE_integer("prefetch", 2, "Training batches prepared in the background while the model runs (0: off).")
+tf.app.flags.DEFINE_string("prefetch_mode", "thread", "Prefetch with a 'thread' or with worker processes ('process', in memory data only).")
+tf.app.flags.DEFINE_integer("prefetch_workers", 1, "Number of worker processes in process prefetch mode.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -58,13 +77,25 @@ def initialize_model(session, model, train_dir):
         logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
         saver = tf.train.Saver()
         saver.restore(session, ckpt.model_checkpoint_path)
+        if not model.config.RE_TRAIN_EMBED:
+            model.load_embeddings(session)
     else:
         logging.info("Created model with fresh parameters.")
         session.run(tf.global_variables_initializer())
+        model.load_embeddings(session)
         logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
     return model
 
 
+def load_training_state(train_dir):
+    """Epoch, batch, step, best f1 and RNG state saved with the latest checkpoint in train_dir"""
+    ckpt = tf.train.get_checkpoint_state(train_dir)
+    state = read_training_state(ckpt.model_checkpoint_path) if ckpt else None
+    if ckpt and state is None:
+        logging.info("%s has no training state, starting from the first epoch" % ckpt.model_checkpoint_path)
+    return state
+
+
 def initialize_vocab(vocab_path):
     if tf.gfile.Exists(vocab_path):
         rev_vocab = []
@@ -101,17 +132,31 @@ def main(_):
 
     #dataset = read_data(FLAGS.data_dir, small_dir=None, small_val=None, \
     #    debug_train_samples=FLAGS.debug_train_samples, debug_val_samples=100, context_maxlen=FLAGS.context_maxlen)
-    dataset = read_data(FLAGS.data_dir)
+    context_buckets = parse_boundaries(FLAGS.context_buckets)
+    if FLAGS.stream_data:
+        dataset = stream_data(FLAGS.data_dir, FLAGS.batch_size, shuffle_buffer=FLAGS.shuffle_buffer,
+                              bucket_boundaries=context_buckets, seed=FLAGS.shuffle_seed)
+        if FLAGS.window_size:
+            logging.warning("window_size needs the data in memory, training on whole contexts")
+    else:
+        dataset = read_data(FLAGS.data_dir)
+        if FLAGS.window_size:
+            # train on the windows holding the whole answer
+            for split in ['training', 'validation']:
+                data = dataset[split]
+                dataset[split], example_of, _ = data.chunk(FLAGS.window_size, FLAGS.window_stride, answers_only=True)
+                logging.info("%s: %d windows of %d questions, %d questions have no window with their answer",
+                             split, len(dataset[split]), len(data), len(data) - len(np.unique(example_of)))
+            dataset['context_maxlen'] = min(dataset['context_maxlen'], FLAGS.window_size)
     if FLAGS.context_maxlen is None:
         FLAGS.context_maxlen = dataset['context_maxlen']
     if FLAGS.question_maxlen is None:
         FLAGS.question_maxlen = dataset['question_maxlen']
 
-    embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
-    embeddings = load_glove_embeddings(embed_path)
-
+    embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.emb".format(FLAGS.embedding_size))
     vocab_path = FLAGS.vocab_path or pjoin(FLAGS.data_dir, "vocab.dat")
     vocab, rev_vocab = initialize_vocab(vocab_path)
+    embeddings = load_glove_embeddings(embed_path, rev_vocab)
 
 
     qa = QASystem(embeddings, FLAGS)
@@ -131,9 +176,10 @@ def main(_):
     with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
         load_train_dir = get_normalized_train_dir(FLAGS.load_train_dir or FLAGS.train_dir)
         initialize_model(sess, qa, load_train_dir)
+        training_state = load_training_state(load_train_dir)
 
         save_train_dir = get_normalized_train_dir(FLAGS.train_dir)
-        qa.train(sess, dataset, save_train_dir, rev_vocab)
+        qa.train(sess, dataset, save_train_dir, rev_vocab, training_state=training_state)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,14 @@
+import os
+import bisect
 import logging
 import numpy as np
+from six.moves import xrange
 from os.path import join as pjoin
 from tensorflow.python.platform import gfile
 
+from utils.util import as_column, ragged_take, QADataset
+import utils.glove as glove_reader
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
@@ -14,29 +20,42 @@ class Config(object):
             self.train_answer_span_file = pjoin(data_dir, 'train.span_sorted')
             self.train_question_file = pjoin(data_dir, 'train.ids.question_sorted')
             self.train_context_file = pjoin(data_dir, 'train.ids.context_sorted')
+            self.train_context_index_file = pjoin(data_dir, 'train.context_index_sorted')
         else:
             if small_dir is None:
                 # self.train_answer_file = pjoin(data_dir, 'train.answer')
                 self.train_answer_span_file = pjoin(data_dir, 'train.span')
                 self.train_question_file = pjoin(data_dir, 'train.ids.question')
                 self.train_context_file = pjoin(data_dir, 'train.ids.context')
+                self.train_context_index_file = pjoin(data_dir, 'train.context_index')
             else:
                 self.train_answer_span_file = pjoin(data_dir, 'train.span_' + str(small_dir))
                 self.train_question_file = pjoin(data_dir, 'train.ids.question_' + str(small_dir))
                 self.train_context_file = pjoin(data_dir, 'train.ids.context_' + str(small_dir))
+                self.train_context_index_file = pjoin(data_dir, 'train.context_index_' + str(small_dir))
 
         if small_val is None:
             self.val_answer_span_file = pjoin(data_dir, 'val.span')
             self.val_question_file = pjoin(data_dir, 'val.ids.question')
             self.val_context_file = pjoin(data_dir, 'val.ids.context')
+            self.val_context_index_file = pjoin(data_dir, 'val.context_index')
         else:
             self.val_answer_span_file = pjoin(data_dir, 'val.span_')+str(small_val)
             self.val_question_file = pjoin(data_dir, 'val.ids.question_')+str(small_val)
             self.val_context_file = pjoin(data_dir, 'val.ids.context_')+str(small_val)
+            self.val_context_index_file = pjoin(data_dir, 'val.context_index_')+str(small_val)
 
-def load_glove_embeddings(embed_path):
+def load_glove_embeddings(embed_path, vocab=None):
+    """
+    Memory maps the embedding file written by qa_data.py
+    :param vocab: rev_vocab the file must have been trimmed to
+    """
     logger.info("Loading glove embedding...")
-    glove = np.load(embed_path)['glove']
+    if embed_path.endswith(".npz"):
+        # matrices written before the memory mapped format
+        glove = np.load(embed_path)['glove'].astype(np.float32)
+    else:
+        glove = glove_reader.open_embeddings(embed_path, vocab)
     logger.info("Dimension: {}".format(glove.shape[1]))
     logger.info("Vocabulary: {}" .format(glove.shape[0]))
     return glove
@@ -45,7 +64,7 @@ def add_paddings(sentence, max_length, n_features=1):
     mask = [True] * len(sentence)
     pad_len = max_length - len(sentence)
     if pad_len > 0:
-        padded_sentence = sentence + [0] * pad_len
+        padded_sentence = list(sentence) + [0] * pad_len
         mask += [False] * pad_len
     else:
         padded_sentence = sentence[:max_length]
@@ -64,58 +83,222 @@ def preprocess_dataset(dataset, question_maxlen, context_maxlen):
 def strip(x):
     return map(int, x.strip().split(" "))
 
-def read_data(data_dir, small_dir=None, small_val = None, question_maxlen=None, context_maxlen=None, debug_train_samples=None, debug_val_samples=None):
-    config = Config(data_dir, small_dir=small_dir, small_val = small_val)
+# Binary token-id format
+# ----------------------
+# A text file of space separated token ids (e.g. train.ids.question) is
+# compiled once into two .npy files next to it:
+#   <path>.tokens.npy   int32 [total_tokens]  all lines concatenated
+#   <path>.offsets.npy  int64 [num_lines + 1] line i is tokens[offsets[i]:offsets[i+1]]
+# A span file (e.g. train.span) is compiled into
+#   <path>.npy          int32 [num_lines, 2]  (answer start, answer end)
+# and a context index file (e.g. train.context_index) into
+#   <path>.npy          int32 [num_lines]     row of the context table
+# read_data opens these with np.load(mmap_mode='r'), so start-up does not parse
+# any text and processes reading the same split share the page cache.
+# <path>.stamp records the format version and the size and modification time
+# of the text file the binaries were compiled from; they are recompiled when
+# any of them differs.
+#
+# Context deduplication
+# ---------------------
+# When {tier}.context_index exists, {tier}.ids.context is a table holding
+# each paragraph once and question i uses row context_index[i]. Samples of
+# the same paragraph then share one context object in memory. Without the
+# index file, line i of {tier}.ids.context is the context of question i.
+
+def ids_binary_paths(path):
+    return path + '.tokens.npy', path + '.offsets.npy'
+
+def array_binary_path(path):
+    return path + '.npy'
+
+BINARY_FORMAT_VERSION = 1
+
+def stamp_path(path):
+    return path + '.stamp'
+
+def _source_stamp(text_path):
+    stat = os.stat(text_path)
+    return '{} {} {!r}'.format(BINARY_FORMAT_VERSION, stat.st_size, stat.st_mtime)
+
+def _write_stamp(text_path, stamp):
+    with open(stamp_path(text_path), 'w') as f:
+        f.write(stamp)
+
+def _is_fresh(binary_paths, text_path):
+    """Whether binary_paths were compiled from text_path as it is now, by this format version"""
+    if not all(gfile.Exists(p) for p in list(binary_paths) + [stamp_path(text_path)]):
+        return False
+    with open(stamp_path(text_path)) as f:
+        return f.read() == _source_stamp(text_path)
+
+def compile_ids_file(path):
+    # taken first: a file changed while compiling is compiled again next time
+    stamp = _source_stamp(path)
+    tokens_path, offsets_path = ids_binary_paths(path)
+    lengths = []
+    chunks = []
+    with gfile.GFile(path, mode="rb") as f:
+        for line in f:
+            ids = np.fromstring(line, dtype=np.int32, sep=' ')
+            chunks.append(ids)
+            lengths.append(len(ids))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+    np.save(tokens_path, tokens.astype(np.int32))
+    np.save(offsets_path, offsets)
+    _write_stamp(path, stamp)
+    logger.info("Compiled %s: %d lines, %d tokens", path, len(lengths), len(tokens))
+
+def compile_span_file(path):
+    stamp = _source_stamp(path)
+    with gfile.GFile(path, mode="rb") as f:
+        spans = np.array([strip(line) for line in f], dtype=np.int32).reshape(-1, 2)
+    np.save(array_binary_path(path), spans)
+    _write_stamp(path, stamp)
+    logger.info("Compiled %s: %d spans", path, len(spans))
+
+def compile_index_file(path):
+    stamp = _source_stamp(path)
+    with gfile.GFile(path, mode="rb") as f:
+        index = np.array([int(line) for line in f], dtype=np.int32)
+    np.save(array_binary_path(path), index)
+    _write_stamp(path, stamp)
+    logger.info("Compiled %s: %d rows", path, len(index))
 
-    train = []
+def _maybe_compile(question_file, context_file, span_file, context_index_file=None, force=False):
+    for path in [question_file, context_file]:
+        if force or not _is_fresh(ids_binary_paths(path), path):
+            compile_ids_file(path)
+    if force or not _is_fresh([array_binary_path(span_file)], span_file):
+        compile_span_file(span_file)
+    if context_index_file is not None and \
+            (force or not _is_fresh([array_binary_path(context_index_file)], context_index_file)):
+        compile_index_file(context_index_file)
+
+def _context_index_file(path):
+    return path if gfile.Exists(path) else None
+
+def compile_data(data_dir, small_dir=None, small_val=None, sorted_data=True, force=False):
+    """Writes the binary form of every split referenced by Config, skipping
+    files whose binary form is fresh and splits that do not exist (yet)."""
+    config = Config(data_dir, small_dir=small_dir, small_val=small_val, sorted_data=sorted_data)
+    for question_file, context_file, span_file, context_index_file in [
+            (config.train_question_file, config.train_context_file, config.train_answer_span_file,
+             config.train_context_index_file),
+            (config.val_question_file, config.val_context_file, config.val_answer_span_file,
+             config.val_context_index_file)]:
+        if not gfile.Exists(question_file):
+            logger.info("No %s, not compiled", question_file)
+            continue
+        _maybe_compile(question_file, context_file, span_file, _context_index_file(context_index_file), force=force)
+
+def open_ids_file(path):
+    tokens_path, offsets_path = ids_binary_paths(path)
+    # view as plain ndarrays: slicing np.memmap objects is much slower
+    tokens = np.load(tokens_path, mmap_mode='r').view(np.ndarray)
+    offsets = np.load(offsets_path, mmap_mode='r').view(np.ndarray)
+    return tokens, offsets
+
+def open_array_file(path):
+    return np.load(array_binary_path(path), mmap_mode='r').view(np.ndarray)
+
+def _iter_text_split(question_file, context_file, span_file, context_index_file=None):
+    if context_index_file is None:
+        with gfile.GFile(question_file, mode="rb") as q_file, \
+             gfile.GFile(context_file, mode="rb") as c_file, \
+             gfile.GFile(span_file, mode="rb") as a_file:
+                for (q, c, a) in zip(q_file, c_file, a_file):
+                    yield strip(q), strip(c), strip(a)
+    else:
+        with gfile.GFile(context_file, mode="rb") as c_file:
+            contexts = [strip(c) for c in c_file]
+        with gfile.GFile(question_file, mode="rb") as q_file, \
+             gfile.GFile(context_index_file, mode="rb") as i_file, \
+             gfile.GFile(span_file, mode="rb") as a_file:
+                for (q, i, a) in zip(q_file, i_file, a_file):
+                    yield strip(q), contexts[int(i)], strip(a)
+
+def _read_binary_split(question_file, context_file, span_file, context_index_file=None, context_maxlen=None, max_samples=None):
+    """The dataset keeps views of the mapped files: the contexts always, the
+    questions unless examples are filtered out, in which case they are copied"""
+    q_tokens, q_offsets = open_ids_file(question_file)
+    c_tokens, c_offsets = open_ids_file(context_file)
+    spans = open_array_file(span_file)
+    if context_index_file is None:
+        if len(c_offsets) - 1 != len(spans):
+            # a deduplicated context table whose index file is missing: pairing
+            # rows by line number would silently mismatch questions and contexts
+            raise ValueError("{} has {} rows for {} questions but there is no context index file".format(
+                context_file, len(c_offsets) - 1, len(spans)))
+        context_index = np.arange(len(spans))
+    else:
+        context_index = open_array_file(context_index_file)
+    keep = None
+    # ignore examples that have answers outside context_maxlen
+    if context_maxlen is not None:
+        keep = np.flatnonzero(spans[:, 1] < context_maxlen)
+    seen = len(spans)
+    if max_samples is not None and max_samples <= (len(spans) if keep is None else len(keep)):
+        keep = (np.arange(len(spans)) if keep is None else keep)[:max_samples]
+        seen = keep[-1] + 1 if len(keep) else 0
+    max_ans_end = spans[:seen, 1].max() if seen else 0
+    if keep is not None and len(keep) == len(spans):
+        keep = None
+    if keep is not None:
+        q_tokens, q_offsets = ragged_take(q_tokens, q_offsets, keep)
+        context_index, spans = context_index[keep], spans[keep]
+    data = QADataset(q_tokens, q_offsets, c_tokens, c_offsets, context_index, spans)
+    max_q_len = data.question_lengths.max() if len(data) else 0
+    max_c_len = data.context_lengths.max() if len(data) else 0
+    return data, max_q_len, max_c_len, max_ans_end
+
+def _read_split(question_file, context_file, span_file, context_index_file=None, context_maxlen=None, max_samples=None, binary=True):
+    """:return: (QADataset, max question length, max context length, max answer end)"""
+    if binary:
+        try:
+            _maybe_compile(question_file, context_file, span_file, context_index_file)
+        except (IOError, OSError) as e:
+            logger.warning("Could not compile binary data (%s), reading text instead", e)
+            binary = False
+    if binary:
+        return _read_binary_split(question_file, context_file, span_file, context_index_file,
+                                  context_maxlen=context_maxlen, max_samples=max_samples)
+
+    data = []
     max_q_len = 0
     max_c_len = 0
     max_ans_end = 0
+    for question, context, answer in _iter_text_split(question_file, context_file, span_file, context_index_file):
+        max_ans_end = max(max_ans_end, answer[1])
+        # ignore examples that have answers outside context_maxlen
+        if context_maxlen is not None and answer[1] >= context_maxlen:
+            continue
+        sample = [question, len(question), context, len(context), answer]
+        data.append(sample)
+        max_q_len = max(max_q_len, len(question))
+        max_c_len = max(max_c_len, len(context))
+        if max_samples is not None and len(data) == max_samples:
+            break
+    return QADataset.from_examples(data), max_q_len, max_c_len, max_ans_end
+
+def read_data(data_dir, small_dir=None, small_val = None, question_maxlen=None, context_maxlen=None, debug_train_samples=None, debug_val_samples=None, binary=True):
+    config = Config(data_dir, small_dir=small_dir, small_val = small_val)
+
     logger.info("Loading training data from %s ...", config.train_question_file)
-    with gfile.GFile(config.train_question_file, mode="rb") as q_file, \
-         gfile.GFile(config.train_context_file, mode="rb") as c_file, \
-         gfile.GFile(config.train_answer_span_file, mode="rb") as a_file:
-            for (q, c, a) in zip(q_file, c_file, a_file):
-                question = strip(q)
-                context = strip(c)
-                answer = strip(a)
-                max_ans_end = max(max_ans_end, answer[1])
-                # ignore examples that have answers outside context_maxlen
-                if context_maxlen is not None and answer[1] >= context_maxlen:
-                    continue
-                sample = [question, len(question), context, len(context), answer]
-                train.append(sample)
-                max_q_len = max(max_q_len, len(question))
-                max_c_len = max(max_c_len, len(context))
-                if debug_train_samples is not None and len(train) == debug_train_samples:
-                    break
+    train, max_q_len, max_c_len, max_ans_end = _read_split(
+        config.train_question_file, config.train_context_file, config.train_answer_span_file,
+        _context_index_file(config.train_context_index_file), context_maxlen=context_maxlen, max_samples=debug_train_samples, binary=binary)
     logger.info("Finish loading %d train data." % len(train))
     logger.info("Max question length %d" % max_q_len)
     logger.info("Max context length %d" % max_c_len)
     logger.info("Max answer end %d" % max_ans_end)
 
-    val = []
-    max_q_len_v = 0
-    max_c_len_v = 0
-    max_ans_end_v = 0
     logger.info("Loading validation data...")
-    with gfile.GFile(config.val_question_file, mode="rb") as q_file, \
-         gfile.GFile(config.val_context_file, mode="rb") as c_file, \
-         gfile.GFile(config.val_answer_span_file, mode="rb") as a_file:
-            for (q, c, a) in zip(q_file, c_file, a_file):
-                question = strip(q)
-                context = strip(c)
-                answer = strip(a)
-                max_ans_end_v = max(max_ans_end_v, answer[1])
-                # ignore examples that have answers outside context_maxlen
-                if context_maxlen is not None and answer[1] >= context_maxlen:
-                    continue
-                sample = [question, len(question), context, len(context), answer]
-                val.append(sample)
-                max_q_len_v = max(max_q_len_v, len(question))
-                max_c_len_v = max(max_c_len_v, len(context))
-                if debug_val_samples is not None and len(val) == debug_val_samples:
-                    break
+    val, max_q_len_v, max_c_len_v, max_ans_end_v = _read_split(
+        config.val_question_file, config.val_context_file, config.val_answer_span_file,
+        _context_index_file(config.val_context_index_file), context_maxlen=context_maxlen, max_samples=debug_val_samples, binary=binary)
     logger.info("Finish loading %d validation data." % len(val))
     logger.info("Max question length %d" % max_q_len_v)
     logger.info("Max context length %d" % max_c_len_v)
@@ -133,5 +316,220 @@ def read_data(data_dir, small_dir=None, small_val = None, question_maxlen=None,
     return {"training": train, "validation": val, "question_maxlen": max_q_len, "context_maxlen": max_c_len}
 
 
+# Streaming, out-of-core access
+# -----------------------------
+# DataStream reads records lazily on every pass instead of materialising the
+# split like read_data. Binary files are used when they are already compiled
+# (everything stays memory-mapped); otherwise the text files are read line by
+# line. With a context index in text form only a table of byte offsets into
+# the context file (8 bytes per paragraph) is kept in memory.
+
+def _line_offsets(path):
+    offsets = []
+    with gfile.GFile(path, mode="rb") as f:
+        position = 0
+        for line in f:
+            offsets.append(position)
+            position += len(line)
+    return np.array(offsets, dtype=np.int64)
+
+def _stream_text_split(question_file, context_file, span_file, context_index_file=None):
+    if context_index_file is None:
+        for record in _iter_text_split(question_file, context_file, span_file):
+            yield record
+        return
+    context_offsets = _line_offsets(context_file)
+    with gfile.GFile(question_file, mode="rb") as q_file, \
+         gfile.GFile(context_file, mode="rb") as c_file, \
+         gfile.GFile(context_index_file, mode="rb") as i_file, \
+         gfile.GFile(span_file, mode="rb") as a_file:
+            for (q, i, a) in zip(q_file, i_file, a_file):
+                c_file.seek(context_offsets[int(i)])
+                yield strip(q), strip(c_file.readline()), strip(a)
+
+def _stream_binary_split(question_file, context_file, span_file, context_index_file=None):
+    q_tokens, q_offsets = open_ids_file(question_file)
+    c_tokens, c_offsets = open_ids_file(context_file)
+    spans = open_array_file(span_file)
+    context_index = open_array_file(context_index_file) if context_index_file is not None else None
+    for i in xrange(len(spans)):
+        c = context_index[i] if context_index is not None else i
+        yield q_tokens[q_offsets[i]:q_offsets[i + 1]], c_tokens[c_offsets[c]:c_offsets[c + 1]], spans[i]
+
+class DataStream(object):
+    """
+    Re-iterable stream of minibatches read from disk. Each pass yields
+    batches in the column format of utils.util.minibatches
+    ([questions, question lengths, contexts, context lengths, spans]).
+
+    Records go through a shuffle buffer of shuffle_buffer records (0 keeps
+    file order). With bucket_boundaries, records are grouped by context
+    length into buckets that are emitted as soon as they hold batch_size
+    records, so peak memory is about shuffle_buffer + len(buckets) * batch_size
+    records regardless of the size of the split.
+
+    Every epoch is shuffled by RandomState(seed) with a seed drawn from the
+    stream's own RNG (self.rng); epoch(seed, start) replays one from a given
+    batch, which is how training resumes mid-epoch.
+    """
+
+    def __init__(self, question_file, context_file, span_file, context_index_file=None, batch_size=24,
+                 shuffle_buffer=10000, bucket_boundaries=None, context_maxlen=None, binary=None, seed=None):
+        self.question_file = question_file
+        self.context_file = context_file
+        self.span_file = span_file
+        self.context_index_file = context_index_file
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.bucket_boundaries = sorted(bucket_boundaries) if bucket_boundaries else None
+        self.context_maxlen = context_maxlen
+        if binary is None:
+            # never compile here: compiling reads a whole file into memory
+            binary = _is_fresh(ids_binary_paths(question_file), question_file) and \
+                     _is_fresh(ids_binary_paths(context_file), context_file) and \
+                     _is_fresh([array_binary_path(span_file)], span_file) and \
+                     (context_index_file is None or
+                      _is_fresh([array_binary_path(context_index_file)], context_index_file))
+        self.binary = binary
+        self._num_records = None
+        self._max_lengths = None
+        # epochs are shuffled from this RNG only, so that evaluation sampling or
+        # another thread drawing from the global one cannot change their order
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        """Number of records on disk (before the context_maxlen filter)"""
+        if self._num_records is None:
+            if self.binary:
+                self._num_records = len(open_array_file(self.span_file))
+            else:
+                with gfile.GFile(self.span_file, mode="rb") as f:
+                    self._num_records = sum(1 for _ in f)
+        return self._num_records
+
+    def max_lengths(self):
+        """
+        (max question length, max context length) of the records kept by the
+        context_maxlen filter, from the offsets of the binary files or from
+        one pass over the text files
+        """
+        if self._max_lengths is None:
+            if self.binary:
+                question_lengths = np.diff(open_ids_file(self.question_file)[1])
+                context_lengths = np.diff(open_ids_file(self.context_file)[1])
+                if self.context_index_file is not None:
+                    context_lengths = context_lengths[open_array_file(self.context_index_file)]
+                if self.context_maxlen is not None:
+                    keep = open_array_file(self.span_file)[:, 1] < self.context_maxlen
+                    question_lengths, context_lengths = question_lengths[keep], context_lengths[keep]
+                self._max_lengths = (int(question_lengths.max()) if len(question_lengths) else 0,
+                                     int(context_lengths.max()) if len(context_lengths) else 0)
+            else:
+                max_q_len = max_c_len = 0
+                for _, question_len, _, context_len, _ in self.records():
+                    max_q_len = max(max_q_len, question_len)
+                    max_c_len = max(max_c_len, context_len)
+                self._max_lengths = (max_q_len, max_c_len)
+        return self._max_lengths
+
+    def records(self):
+        stream = _stream_binary_split if self.binary else _stream_text_split
+        for question, context, answer in stream(self.question_file, self.context_file, self.span_file,
+                                                self.context_index_file):
+            # ignore examples that have answers outside context_maxlen
+            if self.context_maxlen is not None and answer[1] >= self.context_maxlen:
+                continue
+            yield [question, len(question), context, len(context), answer]
+
+    def shuffled_records(self, rng=np.random):
+        if not self.shuffle_buffer:
+            for sample in self.records():
+                yield sample
+            return
+        buf = []
+        for sample in self.records():
+            if len(buf) < self.shuffle_buffer:
+                buf.append(sample)
+                continue
+            i = rng.randint(len(buf))
+            yield buf[i]
+            buf[i] = sample
+        rng.shuffle(buf)
+        for sample in buf:
+            yield sample
+
+    def take(self, n):
+        """The first n samples of a pass shuffled by the global NumPy RNG, e.g. for evaluate_answer"""
+        samples = []
+        for sample in self.shuffled_records():
+            samples.append(sample)
+            if len(samples) == n:
+                break
+        return samples
+
+    def next_seed(self):
+        """Seed of the next epoch, drawn from the stream's RNG"""
+        return int(self.rng.randint(2 ** 31 - 1))
+
+    def _batch(self, samples):
+        return [as_column(col) for col in zip(*samples)]
+
+    def epoch(self, seed, start=0):
+        """
+        The batches of the pass shuffled by RandomState(seed), from batch
+        start on: the same seed and start resume an epoch where it stopped.
+        Batches before start are read but not built.
+        """
+        rng = np.random.RandomState(seed)
+        position = 0
+        if self.bucket_boundaries is None:
+            samples = []
+            for sample in self.shuffled_records(rng):
+                samples.append(sample)
+                if len(samples) == self.batch_size:
+                    if position >= start:
+                        yield self._batch(samples)
+                    position += 1
+                    samples = []
+            if samples and position >= start:
+                yield self._batch(samples)
+            return
+        buckets = [[] for _ in range(len(self.bucket_boundaries) + 1)]
+        for sample in self.shuffled_records(rng):
+            bucket = buckets[bisect.bisect_left(self.bucket_boundaries, sample[3])]
+            bucket.append(sample)
+            if len(bucket) == self.batch_size:
+                if position >= start:
+                    yield self._batch(bucket)
+                position += 1
+                del bucket[:]
+        for bucket in buckets:
+            if bucket:
+                if position >= start:
+                    yield self._batch(bucket)
+                position += 1
+
+    def __iter__(self):
+        return self.epoch(self.next_seed())
+
+def stream_data(data_dir, batch_size, small_dir=None, small_val=None, context_maxlen=None,
+                shuffle_buffer=10000, bucket_boundaries=None, binary=None, seed=None):
+    """Out-of-core counterpart of read_data: returns DataStreams instead of lists.
+    The max lengths are those of the training split, see DataStream.max_lengths."""
+    config = Config(data_dir, small_dir=small_dir, small_val=small_val)
+    train = DataStream(config.train_question_file, config.train_context_file, config.train_answer_span_file,
+                       _context_index_file(config.train_context_index_file), batch_size=batch_size,
+                       shuffle_buffer=shuffle_buffer, bucket_boundaries=bucket_boundaries,
+                       context_maxlen=context_maxlen, binary=binary, seed=seed)
+    val = DataStream(config.val_question_file, config.val_context_file, config.val_answer_span_file,
+                     _context_index_file(config.val_context_index_file), batch_size=batch_size,
+                     shuffle_buffer=0, context_maxlen=context_maxlen, binary=binary)
+    logger.info("Streaming %d train and %d validation records (binary: %s)", len(train), len(val), train.binary)
+    max_q_len, max_c_len = train.max_lengths()
+    logger.info("Max question length %d" % max_q_len)
+    logger.info("Max context length %d" % max_c_len)
+    return {"training": train, "validation": val, "question_maxlen": max_q_len, "context_maxlen": max_c_len}
+
+
 if __name__ == '__main__':
     read_data('../../data/squad', 100)
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""
+Chunked reader for GloVe text files.
+
+The file is cut into byte ranges that end on line boundaries. Every range is
+parsed on its own: words are split off each line and the numbers of the whole
+range are converted in a single np.fromstring call, which is what makes this
+an order of magnitude faster than split()/float() per value. Ranges can be
+parsed by a multiprocessing.Pool and are always returned in file order.
+
+Parsed matrices are stored uncompressed so that they can be memory mapped:
+
+    header       64 bytes  'EMB1', uint64 vocab size, uint32 dim, 20 byte
+                           sha1 of the vocabulary (see vocab_checksum),
+                           zero padded
+    vectors      float32   [vocab size, dim] little endian, row major
+
+Rows of the untrimmed matrix are found through a WordIndex, a sorted string
+table searched in place:
+
+    header       64 bytes  'WIX1', uint64 number of words, 20 byte sha1 of
+                           the vocabulary, zero padded
+    offsets      int64     [n + 1] start of every word in the blob
+    rows         int64     [n] matrix row of every word
+    blob         bytes     the words in sorted order
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import itertools
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1 << 25
+
+HEADER_SIZE = 64
+_MAGIC = b'EMB1'
+_HEADER = struct.Struct('<4sQI20s')
+_INDEX_MAGIC = b'WIX1'
+_INDEX_HEADER = struct.Struct('<4sQ20s')
+
+
+def count_lines(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    num_lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            num_lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return num_lines + (last != b'\n')
+
+
+def chunk_bounds(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """[(start, end)] byte ranges of about chunk_size bytes, each ending after a newline"""
+    size = os.path.getsize(path)
+    bounds = []
+    start = 0
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def parse_lines(data, dim):
+    """
+    :param data: bytes holding complete "word v_1 ... v_dim" lines
+    :return: (words, float32 array [len(words), dim])
+    """
+    lines = [line.strip() for line in data.split(b'\n')]
+    lines = [line for line in lines if line]
+    words = []
+    values = []
+    for line in lines:
+        word, _, rest = line.partition(b' ')
+        words.append(word)
+        values.append(rest)
+    vectors = np.fromstring(b' '.join(values), dtype=np.float32, sep=' ')
+    if vectors.size != len(words) * dim:
+        # words containing spaces (glove.840B has a few): split from the right instead
+        words = []
+        vectors = np.empty((len(lines), dim), dtype=np.float32)
+        for i, line in enumerate(lines):
+            array = line.rsplit(b' ', dim)
+            if len(array) != dim + 1:
+                raise ValueError("Expected {} values in GloVe line {!r}".format(dim, line[:100]))
+            words.append(array[0])
+            vectors[i] = np.array(array[1:], dtype=np.float32)
+    return words, vectors.reshape(len(words), dim)
+
+
+def _parse_range(args):
+    path, start, end, dim = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return parse_lines(f.read(end - start), dim)
+
+
+def iter_glove(path, dim, num_workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields (words, vectors) for consecutive blocks of the GloVe file at path,
+    vectors being a float32 array [len(words), dim].
+    """
+    tasks = [(path, start, end, dim) for (start, end) in chunk_bounds(path, chunk_size)]
+    pool = None
+    if num_workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(num_workers, len(tasks)))
+        results = pool.imap(_parse_range, tasks)
+    else:
+        results = itertools.imap(_parse_range, tasks)
+    try:
+        for words, vectors in results:
+            yield words, vectors
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def vocab_checksum(words):
+    """sha1 of the words one per line, i.e. of the matching vocabulary file"""
+    checksum = hashlib.sha1()
+    for word in words:
+        checksum.update(word + b'\n')
+    return checksum.digest()
+
+
+def _write_header(f, vocab_size, dim, checksum):
+    f.seek(0)
+    f.write(_HEADER.pack(_MAGIC, vocab_size, dim, checksum).ljust(HEADER_SIZE, b'\0'))
+
+
+def read_header(path):
+    """:return: (vocab_size, dim, vocab checksum)"""
+    with open(path, 'rb') as f:
+        magic, vocab_size, dim, checksum = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC:
+        raise ValueError("{} is not an embedding file".format(path))
+    return vocab_size, dim, checksum
+
+
+def open_output(path, shape):
+    """Writable float32 matrix of a new embedding file, see commit_output"""
+    with open(path + '.part', 'wb') as f:
+        _write_header(f, shape[0], shape[1], b'\0' * 20)
+    return np.memmap(path + '.part', dtype='<f4', mode='r+', offset=HEADER_SIZE, shape=shape)
+
+
+def commit_output(matrix, path, checksum):
+    """
+    :param checksum: vocab_checksum of the words of the rows, checked by
+                     open_embeddings
+    """
+    matrix.flush()
+    with open(path + '.part', 'r+b') as f:
+        _write_header(f, matrix.shape[0], matrix.shape[1], checksum)
+    os.rename(path + '.part', path)
+
+
+def open_embeddings(path, vocab=None):
+    """
+    Read-only memory map of an embedding file. Pages are only read when rows
+    are used and are shared by every process mapping the same file.
+    :param vocab: words of the rows, checked against the checksum in the header
+    """
+    vocab_size, dim, checksum = read_header(path)
+    if vocab is not None and (len(vocab) != vocab_size or vocab_checksum(vocab) != checksum):
+        raise ValueError("{} was built for a different vocabulary, rerun qa_data.py".format(path))
+    return np.memmap(path, dtype='<f4', mode='r', offset=HEADER_SIZE, shape=(vocab_size, dim))
+
+
+def write_word_index(path, words):
+    """Writes the WordIndex of words, the i-th word being matrix row i"""
+    # stable sort: for duplicates the last row wins, as in a dict built from words
+    order = sorted(range(len(words)), key=words.__getitem__)
+    lengths = np.array([len(words[i]) for i in order], dtype=np.int64)
+    offsets = np.zeros(len(words) + 1, dtype='<i8')
+    np.cumsum(lengths, out=offsets[1:])
+    with open(path + '.part', 'wb') as f:
+        f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, len(words), vocab_checksum(words)).ljust(HEADER_SIZE, b'\0'))
+        f.write(offsets.tobytes())
+        f.write(np.array(order, dtype='<i8').tobytes())
+        for i in order:
+            f.write(words[i])
+    os.rename(path + '.part', path)
+
+
+class WordIndex(object):
+    """
+    Read-only word -> row mapping backed by a file from write_word_index.
+    Lookups binary search the memory mapped table, so opening it costs
+    nothing and only the probed pages are ever read.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, self.size, self.checksum = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+            if magic != _INDEX_MAGIC:
+                raise ValueError("{} is not a word index".format(path))
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = np.frombuffer(self.data, dtype='<i8', count=self.size + 1, offset=HEADER_SIZE)
+        self.rows = np.frombuffer(self.data, dtype='<i8', count=self.size, offset=HEADER_SIZE + 8 * (self.size + 1))
+        self.blob_start = HEADER_SIZE + 8 * (2 * self.size + 1)
+
+    def __len__(self):
+        return self.size
+
+    def _word(self, i):
+        return self.data[self.blob_start + self.offsets[i]:self.blob_start + self.offsets[i + 1]]
+
+    def get(self, word, default=None):
+        # rightmost position whose word is <= word
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if word < self._word(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo and self._word(lo - 1) == word:
+            return int(self.rows[lo - 1])
+        return default
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        row = self.get(word)
+        if row is None:
+            raise KeyError(word)
+        return row
+
+    def close(self):
+        self.offsets = self.rows = None
+        self.data.close()
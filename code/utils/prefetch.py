@@ -0,0 +1,215 @@
+"""
+Background batch preparation, so that building the next batches overlaps
+with session.run on the current one.
+
+Prefetcher wraps any iterable of batches and yields the same batches in the
+same order:
+
+    thread   a thread iterates the source and fills a bounded queue. A
+             DataStream shuffles from its own RNG, so the thread never
+             draws from the caller's global NumPy RNG
+    process  worker processes build the batches of an index based source
+             (one with .sampler and .batch(indices), i.e. PaddedBatches) and
+             write them into shared memory slots. The sampler is iterated by
+             the caller, so shuffling draws from the caller's NumPy RNG
+             exactly as without prefetching.
+
+Counters tell whether input is the bottleneck: starved is the number of
+batches the consumer had to wait for, wait_time the seconds it waited.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+_END = 'end'
+_ERROR = 'error'
+_SLOT = 'slot'
+_PICKLED = 'pickled'
+
+
+class Prefetcher(object):
+    def __init__(self, source, depth=2, mode='thread', num_workers=1, slot_bytes=1 << 24):
+        """
+        :param depth: batches prepared ahead (per worker in process mode)
+        :param slot_bytes: size of a shared memory slot; larger batches are
+                           sent through the result queue instead
+        """
+        if mode not in ('thread', 'process'):
+            raise ValueError("Unknown prefetch mode {}".format(mode))
+        if mode == 'process' and not (hasattr(source, 'sampler') and hasattr(source, 'batch')):
+            logger.warning("Process prefetching needs an index based source, using a thread")
+            mode = 'thread'
+        self.source = source
+        self.depth = max(1, depth)
+        self.mode = mode
+        self.num_workers = num_workers
+        self.slot_bytes = slot_bytes
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.source)
+
+    def reset_stats(self):
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.
+
+    def _get(self, q):
+        if q.empty():
+            self.starved += 1
+            tic = time.time()
+            item = q.get()
+            self.wait_time += time.time() - tic
+        else:
+            item = q.get()
+        self.batches += 1
+        return item
+
+    def __iter__(self):
+        if self.mode == 'thread':
+            return self._iter_thread()
+        return self._iter_process()
+
+    def _iter_thread(self):
+        batches = iter(self.source)
+        # the first batch is taken here so that a sampler draws its epoch plan
+        # from the RNG before the caller continues, as it would unprefetched
+        try:
+            first = next(batches)
+        except StopIteration:
+            return
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for batch in batches:
+                    while not stop.is_set():
+                        try:
+                            q.put((None, batch), timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                q.put((_END, None))
+            except Exception:
+                q.put((_ERROR, traceback.format_exc()))
+
+        thread = threading.Thread(target=produce, name="prefetch")
+        thread.daemon = True
+        thread.start()
+        try:
+            self.batches += 1
+            yield first
+            while True:
+                kind, item = self._get(q)
+                if kind == _END:
+                    break
+                if kind == _ERROR:
+                    raise RuntimeError("Prefetch thread failed:\n" + item)
+                yield item
+        finally:
+            stop.set()
+
+    def _iter_process(self):
+        """
+        Batches are assigned to workers round robin, so reading the result
+        queues round robin restores the sampler's order. A batch lives in its
+        worker's slot until the next batch is requested.
+        """
+        workers = []
+        try:
+            for w in range(self.num_workers):
+                tasks = multiprocessing.Queue()
+                results = multiprocessing.Queue()
+                slots = [RawArray('b', self.slot_bytes) for _ in range(self.depth)]
+                process = multiprocessing.Process(target=_worker, args=(self.source, tasks, results, slots))
+                process.daemon = True
+                process.start()
+                workers.append((process, tasks, results, slots))
+
+            plan = iter(self.source.sampler)
+            in_flight = 0
+            sent = 0
+            received = 0
+            exhausted = False
+            while True:
+                # keep depth batches queued for every worker
+                while not exhausted and in_flight < self.depth * self.num_workers:
+                    try:
+                        indices = next(plan)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    workers[sent % self.num_workers][1].put((sent // self.num_workers % self.depth, indices))
+                    sent += 1
+                    in_flight += 1
+                if received == sent:
+                    break
+                kind, item = self._get(workers[received % self.num_workers][2])
+                if kind == _ERROR:
+                    raise RuntimeError("Prefetch worker failed:\n" + item)
+                if kind == _SLOT:
+                    slot, layout = item
+                    batch = _unpack(workers[received % self.num_workers][3][slot], layout)
+                else:
+                    batch = item
+                received += 1
+                yield batch
+                in_flight -= 1
+        finally:
+            for process, tasks, _, _ in workers:
+                tasks.put(None)
+            for process, _, _, _ in workers:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+
+
+def _pack(slot, arrays):
+    """Copies arrays into slot, returns their layout or None if they do not fit"""
+    layout = []
+    offset = 0
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        if offset + array.nbytes > len(slot):
+            return None
+        np.frombuffer(slot, dtype=np.int8, count=array.nbytes, offset=offset)[:] = array.view(np.int8).ravel()
+        layout.append((offset, array.dtype.str, array.shape))
+        offset += array.nbytes
+    return layout
+
+
+def _unpack(slot, layout):
+    return [np.frombuffer(slot, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            for offset, dtype, shape in layout]
+
+
+def _worker(source, tasks, results, slots):
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            slot, indices = task
+            batch = source.batch(indices)
+            layout = _pack(slots[slot], batch)
+            if layout is None:
+                results.put((_PICKLED, batch))
+            else:
+                results.put((_SLOT, (slot, layout)))
+    except Exception:
+        results.put((_ERROR, traceback.format_exc()))
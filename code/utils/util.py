@@ -12,6 +12,7 @@ import sys
 import time
 import logging
 import StringIO
+import heapq
 from collections import defaultdict, Counter, OrderedDict
 import numpy as np
 from numpy import array, zeros, allclose
@@ -63,6 +64,148 @@ def get_best_span(start_logits, end_logits, context_ids):
     best_word_span = (len_pre + best_word_span[0], len_pre + best_word_span[1])
     return best_word_span, max_val
 
+SENTENCE_END_ID = 6 # dot id, ends a sentence for get_best_span
+
+def get_sentence_starts(context_ids, boundary_id=SENTENCE_END_ID):
+    """
+    :param context_ids: [N, JX] padded context ids
+    :return: [N, JX] position of the first token of every token's sentence,
+             sentences ending after each boundary_id as in get_best_span
+    """
+    context_ids = np.asarray(context_ids)
+    positions = np.arange(context_ids.shape[1])
+    starts = np.zeros(context_ids.shape, dtype=np.int64)
+    starts[:, 1:] = np.where(context_ids[:, :-1] == boundary_id, positions[1:], 0)
+    return np.maximum.accumulate(starts, axis=1)
+
+def get_best_spans(start_logits, end_logits, lengths, sentence_starts=None, max_answer_len=None):
+    """
+    get_best_span on a whole batch: for every row the span (i, j), i <= j <
+    length, maximizing start_logits[i] + end_logits[j], the smallest j and
+    then the smallest i on ties, so that results are identical.
+    :param sentence_starts: [N, JX] from get_sentence_starts, i must then be
+                            in the sentence of j; None for no constraint
+    :param max_answer_len: at most this many tokens per span, None for no limit
+    :return: ([N, 2] spans, [N] scores); rows of length 0 give (0, 0)
+    """
+    start_logits = np.asarray(start_logits)
+    end_logits = np.asarray(end_logits)
+    N, JX = start_logits.shape
+    positions = np.arange(JX)
+    # first allowed start for every end position
+    lo = np.zeros((N, JX), dtype=np.int64) if sentence_starts is None else np.asarray(sentence_starts)[:, :JX]
+    if max_answer_len:
+        lo = np.maximum(lo, positions - max_answer_len + 1)
+    # best start up to every end: max over [lo, j] from a sparse table of
+    # maxima over power of two windows ending at each position
+    level = np.floor(np.log2(positions - lo + 1)).astype(np.int64)
+    tables = [start_logits]
+    for k in range(1, int(level.max()) + 1 if level.size else 0):
+        width = 1 << (k - 1)
+        tables.append(np.concatenate([tables[-1][:, :width],
+                                      np.maximum(tables[-1][:, width:], tables[-1][:, :-width])], axis=1))
+    tables = np.stack(tables)
+    # the windows [j - 2^k + 1, j] and [lo, lo + 2^k - 1] cover [lo, j]
+    rows = np.arange(N)[:, None]
+    best_start = np.maximum(tables[level, rows, positions], tables[level, rows, lo + (1 << level) - 1])
+    values = best_start + end_logits
+    values[positions >= np.asarray(lengths)[:, None]] = -np.inf
+    ends = np.argmax(values, axis=1)
+    lo_end = lo[np.arange(N), ends]
+    candidates = np.where((positions >= lo_end[:, None]) & (positions <= ends[:, None]), start_logits, -np.inf)
+    starts = np.argmax(candidates, axis=1)
+    scores = start_logits[np.arange(N), starts] + end_logits[np.arange(N), ends]
+    empty = np.asarray(lengths) <= 0
+    if empty.any():
+        starts[empty] = ends[empty] = 0
+        scores[empty] = start_logits[empty, 0] + end_logits[empty, 0]
+    return np.stack([starts, ends], axis=1), scores
+
+DEFAULT_MAX_ANSWER_LEN = 30 # longest span of get_top_spans without max_answer_len
+
+def _masked_log_softmax(logits, mask):
+    logits = np.where(mask, logits, -np.inf)
+    top = np.max(logits, axis=-1, keepdims=True)
+    top[~np.isfinite(top)] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_probs = logits - top - np.log(np.sum(np.exp(logits - top), axis=-1, keepdims=True))
+    return np.where(np.isneginf(logits), -np.inf, log_probs)
+
+def get_top_spans(start_logits, end_logits, lengths, k, max_answer_len=None, sentence_starts=None, length_prior=None):
+    """
+    The k most probable non-overlapping spans of every row, picked greedily.
+    P(i, j) is proportional to softmax(start_logits)[i] * softmax(end_logits)[j]
+    * length_prior[j - i] and sums to 1 over the allowed spans, i <= j <
+    min(length, i + max_answer_len) and in one sentence when sentence_starts
+    is given, so only a [N, JX, max_answer_len] table is built.
+    :param max_answer_len: DEFAULT_MAX_ANSWER_LEN when None
+    :param sentence_starts: [N, JX] from get_sentence_starts, None for no constraint
+    :param length_prior: weights of span lengths 1, 2, ..., 0 past its end, None for uniform
+    :return: ([[(start, end)]], [[probability]]), best first, at most k per row
+    """
+    start_logits = np.asarray(start_logits, dtype=np.float64)
+    end_logits = np.asarray(end_logits, dtype=np.float64)
+    lengths = np.asarray(lengths)
+    N, JX = start_logits.shape
+    L = min(max_answer_len or DEFAULT_MAX_ANSWER_LEN, JX)
+    positions = np.arange(JX)
+    in_context = positions < lengths[:, None]
+    # table[n, i, l] scores the span (i, i + l)
+    ends = np.minimum(positions[:, None] + np.arange(L), JX - 1)
+    valid = (positions[:, None] + np.arange(L) < lengths[:, None, None])
+    if sentence_starts is not None:
+        valid &= np.asarray(sentence_starts)[:, :JX][:, ends] <= positions[:, None]
+    table = _masked_log_softmax(start_logits, in_context)[:, :, None] + _masked_log_softmax(end_logits, in_context)[:, ends]
+    if length_prior is not None:
+        # lengths past the prior get no weight
+        prior = np.zeros(L)
+        prior[:len(length_prior)] = np.asarray(length_prior, dtype=np.float64)[:L]
+        with np.errstate(divide='ignore'):
+            table = table + np.log(prior)
+    table = np.where(valid, table, -np.inf)
+    table = _masked_log_softmax(table.reshape(N, -1), valid.reshape(N, -1)).reshape(N, JX, L)
+
+    # best span of every start, re-evaluated when a picked span cuts it short
+    best_len = np.argmax(table, axis=2)
+    best = np.max(table, axis=2)
+    spans, probs = [], []
+    for n in range(N):
+        heap = [(-best[n, i], i, best_len[n, i]) for i in np.flatnonzero(np.isfinite(best[n]))]
+        heapq.heapify(heap)
+        taken = np.zeros(JX + L, dtype=bool)
+        row_spans, row_probs = [], []
+        while heap and len(row_spans) < k:
+            score, i, l = heapq.heappop(heap)
+            if taken[i]:
+                continue
+            if taken[i:i + l + 1].any():
+                # a picked span starts inside (i, i + l]: only shorter spans remain
+                l = np.argmax(taken[i:i + L])
+                if np.isfinite(table[n, i, :l]).any():
+                    heapq.heappush(heap, (-np.max(table[n, i, :l]), i, np.argmax(table[n, i, :l])))
+                continue
+            taken[i:i + l + 1] = True
+            row_spans.append((int(i), int(i + l)))
+            row_probs.append(float(np.exp(-score)))
+        spans.append(row_spans)
+        probs.append(row_probs)
+    return spans, probs
+
+def merge_window_spans(spans, scores, example_of, window_start, num_examples):
+    """
+    Picks the answer of every example among the best spans of its windows
+    (see QADataset.chunk): the span with the highest score, i.e. start plus
+    end logit as returned by get_best_spans, the earliest window on ties.
+    :return: [(start, end)] in context positions, (0, 0) for examples without windows
+    """
+    spans = np.asarray(spans, dtype=np.int64).reshape(len(example_of), 2)
+    order = np.lexsort((window_start, -np.asarray(scores), example_of))
+    examples, first = np.unique(np.asarray(example_of)[order], return_index=True)
+    best = order[first]
+    merged = np.zeros((num_examples, 2), dtype=np.int64)
+    merged[examples] = spans[best] + np.asarray(window_start)[best][:, None]
+    return [tuple(span) for span in merged.tolist()]
+
 def get_best_span1(start_logits, end_logits):
     # original answer
     # a_s = np.argmax(start_logits)
@@ -943,8 +1086,406 @@ def get_minibatches_with_window(data, batch_size, window_batch):
 def minibatch(data, minibatch_idx):
     return data[minibatch_idx] if type(data) is np.ndarray else [data[i] for i in minibatch_idx]
 
-def minibatches(data, batch_size, shuffle=True, window_batch=None):
-    batches = [np.array(col) for col in zip(*data)]
+def as_column(col):
+    """
+    Turns one field of all samples into an array. Ragged fields (token ids)
+    become object arrays holding references to the samples' own lists, so
+    contexts shared by several questions are not copied.
+    """
+    if len(col) > 0 and isinstance(col[0], (list, np.ndarray)) and len(set(len(x) for x in col)) > 1:
+        column = np.empty(len(col), dtype=object)
+        for i, x in enumerate(col):
+            column[i] = x
+        return column
+    return np.array(col)
+
+def parse_boundaries(spec):
+    """'100,150,200' -> [100, 150, 200], '' -> None"""
+    return [int(b) for b in spec.split(',')] if spec else None
+
+def pack_by_tokens(indices, context_lengths, question_lengths, max_tokens, max_question_tokens=None):
+    """
+    Greedily cuts indices into consecutive batches whose padded size,
+    max(length) * number of examples, stays within max_tokens context tokens
+    (and max_question_tokens question tokens). An example over the budget
+    on its own gets a batch of one.
+    """
+    batches = []
+    start = 0
+    longest_context = longest_question = 0
+    for n, i in enumerate(indices):
+        longest_context = max(longest_context, context_lengths[i])
+        longest_question = max(longest_question, question_lengths[i])
+        size = n - start + 1
+        if size > 1 and (longest_context * size > max_tokens or
+                         (max_question_tokens and longest_question * size > max_question_tokens)):
+            batches.append(indices[start:n])
+            start = n
+            longest_context, longest_question = context_lengths[i], question_lengths[i]
+    if start < len(indices):
+        batches.append(indices[start:])
+    return batches
+
+class BucketSampler(object):
+    """
+    Splits examples into buckets by (context length, question length) and
+    yields index arrays of batches drawn from a single bucket. Every epoch
+    shuffles the examples within each bucket and the order of the batches
+    across buckets, and covers each example exactly once.
+
+    Batches hold batch_size examples, or with max_tokens as many examples as
+    fit in that many padded context tokens (see pack_by_tokens), which keeps
+    the memory of a step roughly constant.
+
+    The context and question padding of the batches yielded so far is
+    accumulated in padded_tokens / real_tokens, see padding_fraction.
+    """
+    def __init__(self, context_lengths, question_lengths, batch_size, context_boundaries=None,
+                 question_boundaries=None, num_buckets=32, shuffle=True, max_tokens=None, max_question_tokens=None,
+                 groups=None):
+        """
+        :param context_boundaries: sorted upper bounds (exclusive) of the context
+                                   length buckets, default: num_buckets quantiles
+        :param question_boundaries: same for questions, default: no split
+        :param shuffle: without shuffling, buckets are sorted by context length
+                        and batches come in bucket order
+        :param groups: group of every example, e.g. its paragraph. Examples
+                       of a group stay next to each other within a bucket,
+                       shuffling moves whole groups
+        """
+        self.context_lengths = np.asarray(context_lengths)
+        self.question_lengths = np.asarray(question_lengths)
+        self.groups = None if groups is None else np.asarray(groups)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        self.max_question_tokens = max_question_tokens
+        if context_boundaries is None:
+            quantiles = np.percentile(self.context_lengths, np.linspace(0, 100, num_buckets + 1)[1:-1])
+            context_boundaries = np.unique(np.ceil(quantiles).astype(np.int64))
+        question_boundaries = question_boundaries or []
+        bucket_ids = np.searchsorted(context_boundaries, self.context_lengths, side='right') * (len(question_boundaries) + 1) \
+            + np.searchsorted(question_boundaries, self.question_lengths, side='right')
+        order = np.argsort(bucket_ids, kind='mergesort')
+        _, starts = np.unique(bucket_ids[order], return_index=True)
+        self.buckets = np.split(order, starts[1:])
+        if not shuffle and self.groups is not None:
+            self.buckets = [b[np.lexsort((self.groups[b], self.context_lengths[b]))] for b in self.buckets]
+        elif not shuffle:
+            self.buckets = [b[np.argsort(self.context_lengths[b], kind='mergesort')] for b in self.buckets]
+        # batches of the next epoch, planned early when __len__ is asked first
+        self._planned = None
+        self._start = 0
+        self.reset_stats()
+
+    def _plan(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = np.random.permutation(bucket)
+                if self.groups is not None:
+                    groups, group_of = np.unique(self.groups[bucket], return_inverse=True)
+                    bucket = bucket[np.argsort(np.random.permutation(len(groups))[group_of], kind='mergesort')]
+            if self.max_tokens:
+                batches.extend(pack_by_tokens(bucket, self.context_lengths, self.question_lengths,
+                                              self.max_tokens, self.max_question_tokens))
+            else:
+                batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def __len__(self):
+        if not self.max_tokens:
+            return sum(int(np.ceil(len(b) / self.batch_size)) for b in self.buckets)
+        if self._planned is None:
+            self._planned = self._plan()
+        return len(self._planned)
+
+    def resume(self, position, rng_state):
+        """
+        Makes the next epoch the one planned when the NumPy RNG was in
+        rng_state, continued from batch position. Batches before it are
+        skipped without being built; the global RNG is left as it is.
+        """
+        current = np.random.get_state()
+        np.random.set_state(rng_state)
+        self._planned = self._plan()
+        np.random.set_state(current)
+        self._start = position
+
+    def reset_stats(self):
+        self.padded_tokens = np.zeros(2, dtype=np.int64)
+        self.real_tokens = np.zeros(2, dtype=np.int64)
+
+    def padding_fraction(self):
+        """(context, question) share of padding in the batches yielded since reset_stats"""
+        return tuple(1 - self.real_tokens / np.maximum(self.padded_tokens, 1))
+
+    def __iter__(self):
+        batches = self._planned if self._planned is not None else self._plan()
+        batches = batches[self._start:]
+        self._planned = None
+        self._start = 0
+        for indices in batches:
+            for j, lengths in enumerate((self.context_lengths[indices], self.question_lengths[indices])):
+                self.padded_tokens[j] += lengths.max() * len(indices)
+                self.real_tokens[j] += lengths.sum()
+            yield indices
+
+def pad_sequences(sequences, max_len=None, dtype=np.int32):
+    """
+    Pads (or cuts) sequences of ids into one [len(sequences), max_len] matrix
+    without a Python loop over positions.
+    :return: (matrix, lengths)
+    """
+    lengths = np.array([len(s) for s in sequences], dtype=np.int32)
+    if max_len is None:
+        max_len = lengths.max() if len(lengths) else 0
+    if (lengths > max_len).any():
+        sequences = [s[:max_len] for s in sequences]
+        lengths = np.minimum(lengths, max_len)
+    matrix = np.zeros((len(sequences), max_len), dtype=dtype)
+    if lengths.sum():
+        matrix[np.arange(max_len) < lengths[:, None]] = np.concatenate([np.asarray(s, dtype=dtype) for s in sequences])
+    return matrix, lengths
+
+def ragged_slices(tokens, starts, lengths):
+    """
+    Concatenates tokens[start:start + length] for every start and length.
+    :return: (tokens, offsets) of the slices
+    """
+    new_offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.arange(new_offsets[-1]) + np.repeat(starts - new_offsets[:-1], lengths)
+    return tokens[positions], new_offsets
+
+def ragged_take(tokens, offsets, rows):
+    """
+    Concatenates the sequences rows of a ragged array stored as tokens plus
+    offsets (sequence i is tokens[offsets[i]:offsets[i + 1]]).
+    :return: (tokens, offsets) of the selected sequences
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    return ragged_slices(tokens, offsets[rows], offsets[rows + 1] - offsets[rows])
+
+def padded_take(tokens, starts, lengths, dtype=np.int32):
+    """[len(starts), max(lengths)] matrix of the sequences tokens[start:start + length], zero padded"""
+    width = lengths.max() if len(lengths) else 0
+    columns = np.arange(width)
+    mask = columns < lengths[:, None]
+    if not mask.any():
+        return np.zeros(mask.shape, dtype=dtype)
+    matrix = tokens[np.where(mask, starts[:, None] + columns, 0)].astype(dtype, copy=False)
+    matrix[~mask] = 0
+    return matrix
+
+class QADataset(object):
+    """
+    In-memory split without per-example objects. Token ids of all questions,
+    and of all distinct contexts, are concatenated into int32 arrays with
+    int64 offsets; context_index maps every question to its context, so a
+    paragraph shared by several questions is stored once. Lengths and spans
+    are typed arrays.
+
+    dataset[i] is the example [question, question length, context, context
+    length, span] with the ids as array views, dataset[indices] a QADataset
+    of those examples and batch(indices) the padded batch [questions,
+    question lengths, contexts, context lengths, spans, context index]:
+    contexts has a row per distinct context of the batch and context index
+    gives the row of every question.
+    """
+    __slots__ = ('question_tokens', 'question_offsets', 'context_tokens', 'context_offsets',
+                 'context_index', 'question_lengths', 'context_lengths', 'spans')
+
+    def __init__(self, question_tokens, question_offsets, context_tokens, context_offsets, context_index, spans):
+        """:param spans: [n, 2] answer start/end, (-1, -1) when unknown"""
+        self.question_tokens = np.asarray(question_tokens, dtype=np.int32)
+        self.question_offsets = np.asarray(question_offsets, dtype=np.int64)
+        self.context_tokens = np.asarray(context_tokens, dtype=np.int32)
+        self.context_offsets = np.asarray(context_offsets, dtype=np.int64)
+        self.context_index = np.asarray(context_index, dtype=np.int64)
+        self.spans = np.asarray(spans, dtype=np.int32).reshape(len(self.context_index), 2)
+        self.question_lengths = np.diff(self.question_offsets).astype(np.int32)
+        self.context_lengths = np.diff(self.context_offsets).astype(np.int32)[self.context_index]
+
+    @classmethod
+    def from_examples(cls, examples):
+        """
+        From a list of [question, question length, context, context length,
+        span] examples; contexts that are the same object are stored once.
+        """
+        context_row = {}
+        contexts = []
+        context_index = np.empty(len(examples), dtype=np.int64)
+        for i, x in enumerate(examples):
+            row = context_row.get(id(x[2]))
+            if row is None:
+                row = context_row[id(x[2])] = len(contexts)
+                contexts.append(x[2])
+            context_index[i] = row
+        question_tokens, question_offsets = _concatenate([x[0] for x in examples])
+        context_tokens, context_offsets = _concatenate(contexts)
+        spans = [(-1, -1) if x[4] is None else x[4] for x in examples]
+        return cls(question_tokens, question_offsets, context_tokens, context_offsets, context_index, spans)
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.context_index)
+
+    def question(self, i):
+        return self.question_tokens[self.question_offsets[i]:self.question_offsets[i + 1]]
+
+    def context(self, i):
+        row = self.context_index[i]
+        return self.context_tokens[self.context_offsets[row]:self.context_offsets[row + 1]]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            return [self.question(key), self.question_lengths[key],
+                    self.context(key), self.context_lengths[key], self.spans[key]]
+        if isinstance(key, slice):
+            key = np.arange(len(self))[key]
+        return self.take(key)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def take(self, indices):
+        """QADataset of the examples at indices, sharing the context arrays"""
+        indices = np.asarray(indices, dtype=np.int64)
+        question_tokens, question_offsets = ragged_take(self.question_tokens, self.question_offsets, indices)
+        return QADataset(question_tokens, question_offsets, self.context_tokens, self.context_offsets,
+                         self.context_index[indices], self.spans[indices])
+
+    def chunk(self, window, stride, answers_only=False):
+        """
+        Cuts every context into windows of window tokens, one every stride
+        tokens, the last one reaching the end of the context.
+        :param answers_only: keep only the windows holding the whole answer,
+                             for training
+        :return: (chunks, example_of, window_start): a QADataset with an
+                 example per question and window of its context, and for
+                 each of them the question's index in this dataset and the
+                 window's first token in the context. Spans are relative to
+                 the window, (-1, -1) when the answer is not inside.
+        """
+        if window <= 0 or not 0 < stride <= window:
+            raise ValueError("Need 0 < stride <= window, got stride {} and window {}".format(stride, window))
+        lengths = np.diff(self.context_offsets)
+        num_windows = 1 + np.maximum(0, -(-(lengths - window) // stride))
+        first_window = np.concatenate([[0], np.cumsum(num_windows)[:-1]])
+        window_context = np.repeat(np.arange(len(lengths)), num_windows)
+        window_start = (np.arange(num_windows.sum()) - first_window[window_context]) * stride
+        window_len = np.minimum(window, lengths[window_context] - window_start)
+        context_tokens, context_offsets = ragged_slices(
+            self.context_tokens, self.context_offsets[window_context] + window_start, window_len)
+
+        example_windows = num_windows[self.context_index]
+        example_of = np.repeat(np.arange(len(self)), example_windows)
+        window_of = np.repeat(first_window[self.context_index], example_windows) + np.arange(len(example_of)) - \
+            np.repeat(np.cumsum(example_windows) - example_windows, example_windows)
+        spans = self.spans[example_of] - window_start[window_of][:, None]
+        inside = (self.spans[example_of, 0] >= 0) & (spans[:, 0] >= 0) & (spans[:, 1] < window_len[window_of])
+        spans[~inside] = -1
+        if answers_only:
+            example_of, window_of, spans = example_of[inside], window_of[inside], spans[inside]
+        question_tokens, question_offsets = ragged_take(self.question_tokens, self.question_offsets, example_of)
+        chunks = QADataset(question_tokens, question_offsets, context_tokens, context_offsets, window_of, spans)
+        return chunks, example_of, window_start[window_of]
+
+    def batch(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        question_lengths = self.question_lengths[indices]
+        questions = padded_take(self.question_tokens, self.question_offsets[indices], question_lengths)
+        rows, context_index = np.unique(self.context_index[indices], return_inverse=True)
+        contexts = padded_take(self.context_tokens, self.context_offsets[rows],
+                               (self.context_offsets[rows + 1] - self.context_offsets[rows]))
+        return [questions, question_lengths, contexts, self.context_lengths[indices], self.spans[indices],
+                context_index.astype(np.int32)]
+
+def _concatenate(sequences):
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in sequences], out=offsets[1:])
+    if not offsets[-1]:
+        return np.zeros(0, dtype=np.int32), offsets
+    return np.concatenate([np.asarray(s, dtype=np.int32) for s in sequences]), offsets
+
+class PaddedBatches(object):
+    """
+    Batches of a BucketSampler as padded id matrices. Questions and contexts
+    of every bucket are padded once, to the longest one in the bucket, so each
+    epoch only gathers rows and cuts the columns to the batch's longest
+    example. Batches are [questions, question lengths, contexts, context
+    lengths, spans] like those of minibatches; for a QADataset with the
+    distinct contexts only and the context index, as QADataset.batch.
+    """
+    def __init__(self, data, sampler):
+        self.data = data
+        self.sampler = sampler
+        self.bucket_of = np.empty(len(data), dtype=np.int64)
+        self.row_of = np.empty(len(data), dtype=np.int64)
+        self.buckets = []
+        for b, bucket in enumerate(sampler.buckets):
+            self.bucket_of[bucket] = b
+            self.row_of[bucket] = np.arange(len(bucket))
+            if isinstance(data, QADataset):
+                # the distinct contexts of the bucket and the row of every question
+                self.buckets.append(tuple(data.batch(bucket)))
+                continue
+            examples = [data[i] for i in bucket]
+            questions, question_lengths = pad_sequences([x[0] for x in examples])
+            contexts, context_lengths = pad_sequences([x[2] for x in examples])
+            spans = np.array([x[4] for x in examples], dtype=np.int32).reshape(len(examples), 2)
+            self.buckets.append((questions, question_lengths, contexts, context_lengths, spans, None))
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def batch(self, indices):
+        """Batch of the examples at indices, which must all be in one bucket"""
+        questions, question_lengths, contexts, context_lengths, spans, context_rows = \
+            self.buckets[self.bucket_of[indices[0]]]
+        rows = self.row_of[indices]
+        question_len, context_len = question_lengths[rows], context_lengths[rows]
+        if context_rows is not None:
+            unique_rows, context_index = np.unique(context_rows[rows], return_inverse=True)
+            return [questions[rows, :question_len.max()], question_len, contexts[unique_rows, :context_len.max()],
+                    context_len, spans[rows], context_index.astype(np.int32)]
+        return [questions[rows, :question_len.max()], question_len,
+                contexts[rows, :context_len.max()], context_len, spans[rows]]
+
+    def __iter__(self):
+        for indices in self.sampler:
+            yield self.batch(indices)
+
+def minibatches(data, batch_size, shuffle=True, window_batch=None, sampler=None):
+    """
+    :param data: list of examples or a QADataset
+    :param sampler: iterable of index arrays (e.g. a BucketSampler), replaces
+                    batch_size, shuffle and window_batch
+    """
+    if isinstance(data, QADataset):
+        # gather padded batches straight from the flat arrays
+        if sampler is None:
+            indices = np.arange(len(data))
+            if window_batch is None:
+                sampler = get_minibatches(indices, batch_size, shuffle)
+            else:
+                sampler = get_minibatches_with_window(indices, batch_size, window_batch)
+        return (data.batch(indices) for indices in sampler)
+    batches = [as_column(col) for col in zip(*data)]
+    if sampler is not None:
+        return ([minibatch(d, indices) for d in batches] for indices in sampler)
     if window_batch is None:
         return get_minibatches(batches, batch_size, shuffle)
     else: